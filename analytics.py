@@ -0,0 +1,197 @@
+from gazetteer import canonical_location
+from numpy import concatenate, empty, floor, load, nan, save, unique, where
+from os import makedirs, remove, replace
+from os.path import isfile, join
+from pandas import DataFrame, to_datetime, to_numeric
+from sys import argv
+from threading import Lock
+from utils import OFFER_COLUMNS, read_new_rows
+import json
+import re
+
+
+# Columns cached by the analytics and their types (loc is saved as a code of the locations' vocabulary)
+CACHED_COLUMNS = {"is_room": "int8", "price": "float64", "size": "float64", "loc": "int32", "scrape_time": "int64"}
+TIME_BUCKETS = {"hour": 3600, "day": 86400, "week": 604800}
+PRICE_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+class Analytics:
+    """ Statistics over the offers' history. Output files are read only once (from the offsets where the previous
+    refresh stopped) -- new rows are converted in chunks to typed columns and cached as .npy batches which are
+    memory-mapped when loaded. """
+    def __init__(self, db_file, cache_dir=None, chunk_size=50000, max_batches=32):
+        """
+        :param db_file: output file (any of its parts) where the offers are saved
+        :param cache_dir: directory for cached columns (next to the output file by default)
+        :param chunk_size: number of rows converted and cached at once
+        :param max_batches: number of cached batches after which they are merged into one
+        """
+        self.db_file = db_file
+        self.cache_dir = cache_dir if cache_dir is not None else \
+            re.sub("(_p[0-9]{2})?\\.csv$", "", db_file) + "_analytics"
+        self.state_file = join(self.cache_dir, "state.json")
+        self.chunk_size = chunk_size
+        self.max_batches = max_batches
+        self.lock = Lock()
+        self.frame_cache = None
+
+        makedirs(self.cache_dir, exist_ok=True)
+
+        # State holds number of bytes read from each part, the locations' vocabulary and the number of batches
+        self.state = {"offsets": {}, "locs": [], "batches": 0}
+        if isfile(self.state_file):
+            with open(self.state_file, "r", encoding="utf-8") as sf:
+                state = json.load(sf)
+
+            # Caches which counted rows (rather than bytes) might have skipped or repeated some, so they are rebuilt
+            if "offsets" in state.keys():
+                self.state = state
+
+    # ---------- Cache management ----------
+    def __batch_file(self, batch, column):
+        return join(self.cache_dir, "batch_%05d_%s.npy" % (batch, column))
+
+    def __save_state(self):
+        with open(self.state_file + ".tmp", "w", encoding="utf-8") as sf:
+            json.dump(self.state, sf)
+        replace(self.state_file + ".tmp", self.state_file)
+
+    def __loc_codes(self, locs):
+        """ Converts locations to codes of the vocabulary (adding new locations to it). Missing location is -1. """
+        vocabulary = dict([(loc, code) for (code, loc) in enumerate(self.state["locs"])])
+        uniques, inverse = unique(locs.fillna("").astype(str).values, return_inverse=True)
+
+        codes = empty(len(uniques), dtype="int32")
+        for (i, loc) in enumerate(uniques):
+            if loc == "":
+                codes[i] = -1
+                continue
+            if loc not in vocabulary.keys():
+                vocabulary[loc] = len(self.state["locs"])
+                self.state["locs"].append(loc)
+            codes[i] = vocabulary[loc]
+
+        return codes[inverse]
+
+    def __convert(self, rows):
+        """ Converts rows read from the output file to typed columns. """
+        chunk = DataFrame(rows, columns=OFFER_COLUMNS)
+        scrape_time = to_datetime(chunk["scrape_time"], errors="coerce").values.astype("datetime64[s]")
+        return {
+            "is_room": chunk["is_room"].map({"True": 1, "False": 0}).fillna(-1).values.astype("int8"),
+            "price": to_numeric(chunk["price"], errors="coerce").values.astype("float64"),
+            "size": to_numeric(chunk["size"], errors="coerce").values.astype("float64"),
+            "loc": self.__loc_codes(chunk["loc"]),
+            "scrape_time": scrape_time.astype("int64")}
+
+    def __save_batch(self, columns):
+        for (column, values) in columns.items():
+            save(self.__batch_file(self.state["batches"], column), values)
+        self.state["batches"] += 1
+
+    def __load_columns(self, mmap_mode="r"):
+        return dict([
+            (column, concatenate([load(self.__batch_file(b, column), mmap_mode=mmap_mode)
+                                  for b in range(self.state["batches"])])
+             if self.state["batches"] > 0 else empty(0, dtype=dtype))
+            for (column, dtype) in CACHED_COLUMNS.items()])
+
+    def __merge_batches(self):
+        """ Merges all cached batches into a single one. """
+        columns = self.__load_columns(mmap_mode=None)
+        batches = self.state["batches"]
+        self.state["batches"] = 0
+        self.__save_batch(columns)
+        self.__save_state()
+        for b in range(1, batches):
+            for column in CACHED_COLUMNS.keys():
+                remove(self.__batch_file(b, column))
+
+    def refresh(self):
+        """ Reads only rows added to the output files since the last refresh. Returns number of new rows. """
+        with self.lock:
+            rows = read_new_rows(self.db_file, self.state["offsets"])
+            new_rows = len(rows)
+            for start in range(0, new_rows, self.chunk_size):
+                self.__save_batch(self.__convert(rows[start:start + self.chunk_size]))
+
+            if new_rows > 0:
+                self.__save_state()
+                self.frame_cache = None
+                if self.state["batches"] > self.max_batches:
+                    self.__merge_batches()
+
+            return new_rows
+
+    # ---------- Statistics ----------
+    def frame(self):
+        """ Returns the cached offers as a data frame (locations decoded, price per m2 added). """
+        if self.frame_cache is None:
+            columns = self.__load_columns()
+            # Code -1 points to the None (locations cached before they were normalized get their canonical names)
+            locs = concatenate([[canonical_location(loc) for loc in self.state["locs"]], [None]]).astype(object)
+            self.frame_cache = DataFrame({
+                "is_room": columns["is_room"],
+                "price": columns["price"],
+                "size": columns["size"],
+                "loc": locs[columns["loc"]],
+                "scrape_time": columns["scrape_time"],
+                "price_m2": where(columns["size"] > 0, columns["price"] / columns["size"], nan)})
+        return self.frame_cache
+
+    def statistics(self, bucket="day", loc=None, is_room=None, since=None):
+        """ Returns statistics of offers grouped by location, offer type and time bucket.
+        :param bucket: one of TIME_BUCKETS keys
+        :param loc: optional location filter (case insensitive)
+        :param is_room: optional offer type filter
+        :param since: optional timestamp (in seconds) of the oldest included offer
+        """
+        frame = self.frame()
+        if loc is not None:
+            frame = frame[frame["loc"].str.lower() == canonical_location(loc).lower()]
+        if is_room is not None:
+            frame = frame[frame["is_room"] == int(is_room)]
+        if since is not None:
+            frame = frame[frame["scrape_time"] >= since]
+
+        bucket_len = TIME_BUCKETS.get(bucket)
+        frame = frame.assign(bucket=to_datetime(floor(frame["scrape_time"] / bucket_len) * bucket_len, unit="s"))
+        groups = frame.groupby(["loc", "is_room", "bucket"])
+
+        stats = groups.agg(
+            offers=("price", "size"),
+            median_price=("price", "median"),
+            median_price_m2=("price_m2", "median"))
+        stats["offers_per_hour"] = stats["offers"] / (bucket_len / 3600)
+
+        # Price distribution
+        quantiles = groups["price"].quantile(PRICE_QUANTILES).unstack()
+        quantiles.columns = ["price_q%02d" % (q * 100) for q in PRICE_QUANTILES]
+
+        return stats.join(quantiles)
+
+    def summary(self, loc, since=None):
+        """ Returns short statistics of given location, separately for flats and rooms. """
+        frame = self.frame()
+        frame = frame[frame["loc"].str.lower() == canonical_location(loc).lower()]
+        if since is not None:
+            frame = frame[frame["scrape_time"] >= since]
+
+        summary = {}
+        for (is_room, offers) in frame.groupby("is_room"):
+            hours = max((offers["scrape_time"].max() - offers["scrape_time"].min()) / 3600, 1)
+            summary[["flats", "rooms", "unknown"][[0, 1, -1].index(is_room)]] = {
+                "offers": len(offers),
+                "median_price": offers["price"].median(),
+                "median_price_m2": offers["price_m2"].median(),
+                "offers_per_hour": len(offers) / hours}
+
+        return summary
+
+
+if __name__ == "__main__":
+    # Usage: python analytics.py output_file [hour/day/week]
+    analytics = Analytics(argv[1])
+    print("New rows: %d" % analytics.refresh())
+    print(analytics.statistics(bucket=argv[2] if len(argv) > 2 else "day").to_string())
@@ -0,0 +1,136 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from offers_index import NUMERIC_FIELDS, to_timestamp
+from threading import Thread, current_thread
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+import json
+
+
+MAX_PAGE_SIZE = 1000
+
+
+class QueryError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def parse_query(params, page_size=100, max_page_size=MAX_PAGE_SIZE):
+    """ Converts URL query parameters to OfferIndex.query arguments. Supported parameters:
+    [price/size/rooms]_[min/max], since (scrape time or timestamp), loc (repeatable), is_room (true/false),
+    offset and limit (page_size if it's missing, at most max_page_size; None means no limit). """
+    def __number(name):
+        value = params.get(name, [None])[0]
+        try:
+            return None if value is None else float(value)
+        except ValueError:
+            raise QueryError("parameter %s must be a number" % name)
+
+    limits = dict([(field, (__number("%s_min" % field), __number("%s_max" % field)))
+                   for field in NUMERIC_FIELDS if field != "scrape_time"])
+
+    # Accept both the scrape time format and a timestamp
+    since = params.get("since", [None])[0]
+    if since is not None:
+        limits["scrape_time"] = (to_timestamp(since) or __number("since"), None)
+
+    is_room = params.get("is_room", [None])[0]
+    if is_room is not None and is_room not in ["true", "false"]:
+        raise QueryError("parameter is_room must be true or false")
+
+    limit = __number("limit") or page_size
+    if limit is not None and max_page_size is not None:
+        limit = min(limit, max_page_size)
+
+    return {
+        "limits": limits,
+        "loc": params.get("loc"),
+        "is_room": None if is_room is None else is_room == "true",
+        "offset": int(__number("offset") or 0),
+        "limit": None if limit is None else int(limit)}
+
+
+def make_handler(offer_index, metrics):
+    """ Creates a request handler class serving offers from given index. """
+    class OffersHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass  # Don't mess up the threads' status table
+
+        def __send_json(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            # Metrics of running components (queues, pipelines etc.)
+            if url.path == "/metrics":
+                self.__send_json(200, dict([(name, obj.stats()) for (name, obj) in metrics.items()
+                                            if obj is not None and hasattr(obj, "stats")]))
+                return
+
+            if url.path not in ["/offers", "/offers.ndjson"]:
+                self.__send_json(404, {"error": "unknown path"})
+                return
+
+            # Offers are streamed without a page limit (unless one is asked for), as they are never held at once
+            try:
+                if url.path == "/offers.ndjson":
+                    query = parse_query(parse_qs(url.query), page_size=None, max_page_size=None)
+                else:
+                    query = parse_query(parse_qs(url.query))
+            except QueryError as err:
+                self.__send_json(400, {"error": str(err)})
+                return
+
+            # Stream offers one per line as they are taken from the index (the response ends with the connection)
+            if url.path == "/offers.ndjson":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+                self.end_headers()
+                try:
+                    for offer in offer_index.stream(**query):
+                        self.wfile.write((json.dumps(offer.scrape_dict, ensure_ascii=False) + "\n").encode("utf-8"))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client went away
+            else:
+                offers = offer_index.query(**query)
+                self.__send_json(200, {
+                    "offset": query.get("offset"),
+                    "count": len(offers),
+                    "offers": [offer.scrape_dict for offer in offers]})
+
+    return OffersHandler
+
+
+def api_runner(thread_statuses, offer_index, port, host="127.0.0.1", metrics=None, refresh_interval=10):
+    """ Function serves stored offers over HTTP until the thread is stopped.
+    :param thread_statuses: used for debugging and checking up on threads
+    :param offer_index: OfferIndex with offers
+    :param port: port the server listens on
+    :param host: address the server listens on (local only by default)
+    :param metrics: dictionary name -> object with stats() method served under /metrics
+    :param refresh_interval: time in seconds between loading offers saved by other processes
+    """
+    thread_statuses[current_thread().name] = "Booting"
+    offer_index.refresh()
+
+    server = ThreadingHTTPServer((host, port), make_handler(offer_index, {**(metrics or {}), "Index": offer_index}))
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    last_refresh = time()
+    while not current_thread().is_stopped():
+        thread_statuses[current_thread().name] = "Serving"
+        if time() - last_refresh > refresh_interval:
+            offer_index.refresh()
+            last_refresh = time()
+        sleep(1)
+
+    server.shutdown()
+    server.server_close()
+    thread_statuses[current_thread().name] = "Stopped"
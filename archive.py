@@ -0,0 +1,212 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from csv import DictWriter
+from datetime import datetime as dt
+from glob import glob
+from importlib.util import find_spec
+from os import getpid, makedirs, replace
+from os.path import basename, getsize, isfile, join
+from threading import Lock
+from time import perf_counter, time
+from utils import OFFER_COLUMNS
+import json
+
+# Note: zstandard is imported only when pages are actually compressed or decompressed.
+
+
+class PageArchive:
+    """ Append-only archive of fetched offers' pages, so offers can be extracted again (e.g. after a scraper was fixed)
+    without fetching pages which might be gone by then. Every page is compressed with zstd on its own and appended
+    to a segment file. Each process writes its own segments, so processes don't have to coordinate. Every segment has
+    an index file with a JSON line (url, offset, length, time) per page. """
+    def __init__(self, archive_dir=None, level=3, segment_size=256 * 2**20):
+        """
+        :param archive_dir: directory of the archive (the archive is disabled until it is opened)
+        :param level: zstd compression level
+        :param segment_size: size in bytes after which a new segment is started
+        """
+        self.archive_dir = None
+        self.level = level
+        self.segment_size = segment_size
+        self.lock = Lock()
+
+        self.segment = None  # name of the segment written by this process
+        self.segment_pid = None
+        self.compressor = None
+
+        self.archived = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+        if archive_dir is not None:
+            self.open(archive_dir)
+
+    def open(self, archive_dir):
+        """ Enables the archive in given directory. """
+        makedirs(archive_dir, exist_ok=True)
+        self.archive_dir = archive_dir
+
+    def segment_path(self, segment):
+        return join(self.archive_dir, segment + ".zst")
+
+    def index_path(self, segment):
+        return join(self.archive_dir, segment + ".idx")
+
+    def add(self, url, html):
+        """ Appends the page to the archive. """
+        import zstandard
+
+        html = html.encode("utf-8") if isinstance(html, str) else html
+        with self.lock:
+            if self.compressor is None:
+                self.compressor = zstandard.ZstdCompressor(level=self.level)
+            data = self.compressor.compress(html)
+
+            # Start a new segment if this process (e.g. forked worker) has none yet or the current one is full
+            if self.segment is None or self.segment_pid != getpid() or \
+                    getsize(self.segment_path(self.segment)) + len(data) > self.segment_size:
+                self.segment = "%d-%d" % (int(time() * 1000), getpid())
+                self.segment_pid = getpid()
+                open(self.segment_path(self.segment), "ab").close()
+
+            # The page is written before its index line, so the index never points to missing data
+            with open(self.segment_path(self.segment), "ab") as sf:
+                offset = sf.tell()
+                sf.write(data)
+            with open(self.index_path(self.segment), "a", encoding="utf-8") as idx:
+                idx.write(json.dumps({"url": url, "offset": offset, "length": len(data),
+                                      "time": dt.now().strftime("%Y-%m-%d %H:%M:%S")}) + "\n")
+
+            self.archived += 1
+            self.raw_bytes += len(html)
+            self.compressed_bytes += len(data)
+
+    def records(self):
+        """ Returns dictionary url -> (segment, offset, length, time) of the latest archived version of every page. """
+        latest = {}
+        for index_file in sorted(glob(join(self.archive_dir, "*.idx"))):
+            segment = basename(index_file)[:-len(".idx")]
+            with open(index_file, "r", encoding="utf-8") as idx:
+                for line in idx:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # the last line might have been cut off by a crash
+
+                    url = record.get("url")
+                    if url not in latest.keys() or record.get("time") >= latest[url][3]:
+                        latest[url] = (segment, record.get("offset"), record.get("length"), record.get("time"))
+        return latest
+
+    def read(self, segment, offset, length):
+        """ Returns the page (bytes) stored at given position. """
+        import zstandard
+
+        with open(self.segment_path(segment), "rb") as sf:
+            sf.seek(offset)
+            return zstandard.ZstdDecompressor().decompress(sf.read(length))
+
+    def get(self, url):
+        """ Returns the latest archived version of the page or None if it wasn't archived. """
+        record = self.records().get(url)
+        return None if record is None else self.read(*record[:3])
+
+    def stats(self):
+        """ Returns the archive's metrics. """
+        with self.lock:
+            return {"archived": self.archived, "raw_bytes": self.raw_bytes, "compressed_bytes": self.compressed_bytes}
+
+
+# Archive used by the offers' scrapers (opened by main script if it was selected)
+ARCHIVE = PageArchive()
+
+
+def archive_page(url, page):
+    """ Saves fetched offer's page (requests_html's HTML) if the archive was opened. """
+    if ARCHIVE.archive_dir is not None and page is not None:
+        ARCHIVE.add(url, page.raw_html)
+
+
+def extract_batch(archive_dir, segment, records):
+    """ Extracts offers from archived pages of one segment (run by the processes of the pool).
+    :param records: list of (offset, length, url, time) sorted by offset
+    Returns (list of offers' scrape dictionaries, number of pages which couldn't be extracted).
+    """
+    from scrapers.scrapers_master import ScraperMissingException, scraper_master
+
+    archive = PageArchive(archive_dir)
+    rows, failed = [], 0
+    for (offset, length, url, fetch_time) in records:
+        try:
+            scrape_dict = scraper_master(url, offer=True, page=archive.read(segment, offset, length))
+        except ScraperMissingException:
+            failed += 1
+            continue
+
+        # The offer is as it was when the page was fetched
+        scrape_dict["scrape_time"] = fetch_time
+        rows.append(scrape_dict)
+
+    return rows, failed
+
+
+def reextract(archive_dir, output_file, processes=None, batch_size=500):
+    """ Extracts offers from all archived pages (the latest version of each) again and writes them to a new output
+    file, one row per offer. The scraper's output isn't touched (its rows are read incrementally by offsets, so they
+    can't be replaced in place) -- the new file replaces it once the scraper is stopped. An existing file is refused,
+    so the re-extracted offers never end up next to the saved ones as duplicates, and the file appears only once all
+    pages were extracted. Batches of pages are extracted by a pool of processes and their results are written as
+    they come.
+    :param archive_dir: directory of the archive
+    :param output_file: new file the offers are written to
+    :param processes: number of processes (all cores by default)
+    :param batch_size: number of pages extracted by a process at once
+    Returns (number of written offers, number of pages which couldn't be extracted).
+    """
+    if isfile(output_file):
+        raise FileExistsError("Output file already exists: %s" % output_file)
+
+    # Batches of pages read sequentially from each segment
+    by_segment = {}
+    for (url, (segment, offset, length, fetch_time)) in PageArchive(archive_dir).records().items():
+        by_segment.setdefault(segment, []).append((offset, length, url, fetch_time))
+    batches = []
+    for (segment, records) in sorted(by_segment.items()):
+        records.sort()
+        batches += [(segment, records[i:i + batch_size]) for i in range(0, len(records), batch_size)]
+
+    written, failed = 0, 0
+    with ProcessPoolExecutor(processes) as pool, open(output_file + ".tmp", "w", encoding="utf-8") as out_file:
+        writer = DictWriter(out_file, OFFER_COLUMNS)
+        for (rows, batch_failed) in pool.map(extract_batch, [archive_dir] * len(batches),
+                                             [segment for (segment, _) in batches],
+                                             [records for (_, records) in batches]):
+            writer.writerows(rows)
+            written += len(rows)
+            failed += batch_failed
+    replace(output_file + ".tmp", output_file)
+
+    return written, failed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="extracts offers from the archived pages again (no pages are fetched)")
+    parser.add_argument("archive_dir", help="directory of the archive")
+    parser.add_argument("output_file", help="new file the extracted offers are written to (it replaces the "
+                                            "scraper's output once the scraper is stopped)")
+    parser.add_argument("--processes", dest="processes", default=None, type=int, metavar="processes",
+                        help="number of processes (all cores by default)")
+    parser.add_argument("--batch-size", dest="batch_size", default=500, type=int, metavar="pages",
+                        help="number of pages extracted by a process at once")
+    args = parser.parse_args()
+
+    if find_spec("zstandard") is None:
+        parser.error("archived pages can't be read without zstandard (pip install zstandard)")
+    if len(glob(join(args.archive_dir, "*.idx"))) == 0:
+        parser.error("there are no archived pages in %s" % args.archive_dir)
+    if isfile(args.output_file):
+        parser.error("%s already exists (the offers are written to a new file)" % args.output_file)
+
+    start = perf_counter()
+    offers, errors = reextract(args.archive_dir, args.output_file, args.processes, args.batch_size)
+    print("Extracted offers: %d, failed pages: %d, time: %.1f s" % (offers, errors, perf_counter() - start))
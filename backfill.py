@@ -0,0 +1,217 @@
+from classes import Page, TokenBucket
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from lineage import Lineage
+from os import replace
+from os.path import isfile
+from queue import Full
+from scrapers.scrapers_master import ScraperMissingException
+from threading import Lock, current_thread
+from time import monotonic, sleep
+from utils import GetPageException
+import json
+import re
+
+
+BACKFILL_PRIORITY = 20  # backfilled offers' priority is lowered by this much (below the deferred ones)
+MAX_BACKOFF = 300       # longest pause in seconds of a feed whose listing pages keep failing
+EMPTY_RETRIES = 3       # number of times a page without offers is fetched again (it might be an error page)
+
+
+def listing_page_url(url, number):
+    """ Returns URL of given page of the listing (pages are numbered from 1). """
+    if url.find("gumtree.") != -1:
+        return re.sub("p[0-9]+$", "p%d" % number, url)
+    return "%s%spage=%d" % (url, "&" if "?" in url else "?", number)
+
+
+class BackfillCrawler:
+    """ Walks all listing pages of the feeds, from the first one to the last one, to collect offers which were
+    published before the scraper started tracking the feeds. Pages of a feed might be fetched concurrently, but they
+    are taken into account in their order. A feed ends with a page which brings no new offers (boards repeat the last
+    page or go back to the first one past the end) or with the page limit. A page without any offers might be an error
+    page, so it ends the feed only if it stays empty after a few retries. The progress (next page of every feed and
+    offers not yet handed over) is saved to the checkpoint file, so the backfill resumes where it stopped. """
+    def __init__(self, checkpoint_file, urls, max_pages=500, window=2):
+        """
+        :param checkpoint_file: JSON file with the progress (loaded on start if it exists)
+        :param urls: listings' URLs (first pages of the feeds)
+        :param max_pages: maximum number of pages walked in a feed
+        :param window: maximum number of pages of a feed fetched ahead of the next one to be taken into account
+        """
+        self.checkpoint_file = checkpoint_file
+        self.max_pages = max_pages
+        self.window = window
+
+        self.lock = Lock()
+        self.feeds = dict([(url, {"next_page": 1, "done": False, "last_offers": []}) for url in urls])
+        self.pending = deque()  # offers' URLs found but not handed over yet
+        if isfile(self.checkpoint_file):
+            with open(self.checkpoint_file, "r", encoding="utf-8") as cf:
+                checkpoint = json.load(cf)
+            for (url, feed) in checkpoint.get("feeds", {}).items():
+                if url in self.feeds.keys():
+                    self.feeds[url] = feed
+            self.pending.extend(checkpoint.get("pending", []))
+
+        # Offers seen in every feed (the last page before a restart is enough to find where the feed ends)
+        self.seen = dict([(url, set(feed.get("last_offers"))) for (url, feed) in self.feeds.items()])
+        self.fetching = dict([(url, set()) for url in self.feeds.keys()])  # pages being fetched
+        self.results = dict([(url, {}) for url in self.feeds.keys()])      # fetched pages waiting for earlier ones
+        self.failures = dict([(url, 0) for url in self.feeds.keys()])
+        self.retry_at = dict([(url, 0) for url in self.feeds.keys()])
+        self.turn = 0  # feeds take turns
+
+        # Metrics
+        self.pages = 0
+        self.errors = 0
+        self.found = 0
+
+    def next_page(self):
+        """ Returns (feed's URL, page number) which should be fetched now or None if there is none. """
+        with self.lock:
+            urls = list(self.feeds.keys())
+            for i in range(len(urls)):
+                url = urls[(self.turn + i) % len(urls)]
+                feed = self.feeds[url]
+                if feed.get("done") or self.retry_at[url] > monotonic():
+                    continue
+
+                number = feed.get("next_page")
+                while number in self.fetching[url] or number in self.results[url].keys():
+                    number += 1
+                if number < feed.get("next_page") + self.window and number <= self.max_pages:
+                    self.fetching[url].add(number)
+                    self.turn = (self.turn + i + 1) % len(urls)
+                    return url, number
+            return None
+
+    def complete(self, url, number, offers_urls):
+        """ Takes the fetched page into account (None means that it couldn't be fetched and it's retried later). """
+        with self.lock:
+            self.fetching[url].discard(number)
+            if offers_urls is not None and len(offers_urls) == 0 and self.failures[url] < EMPTY_RETRIES:
+                offers_urls = None
+            if offers_urls is None:
+                self.errors += 1
+                self.failures[url] += 1
+                self.retry_at[url] = monotonic() + min(2 ** self.failures[url], MAX_BACKOFF)
+                return
+            self.pages += 1
+            self.failures[url] = 0
+
+            # Pages are taken into account in their order
+            feed = self.feeds[url]
+            self.results[url][number] = offers_urls
+            while not feed.get("done") and feed.get("next_page") in self.results[url].keys():
+                page_offers = self.results[url].pop(feed.get("next_page"))
+                new_offers = [offer_url for offer_url in page_offers if offer_url not in self.seen[url]]
+                self.seen[url].update(new_offers)
+                self.pending.extend(new_offers)
+                self.found += len(new_offers)
+
+                feed["last_offers"] = page_offers
+                feed["done"] = len(new_offers) == 0 or feed.get("next_page") >= self.max_pages
+                feed["next_page"] += 1
+            if feed.get("done"):
+                self.results[url] = {}
+
+    def finished(self):
+        """ Returns whether every feed was walked and every found offer was handed over. """
+        with self.lock:
+            return all([feed.get("done") for feed in self.feeds.values()]) and len(self.pending) == 0
+
+    def save(self):
+        """ Saves the progress to the checkpoint file. """
+        with self.lock:
+            checkpoint = {"feeds": self.feeds, "pending": list(self.pending)}
+            with open(self.checkpoint_file + ".tmp", "w", encoding="utf-8") as cf:
+                json.dump(checkpoint, cf)
+            replace(self.checkpoint_file + ".tmp", self.checkpoint_file)
+
+    def stats(self):
+        """ Returns the crawler's metrics. """
+        with self.lock:
+            return {"feeds_done": len([feed for feed in self.feeds.values() if feed.get("done")]),
+                    "feeds": len(self.feeds), "pages": self.pages, "errors": self.errors, "found": self.found,
+                    "pending": len(self.pending)}
+
+
+def fetch_listing_page(url, number):
+    """ Returns offers' URLs from given page of the listing (None if it couldn't be read). """
+    try:
+        return Page(listing_page_url(url, number)).offers_urls
+    except (GetPageException, ScraperMissingException):
+        return None
+
+
+def backfill_runner(thread_statuses, crawler, q_read, rate=0.5, workers=2, low_watermark=5, priority=0,
+                    offer_index=None, save_interval=10):
+    """ Function walks listing pages of the feeds with the crawler and puts found offers to the read queue, so they
+    are processed (deduplicated, fetched and saved) by the workers like the offers read by the readers. Backfilling
+    yields to live polling: it has its own request budget (which it shares with the others through host's rate
+    limit) and offers are handed over (with lowered priority) only while the read queue is almost empty.
+    The thread finishes once the backfill is done.
+    :param thread_statuses: used for debugging and checking up on threads
+    :param crawler: BackfillCrawler with the feeds
+    :param q_read: queue of read offers passed to the workers
+    :param rate: maximum number of listing pages fetched per second
+    :param workers: number of listing pages fetched at the same time
+    :param low_watermark: offers are handed over only while the read queue holds fewer items
+    :param priority: priority of the backfilled offers (supported by the bounded queue)
+    :param offer_index: optional OfferIndex used to skip already saved offers right away
+    :param save_interval: time in seconds between saving the progress to the checkpoint file
+    """
+    thread_statuses[current_thread().name] = "Booting"
+    budget = TokenBucket(rate, capacity=workers)
+    last_save = monotonic()
+    fetching = {}  # future -> (feed's URL, page number)
+
+    with ThreadPoolExecutor(workers) as pool:
+        while not current_thread().is_stopped():
+            # Hand over found offers while live polling leaves the read queue (almost) empty
+            while len(crawler.pending) > 0 and q_read.qsize() < low_watermark and not current_thread().is_stopped():
+                url = crawler.pending[0]
+                if offer_index is None or offer_index.get(url) is None:
+                    try:
+                        lineage = Lineage(url).mark("backfilled")  # backfilled offers aren't sent to the chats
+                        if priority != 0:
+                            q_read.put(lineage, timeout=1, priority=priority)
+                        else:
+                            q_read.put(lineage, timeout=1)
+                    except Full:
+                        break
+                crawler.pending.popleft()
+
+            # Fetch next listing pages (unless there are many found offers waiting already)
+            while len(fetching) < workers and len(crawler.pending) < low_watermark * 20 and \
+                    budget.wait_time() == 0:
+                task = crawler.next_page()
+                if task is None:
+                    break
+                budget.try_acquire()
+                fetching[pool.submit(fetch_listing_page, *task)] = task
+
+            if crawler.finished() and len(fetching) == 0:
+                break
+
+            # Take fetched pages into account
+            if len(fetching) > 0:
+                thread_statuses[current_thread().name] = "Backfill %d" % len(crawler.pending)
+                done, _ = wait(list(fetching.keys()), timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    crawler.complete(*fetching.pop(future), future.result())
+            else:
+                thread_statuses[current_thread().name] = "Yield %d" % len(crawler.pending)
+                sleep(1)
+
+            if monotonic() - last_save > save_interval:
+                crawler.save()
+                last_save = monotonic()
+
+        # Pages still being fetched are fetched again after restart
+        for (future, task) in fetching.items():
+            crawler.complete(*task, future.result() if future.done() else None)
+
+    crawler.save()
+    thread_statuses[current_thread().name] = "Done" if crawler.finished() else "Stopped"
@@ -0,0 +1,138 @@
+""" Checks the egress proxy pool with local stand-in proxies: a fast one, a slow one and one which is fast until it
+breaks a third into the check (then it answers with HTTP 502 or drops the connection). Threads standing in for readers
+fetch pages through get_page for a while. The check fails unless the breaking proxy got (almost) no requests once it
+broke, the fast proxy served more requests than the slow one and almost all fetches brought the listing (error pages
+count as failed fetches).
+Usage: python benchmarks/egress_check.py [--duration seconds] [--threads threads] """
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import abspath, dirname, join
+from threading import Lock, Thread
+from time import monotonic, sleep
+import json
+import random
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from classes import StoppableThread  # noqa: E402
+from egress import EGRESS  # noqa: E402
+from politeness import POLITENESS  # noqa: E402
+from utils import GetPageException, get_page  # noqa: E402
+
+FIXTURES_DIR = join(dirname(abspath(__file__)), "fixtures")
+
+
+class StandInProxy:
+    """ HTTP proxy standing in for an egress proxy. It answers every request itself with the listing fixture. """
+    def __init__(self, name, delay=0.0, failure_rate=0.0):
+        """
+        :param name: name of the proxy in the report
+        :param delay: seconds each answer takes
+        :param failure_rate: fraction of requests answered with HTTP 502 or a dropped connection (can be changed)
+        """
+        self.name = name
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.lock = Lock()
+        self.requests = 0
+        with open(join(FIXTURES_DIR, "olx_listing.html"), "rb") as ff:
+            self.body = ff.read()
+
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with proxy.lock:
+                    proxy.requests += 1
+                sleep(proxy.delay)
+                if random.random() < proxy.failure_rate:
+                    if random.random() < 0.5:
+                        self.send_response(502)
+                        self.end_headers()
+                    else:
+                        self.close_connection = True
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(proxy.body)))
+                self.end_headers()
+                self.wfile.write(proxy.body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+
+def is_listing(page):
+    """ Returns whether the page is the listing (and not e.g. proxy's empty HTTP 502 answer). """
+    try:
+        return len(page.find("table[id=offers_table]")) > 0
+    except Exception:  # empty documents can't even be searched
+        return False
+
+
+def fetch(counter, url, lock):
+    """ Fetches the page over and over (stands in for a reader of one feed). """
+    from threading import current_thread
+    while not current_thread().is_stopped():
+        # Only the listing itself counts, an error page (e.g. proxy's empty HTTP 502 answer) is a failed fetch
+        try:
+            page = get_page(url, retry_after=0)
+            fetched = is_listing(page)
+        except GetPageException:
+            fetched = False
+            sleep(0.1)
+        with lock:
+            counter["pages" if fetched else "failed"] += 1
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="checks routing and quarantine of the egress proxy pool")
+    parser.add_argument("--duration", type=int, default=20, help="length of the check in seconds")
+    parser.add_argument("--threads", type=int, default=6, help="number of fetching threads (feeds)")
+    args = parser.parse_args()
+
+    proxies = [StandInProxy("fast"), StandInProxy("slow", delay=0.3), StandInProxy("breaking")]
+    names = dict([(proxy.url, proxy.name) for proxy in proxies])
+    POLITENESS.configure(rate=50, max_in_flight=4, open_time=1)
+    EGRESS.configure([proxy.url for proxy in proxies])
+    EGRESS.sticky_time = 5  # hosts pick their proxies again often, so the scores matter within the check
+    EGRESS.base_quarantine_time = 3
+
+    counter, lock = {"pages": 0, "failed": 0}, Lock()
+    threads = [StoppableThread(target=fetch, args=(counter, "http://www.olx.pl/feed%d/" % i, lock))
+               for i in range(args.threads)]
+    start = monotonic()
+    for thr in threads:
+        thr.start()
+    sleep(args.duration / 3)
+    proxies[2].failure_rate = 1.0
+    before = dict([(proxy.name, proxy.requests) for proxy in proxies])
+    sleep(args.duration * 2 / 3)
+    for thr in threads:
+        thr.stop()
+    for thr in threads:
+        thr.join()
+
+    stats = dict([(names[url], proxy_stats) for (url, proxy_stats) in EGRESS.stats().items()])
+    served = dict([(proxy.name, proxy.requests) for proxy in proxies])
+    after = dict([(name, served[name] - before[name]) for name in served.keys()])
+    print("Pages: %d, failed fetches: %d, time: %.1f s" % (counter["pages"], counter["failed"], monotonic() - start))
+    print("Requests once the proxy broke: %s" % ", ".join(["%s %d" % item for item in after.items()]))
+    for proxy in proxies:
+        print("%-7s requests %5d  %s" % (proxy.name, proxy.requests, json.dumps(stats[proxy.name])))
+
+    problems = []
+    if after["breaking"] > 0.02 * sum(after.values()):
+        problems.append("the breaking proxy got more than 2% of requests once it broke")
+    if served["fast"] <= served["slow"]:
+        problems.append("the fast proxy served fewer requests than the slow one")
+    if counter["failed"] > 0.01 * (counter["pages"] + counter["failed"]):
+        problems.append("more than 1% of fetches failed")
+    for problem in problems:
+        print("FAILED: %s" % problem)
+    sys.exit(1 if len(problems) > 0 else 0)
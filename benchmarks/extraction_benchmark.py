@@ -0,0 +1,82 @@
+""" Compares extraction of offer pages by the precompiled plans with the former hand-written way (requests_html's
+find() run for every field, regexes compiled at call time). Pages are parsed beforehand, so only extraction is timed.
+Usage: python benchmarks/extraction_benchmark.py [pages] """
+from os.path import abspath, dirname, join
+from time import perf_counter
+import re
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from requests_html import HTML  # noqa: E402
+from scrapers.scrapers_gumtree import GUMTREE_OFFER_PLAN  # noqa: E402
+from scrapers.scrapers_olx import OLX_OFFER_PLAN  # noqa: E402
+
+FIXTURES_DIR = join(dirname(abspath(__file__)), "fixtures")
+
+
+def find_based_olx(page, url):
+    """ OLX offer's fields read the way the hand-written scraper did it (location isn't normalized). """
+    images = [re.search("[^;]*", elem.attrib["src"]).group() for elem in page.element("div[class=photo-glow] img")]
+    try:
+        price = int("".join([d for d in page.find("div[class=price-label]", first=True).text if d.isdigit()]))
+    except (ValueError, AttributeError):
+        price = None
+    try:
+        loc = re.search("^[^,]*", page.find("a[class=show-map-link]", first=True).text).group()
+    except AttributeError:
+        loc = None
+    try:
+        attr_dict = dict([e.text.split(sep="\n") for e in page.find("div[id=offerdescription] table[class=item]")])
+    except ValueError:
+        attr_dict = {}
+    rooms = attr_dict.get("Liczba pokoi")
+    try:
+        size = int(re.search("[0-9]*", attr_dict.get("Powierzchnia")).group())
+    except (ValueError, TypeError):
+        size = None
+    try:
+        is_room = page.element("div[class='wrapper'] td li")[-1].find("a").attrib.get("href").find("stancje") != -1
+    except IndexError:
+        is_room = None
+    return {"url": url, "is_room": is_room, "price": price, "loc": loc, "rooms_info": rooms, "size": size,
+            "images_urls_list": images, "preferred_group": attr_dict.get("Preferowani")}
+
+
+def find_based_gumtree(page, url):
+    """ Gumtree offer's fields read the way the hand-written scraper did it (location isn't normalized). """
+    try:
+        price = int("".join([
+            d for d in page.find("div[class=vip-content-header] span[class=value]", first=True).text if d.isdigit()]))
+    except (ValueError, AttributeError):
+        price = None
+    attr_dict = dict(zip([name.text for name in page.find("div[class=vip-details] span[class=name]")],
+                         [val.text for val in page.find("div[class=vip-details] span[class=value]")]))
+    try:
+        size = int(attr_dict.get("Wielkość (m2)"))
+    except (ValueError, TypeError):
+        size = None
+    return {"url": url, "is_room": url.find("pokoje-do-wynajecia") != -1, "price": price,
+            "loc": attr_dict.get("Lokalizacja"), "rooms_info": attr_dict.get("Liczba pokoi"), "size": size}
+
+
+def run(extract, fixture, url, pages):
+    """ Extracts fields from freshly parsed copies of the fixture. Returns pages per second. """
+    with open(join(FIXTURES_DIR, fixture), "r", encoding="utf-8") as ff:
+        html = ff.read()
+    parsed = [HTML(html=html, url=url) for _ in range(pages)]
+
+    start = perf_counter()
+    for page in parsed:
+        extract(page, url)
+    return pages / (perf_counter() - start)
+
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    for (fixture, url, find_based, plan) in [
+            ("olx_offer.html", "https://www.olx.pl/oferta/CID3-IDabc123.html", find_based_olx, OLX_OFFER_PLAN),
+            ("gumtree_offer.html", "https://www.gumtree.pl/a-mieszkania/1001", find_based_gumtree, GUMTREE_OFFER_PLAN)]:
+        old = run(find_based, fixture, url, pages)
+        new = run(plan.run, fixture, url, pages)
+        print("%-20s find-based: %8.0f pages/s, plan: %8.0f pages/s (%.1fx)" % (fixture, old, new, new / old))
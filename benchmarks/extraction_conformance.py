@@ -0,0 +1,50 @@
+""" Checks that the sites' extraction plans return expected values for saved pages (benchmarks/fixtures).
+The fixtures reproduce the structure of the sites' pages and expected.json holds the values the hand-written
+scrapers returned for them, so a changed spec (or a new site's spec) can be checked without the network.
+Usage: python benchmarks/extraction_conformance.py """
+from os.path import abspath, dirname, join
+import json
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from scrapers import scrapers_gumtree, scrapers_olx  # noqa: E402
+
+FIXTURES_DIR = join(dirname(abspath(__file__)), "fixtures")
+
+
+def find_plan(name):
+    """ Returns the extraction plan of given name from the sites' modules. """
+    for module in [scrapers_olx, scrapers_gumtree]:
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise KeyError("unknown plan %s" % name)
+
+
+def check(case):
+    """ Returns list of (field, expected value, extracted value) which don't match. """
+    with open(join(FIXTURES_DIR, case.get("fixture")), "r", encoding="utf-8") as ff:
+        html = ff.read()
+
+    extracted = find_plan(case.get("plan")).run(html, case.get("url"))
+    expected = case.get("expected")
+
+    # Listing's URL is added by the scraper function, not by the plan
+    fields = [field for field in expected.keys() if field != "url"] + \
+             [field for field in extracted.keys() if field not in expected.keys()]
+    return [(field, expected.get(field), extracted.get(field)) for field in fields
+            if expected.get(field) != extracted.get(field)]
+
+
+if __name__ == "__main__":
+    with open(join(FIXTURES_DIR, "expected.json"), "r", encoding="utf-8") as ef:
+        cases = json.load(ef)
+
+    failed = 0
+    for (name, case) in cases.items():
+        mismatches = check(case)
+        print("%-16s %s" % (name, "ok" if len(mismatches) == 0 else "FAILED"))
+        for (field, expected, extracted) in mismatches:
+            print("    %s: expected %r, extracted %r" % (field, expected, extracted))
+        failed += len(mismatches) > 0
+
+    sys.exit(0 if failed == 0 else 1)
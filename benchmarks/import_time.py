@@ -0,0 +1,54 @@
+""" Checks that the reader-only path of main.py starts within the import-time budget.
+It runs `python -X importtime main.py --help` a few times, sums the cumulative import time of the modules
+imported by main.py (interpreter's startup is excluded) and fails if the median exceeds the budget
+or if any of the heavy modules was imported at all.
+Usage: python benchmarks/import_time.py [budget_ms] """
+from os.path import abspath, dirname, join
+from statistics import median
+from subprocess import DEVNULL, PIPE, run
+import re
+import sys
+
+
+HEAVY_MODULES = ["numpy", "pandas", "requests", "requests_html", "telegram", "PIL"]
+RUNS = 5
+
+
+def parse_importtime(stderr):
+    """ Returns list of (module, cumulative time in us, nesting level) parsed from -X importtime output. """
+    modules = []
+    for line in stderr.splitlines():
+        match = re.match("import time:\\s+([0-9]+) \\|\\s+([0-9]+) \\|( *)(\\S+)$", line)
+        if match is not None:
+            modules.append((match.group(4), int(match.group(2)), (len(match.group(3)) - 1) // 2))
+    return modules
+
+
+def measure(main_file):
+    """ Returns (import time in ms of modules imported after the interpreter's startup, imported modules' names). """
+    stderr = run([sys.executable, "-X", "importtime", main_file, "--help"],
+                 stdout=DEVNULL, stderr=PIPE, universal_newlines=True, check=True).stderr
+    modules = parse_importtime(stderr)
+
+    # Modules imported before (and including) site belong to the interpreter's startup
+    names = [name for (name, _, _) in modules]
+    startup_end = names.index("site") + 1 if "site" in names else 0
+
+    main_modules = modules[startup_end:]
+    return sum([cumulative for (_, cumulative, level) in main_modules if level == 0]) / 1000, \
+        set([name.split(".")[0] for (name, _, _) in main_modules])
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 150
+    main_path = join(dirname(dirname(abspath(__file__))), "main.py")
+
+    results = [measure(main_path) for _ in range(RUNS)]
+    import_time = median([t for (t, _) in results])
+    heavy = sorted(set(HEAVY_MODULES) & results[0][1])
+
+    print("Import time (median of %d runs): %.1f ms, budget: %.1f ms" % (RUNS, import_time, budget))
+    if len(heavy) > 0:
+        print("Heavy modules imported on the reader-only path: %s" % ", ".join(heavy))
+
+    sys.exit(0 if import_time <= budget and len(heavy) == 0 else 1)
@@ -0,0 +1,57 @@
+""" Compares matching offers' descriptions against every chat's keywords by the single automaton with searching
+for each chat's keywords in the description separately. The number of chats grows while the vocabulary of keywords
+stays the same (chats pick a few keywords each), as it does for the bot's chats.
+Usage: python benchmarks/keyword_benchmark.py [descriptions] """
+from os.path import abspath, dirname
+from time import perf_counter
+import random
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from gazetteer import normalize_text  # noqa: E402
+from keywords import KeywordMatcher, normalize_keyword  # noqa: E402
+
+VOCABULARY = ["balkon", "taras", "garaż", "miejsce parkingowe", "zwierzęta", "bez prowizji", "prowizja", "winda",
+              "zmywarka", "klimatyzacja", "ogródek", "piwnica", "komórka lokatorska", "metro", "umeblowane",
+              "dla studentów", "dla pary", "internet", "rachunki wliczone", "kaucja"]
+FILLER = ["mieszkanie", "pokój", "kuchnia", "łazienka", "blisko", "sklepy", "komunikacja", "do", "wynajęcia", "od",
+          "zaraz", "w", "bloku", "na", "piętrze", "spokojna", "okolica", "jasne", "po", "remoncie"]
+
+
+def per_chat(chats, description):
+    """ Chats accepting the description, each chat's (normalized) keywords searched in the normalized text. """
+    text = " %s" % normalize_text(description)
+    return set([chat_id for (chat_id, (include, exclude)) in chats.items()
+                if all([k in text for k in include]) and not any([k in text for k in exclude])])
+
+
+def automaton(matcher, chat_ids, description):
+    """ Chats accepting the description, which is scanned once. """
+    found = matcher.scan(description)
+    return set([chat_id for chat_id in chat_ids if matcher.accepts(chat_id, found)])
+
+
+if __name__ == "__main__":
+    descriptions = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    random.seed(0)
+    texts = [" ".join(random.sample(FILLER * 10 + VOCABULARY, 120)) for _ in range(descriptions)]
+
+    for chats_count in [10, 100, 1000]:
+        chats = dict([(chat_id, (random.sample(VOCABULARY, random.randint(0, 2)), random.sample(VOCABULARY, 1)))
+                      for chat_id in range(chats_count)])
+        matcher = KeywordMatcher()
+        for (chat_id, (include, exclude)) in chats.items():
+            matcher.update(chat_id, include, exclude)
+
+        normalized = dict([(chat_id, ([normalize_keyword(k) for k in include], [normalize_keyword(k) for k in exclude]))
+                           for (chat_id, (include, exclude)) in chats.items()])
+        start = perf_counter()
+        expected = [per_chat(normalized, text) for text in texts]
+        old = descriptions / (perf_counter() - start)
+        start = perf_counter()
+        accepted = [automaton(matcher, list(chats.keys()), text) for text in texts]
+        new = descriptions / (perf_counter() - start)
+
+        assert accepted == expected, "the automaton accepts other chats than the per-chat search"
+        print("%5d chats  per-chat: %8.0f offers/s, automaton: %8.0f offers/s (%.1fx)" % (
+            chats_count, old, new, new / old))
@@ -0,0 +1,46 @@
+""" Compares throughput of the in-memory Queue with the DurableQueue.
+Usage: python benchmarks/queue_benchmark.py [items] """
+from os.path import abspath, dirname
+from queue import Queue
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from queues import DurableQueue  # noqa: E402
+
+
+def run(q, items):
+    """ Pushes items through the queue with one producer and one consumer thread. Returns items per second. """
+    def __produce():
+        for i in range(items):
+            q.put("https://www.olx.pl/oferta/CID3-ID%08d.html" % i)
+
+    def __consume():
+        for _ in range(items):
+            q.get()
+            q.task_done()
+
+    start = perf_counter()
+    threads = [Thread(target=__produce), Thread(target=__consume)]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+
+    return items / (perf_counter() - start)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    memory_rate = run(Queue(), n)
+    with TemporaryDirectory() as tmp_dir:
+        durable_queue = DurableQueue(tmp_dir)
+        durable_rate = run(durable_queue, n)
+        durable_queue.close()
+
+    print("Queue         %10.0f items/s" % memory_rate)
+    print("DurableQueue  %10.0f items/s" % durable_rate)
+    print("Slowdown      %10.2fx" % (memory_rate / durable_rate))
@@ -0,0 +1,213 @@
+""" Soak test: runs the pipeline (readers, worker, output file, offer index and a consumer standing in for the bot)
+against a local stub of OLX for a long time and checks that memory, threads and open files don't keep growing.
+The stub serves listings with new offers on every refresh and offer pages made of the fixtures. It acts as an HTTP
+proxy, so the pipeline requests the site's usual URLs (over http) and the scrapers are picked as in production.
+RSS, the number of threads, open file descriptors and the top allocators (tracemalloc) are sampled periodically.
+Growth is measured from the end of the warm-up; the test fails if any of it exceeds its budget.
+Usage: python benchmarks/soak.py [--duration seconds] [--readers readers] [--new-offers offers] ... (see --help) """
+from argparse import ArgumentParser
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, listdir
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread, active_count, current_thread
+from time import monotonic, sleep
+from urllib.parse import urlparse
+import json
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from classes import StoppableThread  # noqa: E402
+from methods import process_offers, read_pages  # noqa: E402
+from offers_index import OfferIndex  # noqa: E402
+from politeness import POLITENESS  # noqa: E402
+from queue import Empty, Queue  # noqa: E402
+
+FIXTURES_DIR = join(dirname(abspath(__file__)), "fixtures")
+LISTING_ROW = '<tr class="wrap"><td class="offer"><table summary="Ogłoszenie" class="fixed breakword ad_id%s">' \
+              '<tr><td><a href="#">Oferta</a></td></tr></table></td></tr>'
+
+
+class StubSite:
+    """ Stub of the site: listings get new offers on every request, offers are the fixture with a random price. """
+    def __init__(self, new_offers, offers_per_page=40, error_rate=0.0):
+        """
+        :param new_offers: number of new offers on a listing per request
+        :param offers_per_page: number of offers on a listing
+        :param error_rate: fraction of requests answered with HTTP 503
+        """
+        self.new_offers = new_offers
+        self.offers_per_page = offers_per_page
+        self.error_rate = error_rate
+        self.lock = Lock()
+        self.listings = {}  # listing's path -> ids of its offers (newest first)
+        self.next_id = 0
+        self.requests = 0
+
+        with open(join(FIXTURES_DIR, "olx_offer.html"), "r", encoding="utf-8") as ff:
+            self.offer_html = ff.read()
+        with open(join(FIXTURES_DIR, "olx_listing.html"), "r", encoding="utf-8") as ff:
+            listing_html = ff.read()
+        rows_start = listing_html.index('<tr class="wrap">')
+        self.listing_head = listing_html[:rows_start]
+        self.listing_tail = listing_html[listing_html.rindex("</tr>") + len("</tr>"):]
+
+    def listing(self, path):
+        with self.lock:
+            ids = self.listings.setdefault(path, deque(maxlen=self.offers_per_page))
+            for _ in range(self.new_offers):
+                ids.appendleft("%08x" % self.next_id)
+                self.next_id += 1
+            rows = "\n".join([LISTING_ROW % offer_id for offer_id in ids])
+        return self.listing_head + rows + self.listing_tail
+
+    def offer(self):
+        return self.offer_html.replace("2 750 zł", "%d zł" % random.randint(1000, 6000))
+
+    def handler(self):
+        site = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with site.lock:
+                    site.requests += 1
+                if random.random() < site.error_rate:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+
+                path = urlparse(self.path).path
+                body = (site.offer() if path.startswith("/oferta/") else site.listing(path)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return StubHandler
+
+
+def consume(thread_statuses, q_offers, counter):
+    """ Takes offers from the queue the way the bot does (stands in for it). """
+    thread_statuses[current_thread().name] = "Booting"
+    while not current_thread().is_stopped():
+        thread_statuses[current_thread().name] = "Waiting"
+        try:
+            q_offers.get(timeout=1)
+        except Empty:
+            continue
+        counter["offers"] += 1
+        q_offers.task_done()
+    thread_statuses[current_thread().name] = "Stopped"
+
+
+def rss_mb():
+    """ Resident set size of this process in MB (Linux). """
+    with open("/proc/self/status", "r") as sf:
+        for line in sf:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def sample(start, counter, index):
+    return {"time": round(monotonic() - start), "rss_mb": round(rss_mb(), 1), "threads": active_count(),
+            "fds": len(listdir("/proc/self/fd")), "traced_mb": round(tracemalloc.get_traced_memory()[0] / 2**20, 1),
+            "offers": counter["offers"], "indexed": len(index)}
+
+
+def average(samples, key):
+    return sum([s.get(key) for s in samples]) / len(samples)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="runs the pipeline against a local stub site and checks resources' growth")
+    parser.add_argument("--duration", type=int, default=3600, help="length of the test in seconds")
+    parser.add_argument("--warmup", type=int, default=120, help="seconds after which growth is measured")
+    parser.add_argument("--sample-interval", type=int, default=30, help="seconds between samples")
+    parser.add_argument("--readers", type=int, default=4, help="number of tracked listings")
+    parser.add_argument("--interval", type=int, default=5, help="seconds between listings' refreshes")
+    parser.add_argument("--new-offers", type=int, default=2, help="new offers on a listing per refresh")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="fraction of requests failing with HTTP 503")
+    parser.add_argument("--rss-budget", type=float, default=64, help="allowed RSS growth in MB")
+    parser.add_argument("--thread-budget", type=int, default=2, help="allowed growth of the number of threads")
+    parser.add_argument("--fd-budget", type=int, default=8, help="allowed growth of open file descriptors")
+    parser.add_argument("--top", type=int, default=10, help="number of reported top allocators")
+    parser.add_argument("--samples", default=None, help="file the samples are written to (JSON lines)")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    site = StubSite(args.new_offers, error_rate=args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), site.handler())
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    # All requests of the pipeline go to the stub
+    environ["http_proxy"] = "http://127.0.0.1:%d" % server.server_address[1]
+    environ.pop("no_proxy", None)
+    POLITENESS.configure(rate=100, max_in_flight=8, open_time=2)
+
+    with TemporaryDirectory() as tmp_dir:
+        thread_statuses, counter = {}, {"offers": 0}
+        read_queue, offers_queue = Queue(), Queue()
+        output = join(tmp_dir, "offers_p00.csv")
+        index = OfferIndex(output)
+
+        threads = [StoppableThread(target=read_pages, name="Reader %d" % i, args=(
+            thread_statuses, "http://www.olx.pl/nieruchomosci/mieszkania/wynajem/region%d/" % i, read_queue,
+            args.interval)) for i in range(args.readers)]
+        threads.append(StoppableThread(target=process_offers, name="Worker", args=(
+            thread_statuses, read_queue, offers_queue, output, None, None, index)))
+        threads.append(StoppableThread(target=consume, name="Bot", args=(thread_statuses, offers_queue, counter)))
+        for thr in threads:
+            thr.start()
+
+        # Sampling the resources
+        start, samples, baseline = monotonic(), [], None
+        samples_file = open(args.samples, "w", encoding="utf-8") if args.samples is not None else None
+        try:
+            while monotonic() - start < args.duration:
+                sleep(args.sample_interval)
+                samples.append(sample(start, counter, index))
+                if baseline is None and samples[-1].get("time") >= args.warmup:
+                    baseline = (len(samples) - 1, tracemalloc.take_snapshot())
+                print(" ".join(["%s=%s" % (k, v) for (k, v) in samples[-1].items()]), flush=True)
+                if samples_file is not None:
+                    samples_file.write(json.dumps(samples[-1]) + "\n")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for thr in threads:
+                thr.stop()
+            for thr in threads:
+                thr.join()
+            server.shutdown()
+            if samples_file is not None:
+                samples_file.close()
+
+    if baseline is None or len(samples) - baseline[0] < 2:
+        sys.exit("The test was too short to measure growth (duration must exceed the warm-up by a few samples).")
+
+    # Growth between the first samples after the warm-up and the last ones (averages smooth the noise)
+    window = max(1, min(3, (len(samples) - baseline[0]) // 2))
+    first, last = samples[baseline[0]:baseline[0] + window], samples[-window:]
+    growth = dict([(key, average(last, key) - average(first, key)) for key in ["rss_mb", "threads", "fds"]])
+    budgets = {"rss_mb": args.rss_budget, "threads": args.thread_budget, "fds": args.fd_budget}
+
+    print("\nRequests served: %d, offers passed on: %d, offers indexed: %d" % (
+        site.requests, counter["offers"], len(index)))
+    print("Top allocators' growth since the warm-up:")
+    for stat in tracemalloc.take_snapshot().compare_to(baseline[1], "lineno")[:args.top]:
+        print("    %s" % stat)
+
+    exceeded = [key for key in growth.keys() if growth[key] > budgets[key]]
+    for key in growth.keys():
+        print("%-8s growth %8.1f, budget %8.1f %s" % (key, growth[key], budgets[key],
+                                                   "EXCEEDED" if key in exceeded else "ok"))
+    sys.exit(1 if len(exceeded) > 0 else 0)
@@ -0,0 +1,188 @@
+""" Checks the bot's webhook mode against a local stand-in for the Telegram Bot API. The bot is pointed at the stand-in
+(base_url) and started with a webhook section, then updates with commands are posted to its WebhookServer from several
+threads at once (some of them twice, as Telegram redelivers updates which weren't acknowledged in time) while another
+thread keeps matching offers against the chats' configs, as the bot's thread does. The check fails unless the webhook
+was registered and removed, every update was answered exactly once, no change of the configs was lost and matching
+offers never failed.
+Usage: python benchmarks/webhook_check.py [--chats chats] [--updates updates] [--workers workers] """
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread
+from time import monotonic, sleep, time
+from urllib.request import Request, urlopen
+import json
+import random
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from bot import TelegramBot  # noqa: E402
+from classes import Offer  # noqa: E402
+from gazetteer import DISTRICTS  # noqa: E402
+from utils import OFFER_COLUMNS  # noqa: E402
+
+TOKEN = "123456:stand-in"
+ADMIN_ID = 7
+
+
+class StandInBotApi:
+    """ HTTP server standing in for the Bot API. It answers the methods the bot calls and records them. """
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = []  # (method, parameters)
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                try:
+                    parameters = json.loads(body) if body != "" else {}
+                except ValueError:
+                    parameters = {}
+                with api.lock:
+                    api.calls.append((method, parameters))
+                    message_id = len(api.calls)
+
+                if method == "getMe":
+                    result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "stand_in_bot"}
+                elif method == "sendMessage":
+                    result = {"message_id": message_id, "date": int(time()), "text": parameters.get("text"),
+                              "chat": {"id": int(parameters.get("chat_id")), "type": "group", "title": "Chat"}}
+                elif method == "getMyCommands":
+                    result = []
+                else:
+                    result = True
+                answer = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            do_GET = do_POST
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def called(self, method):
+        with self.lock:
+            return [parameters for (name, parameters) in self.calls if name == method]
+
+
+def command_update(update_id, chat_id, text):
+    """ Returns an update with a message holding the command (as Telegram posts it to the webhook). """
+    command = text.split(" ")[0]
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": int(time()) + 1, "text": text,
+                        "chat": {"id": chat_id, "type": "group", "title": "Chat"},
+                        "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+                        "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}}
+
+
+def post(url, update):
+    request = Request(url, data=json.dumps(update).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urlopen(request, timeout=10) as response:
+        return response.status
+
+
+def match_offers(bot, stop, errors, counter):
+    """ Keeps matching offers against the chats' configs (stands in for the bot's thread). """
+    while not stop.is_set():
+        scrape_dict = dict([(column, None) for column in OFFER_COLUMNS])
+        scrape_dict.update(url="http://www.olx.pl/oferta/%d" % counter[0], is_room=False, size=40,
+                           price=random.randint(500, 4000), loc=random.choice(DISTRICTS), description="balkon")
+        try:
+            bot.matching_chats(Offer(scrape_dict.get("url"), scrape_dict_arg=scrape_dict))
+        except Exception as err:
+            errors.append(repr(err))
+        counter[0] += 1
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="checks the bot's webhook mode with a local stand-in for the Bot API")
+    parser.add_argument("--chats", type=int, default=5, help="number of chats")
+    parser.add_argument("--updates", type=int, default=20, help="number of location changes sent by each chat")
+    parser.add_argument("--workers", type=int, default=4, help="number of the webhook's threads")
+    args = parser.parse_args()
+    random.seed(0)
+
+    api = StandInBotApi()
+    with TemporaryDirectory() as temp_dir:
+        chat_ids = [-1000 - i for i in range(args.chats)]
+        settings_file, configs_dir = join(temp_dir, "settings.json"), temp_dir
+        with open(settings_file, "w", encoding="utf-8") as sf:
+            json.dump({"token": TOKEN, "bot_admins": [ADMIN_ID], "chat_ids": chat_ids, "base_url": api.url + "/bot",
+                       "webhook": {"url": "https://example.com/secret-path", "listen": "127.0.0.1", "port": 0,
+                                   "workers": args.workers}}, sf)
+        for chat_id in chat_ids:
+            with open(join(configs_dir, "%s.json" % chat_id), "w", encoding="utf-8") as cf:
+                json.dump({"online": True, "chat_admins": [ADMIN_ID], "fav": [], "loc": []}, cf)
+
+        bot = TelegramBot(settings_file, configs_dir)
+        bot.start()
+        webhook_url = "http://127.0.0.1:%d/secret-path" % bot.webhook.port
+
+        # Every chat adds a location per update (in parallel with the other chats and its own other updates)
+        updates, expected = [], {}
+        for chat_id in chat_ids:
+            locations = random.sample(DISTRICTS, min(args.updates, len(DISTRICTS)))
+            expected[chat_id] = set(locations)
+            updates += [command_update(0, chat_id, "/config loc add %s" % loc) for loc in locations]
+            updates += [command_update(0, chat_id, "/config price 1000 %d" % (2000 + -chat_id))]
+        random.shuffle(updates)
+        for (update_id, update) in enumerate(updates):
+            update["update_id"] = update["message"]["message_id"] = update_id + 1
+        redelivered = random.sample(updates, len(updates) // 5)
+
+        stop, errors, matched = Event(), [], [0]
+        matcher = Thread(target=match_offers, args=(bot, stop, errors, matched))
+        matcher.start()
+        start = monotonic()
+        with ThreadPoolExecutor(8) as pool:
+            statuses = list(pool.map(lambda update: post(webhook_url, update), updates + redelivered))
+
+        # Wait for the answers (the job queue sends them)
+        while len(api.called("sendMessage")) < len(updates) and monotonic() - start < 30:
+            sleep(0.1)
+        sleep(1)
+        stop.set()
+        matcher.join()
+        bot.stop()
+
+        answers = api.called("sendMessage")
+        with open(join(configs_dir, "%s.json" % chat_ids[0]), "r", encoding="utf-8") as cf:
+            saved_config = json.load(cf)
+
+        print("Updates: %d (redelivered %d), answers: %d, time: %.1f s" % (
+            len(updates), len(redelivered), len(answers), monotonic() - start))
+        print("Webhook: %s" % ", ".join(["%s %s" % item for item in bot.webhook.stats().items()]))
+        print("Offers matched meanwhile: %d, errors: %d" % (matched[0], len(errors)))
+
+        problems = []
+        if any([status != 200 for status in statuses]):
+            problems.append("the webhook didn't acknowledge every update")
+        if [p.get("url") for p in api.called("setWebhook")] != ["https://example.com/secret-path"] or \
+                len(api.called("deleteWebhook")) != 1:
+            problems.append("the webhook wasn't registered and removed")
+        if len(answers) != len(updates) or bot.webhook.stats().get("duplicates") != len(redelivered):
+            problems.append("updates weren't answered exactly once (%d answers)" % len(answers))
+        lost = dict([(chat_id, expected[chat_id] - set(bot.get_config(chat_id, "loc"))) for chat_id in chat_ids])
+        if any([len(locations) > 0 for locations in lost.values()]):
+            problems.append("changes of the configs were lost: %s" % lost)
+        if set(saved_config.get("loc")) != expected[chat_ids[0]] or \
+                saved_config.get("price") != {"min": 1000, "max": 2000 - chat_ids[0]}:
+            problems.append("the saved config differs from the sent changes: %s" % saved_config)
+        if len(errors) > 0:
+            problems.append("matching offers failed: %s" % errors[0])
+        for problem in problems:
+            print("FAILED: %s" % problem)
+        sys.exit(1 if len(problems) > 0 else 0)
@@ -1,8 +1,20 @@
+from collections import OrderedDict
+from copy import deepcopy
 from datetime import datetime as dt
+from gazetteer import DISTRICTS, canonical_location, normalize_location
+from geo import CENTROIDS, MAX_RADIUS, SubscriptionGrid, distance
+from itertools import islice
+from keywords import KEYWORD_KINDS, KeywordMatcher, normalize_keyword
+from telegram import Update
 from telegram.ext import CommandHandler, Updater
 from telegram.error import InvalidToken
 from os.path import isdir, isfile, join
+from threading import RLock
+from time import monotonic
+from urllib.parse import urlparse
+from webhook import WebhookServer
 import json
+import re
 
 
 DEFAULT_CONFIG = {
@@ -13,12 +25,22 @@ DEFAULT_CONFIG = {
     "price": {"min": float("-inf"), "max": float("inf")},
     "size": {"min": float("-inf"), "max": float("inf")},
     "rooms": {"min": float("-inf"), "max": float("inf")},
-    "mode": None  # is_room equivalent
+    "mode": None,  # is_room equivalent
+    "keywords": {"include": [], "exclude": []},  # words offer's description must (or mustn't) mention
+    "near": None  # circle ({"lat", "lon", "km"}) offers must be located in (instead of the list of locations)
 }
+STATS_DAYS = 30        # number of days included in /stats
+SEARCH_DAYS = 14       # number of days searched by /search
+SEARCH_PAGE_SIZE = 5   # number of offers sent by one /search
+SEND_INTERVAL = 1.1    # seconds between consecutive messages sent to the same chat (Telegram's rate limits)
+ALERTS_TTL = 3600      # seconds an alert waits for the offer's details (so it can be edited)
+THUMBNAIL_DELAY = 5    # seconds between checks whether offer's image was downloaded (so its thumbnail can be sent)
+THUMBNAIL_CHECKS = 6   # number of the checks (the image might never come, e.g. the images' backlog was full)
 
 
 class TelegramBot:
-    def __init__(self, bot_settings_file, users_configs_dir):
+    def __init__(self, bot_settings_file, users_configs_dir, analytics=None, offer_index=None, latency=None,
+                 image_store=None):
         # Assert that token file exists
         if not isfile(bot_settings_file):
             raise Exception("settings file does not exist")
@@ -31,21 +53,42 @@ class TelegramBot:
         self.settings_file = bot_settings_file
         self.configs_dir = users_configs_dir
 
+        # Offers' statistics and index of saved offers (optional, used by /stats and /search)
+        self.analytics = analytics
+        self.offer_index = offer_index
+        self.search_offsets = {}  # chat id -> number of already sent search results
+
+        # Latencies of offers from being seen to being sent (optional)
+        self.latency = latency
+
+        # Offers' images downloaded in the background (optional, their thumbnails are sent after the offers)
+        self.image_store = image_store
+
+        # Alerts waiting for offers' details: offer URL -> (time, {chat id -> message id (None until it's sent)})
+        self.alerts = OrderedDict()
+
         # Load bot settings
         with open(bot_settings_file, "r", encoding="utf-8") as sf:
             self.bot_settings = json.load(sf)
             if set(self.bot_settings.keys()) != {"token", "bot_admins", "chat_ids"}:
                 Exception("incorrect bot config file")
 
-        # Defining the bot's updater
+        # Defining the bot's updater (base_url setting allows to use other Bot API server, e.g. a local one)
         try:
             self.updater = Updater(token=self.bot_settings.get("token"),
+                                   base_url=self.bot_settings.get("base_url"),
                                    request_kwargs={'read_timeout': 60, 'connect_timeout': 60})
         except InvalidToken:
             raise Exception("invalid token")
+        self.webhook = None
 
-        # Loading chat configs
+        # Loading chat configs (all chats' keywords are matched by a single automaton and their circles are kept
+        # in a spatial index). Handlers (e.g. webhook's threads) change the configs and chats while the bot's thread
+        # matches offers against them, so both hold the lock.
         self.configs = {}
+        self.configs_lock = RLock()
+        self.keywords = KeywordMatcher()
+        self.near = SubscriptionGrid()
         for chat_id in self.get_chat_ids():
             self.load_config(chat_id)
 
@@ -64,23 +107,31 @@ class TelegramBot:
 
     def load_config(self, chat_id):
         """ Method loads the chat config. """
-        config_path = join(self.configs_dir, "%s.json" % chat_id)
-
-        # If config file does not exist then create one
-        if not isfile(config_path):
-            self.save_config(chat_id, default=True)
-
-        # Load the config file
-        with open(config_path, "r", encoding="utf-8") as cfg_file:
-            self.configs[chat_id] = json.load(cfg_file)
-
-        # Add new keys if present
-        new_keys = set(DEFAULT_CONFIG.keys()) - set(self.get_config(chat_id).keys())
-        if new_keys != set():
-            for new_key in new_keys:
-                self.configs[chat_id][new_key] = DEFAULT_CONFIG.get(new_key)
-            self.save_config(chat_id)
-
+        with self.configs_lock:
+            config_path = join(self.configs_dir, "%s.json" % chat_id)
+
+            # If config file does not exist then create one
+            if not isfile(config_path):
+                self.save_config(chat_id, default=True)
+
+            # Load the config file
+            with open(config_path, "r", encoding="utf-8") as cfg_file:
+                self.configs[chat_id] = json.load(cfg_file)
+
+            # Add new keys if present and migrate locations saved before they were normalized to the canonical names
+            new_keys = set(DEFAULT_CONFIG.keys()) - set(self.get_config(chat_id).keys())
+            locations = self.get_config(chat_id, "loc")
+            canonical_locations = None if locations is None else \
+                list(dict.fromkeys([canonical_location(loc) for loc in locations]))
+            if new_keys != set() or canonical_locations != locations:
+                for new_key in new_keys:
+                    self.configs[chat_id][new_key] = deepcopy(DEFAULT_CONFIG.get(new_key))  # chats don't share it
+                if canonical_locations != locations:
+                    self.configs[chat_id]["loc"] = canonical_locations
+                self.save_config(chat_id)
+
+            self.keywords.update(chat_id, **self.get_config(chat_id, "keywords"))
+            self.near.update(chat_id, self.get_config(chat_id, "near"))
         return self
 
     def save_config(self, chat_id, default=False):
@@ -95,39 +146,164 @@ class TelegramBot:
 
     def update_config(self, chat_id, key, value, add=None):
         """ Function modifies config's values corresponding to provided key. """
-        # Adding/removing a value from parameter which contains list
-        if key in ["loc", "chat_admins", "fav"] and add is not None:
-            if add:
-                if isinstance(value, list):  # Adding multiple values
-                    for val in value:
-                        self.configs[chat_id][key].append(val)
-                else:
-                    self.configs[chat_id][key].append(value)
-                self.configs[chat_id][key] = list(dict.fromkeys(self.get_config(chat_id, key)))  # Removing duplicates
-            else:
-                if isinstance(value, list):  # Removing multiple values
-                    for val in value:
-                        self.configs[chat_id][key].remove(val)
+        with self.configs_lock:
+            # Adding/removing a value from parameter which contains list
+            if key in ["loc", "chat_admins", "fav"] and add is not None:
+                if add:
+                    if isinstance(value, list):  # Adding multiple values
+                        for val in value:
+                            self.configs[chat_id][key].append(val)
+                    else:
+                        self.configs[chat_id][key].append(value)
+                    # Removing duplicates
+                    self.configs[chat_id][key] = list(dict.fromkeys(self.get_config(chat_id, key)))
                 else:
-                    self.configs[chat_id][key].remove(value)
-
-        # Setting the numerical parameters min and max
-        elif key in ["price", "size", "rooms"]:
-            self.configs[chat_id][key]["min"] = value[0]
-            self.configs[chat_id][key]["max"] = value[1]
-
-        # Setting the flag parameters values
-        elif key in ["mode", "online"]:
-            self.configs[chat_id][key] = value
-
-        # Saving the updated config
-        self.save_config(chat_id)
+                    if isinstance(value, list):  # Removing multiple values
+                        for val in value:
+                            self.configs[chat_id][key].remove(val)
+                    else:
+                        self.configs[chat_id][key].remove(value)
+
+            # Setting the numerical parameters min and max
+            elif key in ["price", "size", "rooms"]:
+                self.configs[chat_id][key]["min"] = value[0]
+                self.configs[chat_id][key]["max"] = value[1]
+
+            # Adding/removing keywords (value is a pair of the keywords' kind and the list of keywords)
+            elif key == "keywords":
+                kind, keywords = value
+                current = self.configs[chat_id][key][kind]
+                current = list(dict.fromkeys(current + keywords)) if add else [k for k in current if k not in keywords]
+                # Default's dict isn't changed
+                self.configs[chat_id][key] = {**self.configs[chat_id][key], kind: current}
+                self.keywords.update(chat_id, **self.get_config(chat_id, key))
+
+            # Setting the circle (value is a list of latitude, longitude and radius in km, or None)
+            elif key == "near":
+                self.configs[chat_id][key] = None if value is None else dict(zip(["lat", "lon", "km"], value))
+                self.near.update(chat_id, self.get_config(chat_id, key))
+
+            # Setting the flag parameters values
+            elif key in ["mode", "online"]:
+                self.configs[chat_id][key] = value
+
+            # Saving the updated config
+            self.save_config(chat_id)
 
         return self
 
     # ------------------------------ Offer processing methods ------------------------------
     def process_offer(self, offer):
-        """ Method sends offer to chat which might be interested in it (based on chat's config). """
+        """ Method sends offer to chat which might be interested in it (based on chat's config).
+        Offer's lineage is finished by the first sent message (or right away if the offer isn't sent anywhere). """
+        chat_ids = self.matching_chats(offer)
+        lineage = getattr(offer, "lineage", None) if self.latency is not None else None
+        if lineage is not None:
+            lineage.mark("matched")
+
+        # Chats which got an alert about the offer have it edited, the others get a new message
+        alerted = self.alerts.pop(offer.url, (None, {}))[1]
+        sent = [self.edit_alert(offer, chat_id, alerted, lineage=lineage) if chat_id in alerted.keys() else
+                self.send_offer(offer, chat_id, lineage=lineage) for chat_id in chat_ids]
+        if lineage is not None and not any(sent):
+            self.latency.record(lineage)
+
+        # Alerts sent to chats which the offer doesn't match after all (e.g. its size) are corrected
+        for chat_id in [chat_id for chat_id in alerted.keys() if chat_id not in chat_ids]:
+            self.edit_alert(offer, chat_id, alerted, matches=False)
+
+    def is_saved(self, url):
+        """ Returns whether the offer was already saved (False if there is no offer index). """
+        if self.offer_index is None:
+            return False
+        if self.offer_index.get(url) is not None:
+            return True
+        self.offer_index.refresh()  # only rows added since the last refresh are read
+        return self.offer_index.get(url) is not None
+
+    def process_alert(self, alert):
+        """ Method sends a short alert about an offer seen on a listing to chats whose configs its summary matches.
+        The alerts are edited in place once the offer's details are read (see process_offer). """
+        # Offers which were already read (e.g. bumped to the top of the listing) aren't alerted again. Workers of other
+        # processes save offers only to the output files, so the index reads them before an offer is taken for new
+        if alert.url in self.alerts.keys() or self.is_saved(alert.url):
+            return
+
+        # Forget alerts whose offers' details never came (e.g. offer's page couldn't be read)
+        while len(self.alerts) > 0 and next(iter(self.alerts.values()))[0] < monotonic() - ALERTS_TTL:
+            self.alerts.popitem(last=False)
+
+        with self.configs_lock:
+            chat_ids = [chat_id for chat_id in self.get_chat_ids() if self.check_chat_status(chat_id) and
+                        self.check_summary(alert.summary, self.get_config(chat_id))]
+        if len(chat_ids) == 0:
+            return
+        messages = dict([(chat_id, None) for chat_id in chat_ids])
+        self.alerts[alert.url] = (monotonic(), messages)
+
+        def __send_alert(bot, job):
+            """ Callback function passed to job queue. """
+            message = bot.send_message(text=job.context.get("text"), chat_id=job.context.get("chat_id"),
+                                       parse_mode="Markdown")
+            messages[job.context.get("chat_id")] = message.message_id
+            if self.latency is not None and job.context.get("first"):
+                self.latency.record_alert(alert.seen)
+
+        # Title might contain characters which would break the Markdown
+        title = re.sub(r"[*_`\[]", "", alert.summary.get("title") or "")
+        msg_body = "*New offer*\n`Price     %s`\n`Location  %s`\n\n%s%s" % (
+            alert.price, alert.loc, title + "\n" if title != "" else "", alert.url)
+        for (i, chat_id) in enumerate(chat_ids):
+            self.updater.job_queue.run_once(callback=__send_alert, when=0,
+                                            context={
+                                                "text": msg_body,
+                                                "chat_id": chat_id,
+                                                "first": i == 0})
+
+    def process_change(self, change):
+        """ Method sends information about offer's change to chats which might be interested in the offer. """
+        for chat_id in self.matching_chats(change.offer):
+            self.send_change(change, chat_id)
+
+    def matching_chats(self, offer):
+        """ Method returns ids of chats which might be interested in the offer (based on chat's config).
+        Offer's description is scanned for all chats' keywords at once and its coordinates are checked only against
+        circles of the chats nearby. """
+        found = self.keywords.scan(getattr(offer, "description", None))
+        near = self.near.matching(getattr(offer, "lat", None), getattr(offer, "lon", None))
+        with self.configs_lock:
+            return [chat_id for chat_id in self.get_chat_ids()
+                    if self.check_offer(offer, self.get_config(chat_id)) and self.keywords.accepts(chat_id, found) and
+                    (self.get_config(chat_id, "near") is None or chat_id in near)]
+
+    @staticmethod
+    def check_summary(summary, user_config):
+        """ Method checks whether offer's summary (from the listing) is eligible for chat with given config.
+        Unlike check_offer, a missing value fails the check. Fields which listings don't show (size and rooms)
+        are checked once offer's details are read. Chats subscribed to a circle get alerts about offers whose
+        location's centroid is in the circle. """
+        price, limits = summary.get("price"), user_config.get("price")
+        if limits is not None and (price is None or not limits.get("min") <= price <= limits.get("max")):
+            return False
+
+        near = user_config.get("near")
+        if near is not None:
+            centroid = CENTROIDS.get(summary.get("loc"))
+            if centroid is None or distance(near.get("lat"), near.get("lon"), *centroid) > near.get("km"):
+                return False
+        elif user_config.get("loc") is not None and summary.get("loc") not in user_config.get("loc"):
+            return False
+
+        if user_config.get("mode") is not None and summary.get("is_room") != user_config.get("mode"):
+            return False
+
+        return True
+
+    @staticmethod
+    def check_offer(offer, user_config):
+        """ Method checks whether offer is eligible for chat with given config.
+        Chat's circle (near) replaces the list of locations, it's checked with the spatial index (see matching_chats).
+        """
 
         def __check_numeric_variable(off, u_cfg, var_name, allow_none=False):
             """ Function checks whether numeric variable of given offer falls into users config's limits.
@@ -147,68 +323,181 @@ class TelegramBot:
                 if getattr(off, var_name) is None or getattr(off, var_name) not in u_cfg.get(var_name):
                     return True
 
-        # For each chat check if offer is eligible
-        for chat_id in self.get_chat_ids():
-            user_config = self.get_config(chat_id)
-
-            # Check price
-            if __check_numeric_variable(offer, user_config, "price"):
-                continue
-
-            # Check measurement
-            if __check_numeric_variable(offer, user_config, "size"):
-                continue
-
-            # Check localisation
-            if __check_categorical_variable(offer, user_config, "loc"):
-                continue
-
-            # Check if it's room
-            if user_config.get("mode") is not None:
-                if offer.is_room != user_config.get("mode"):
-                    continue
-
-            # Check number of rooms
-            if not offer.is_room:
-                if __check_numeric_variable(offer, user_config, "rooms", allow_none=True):
-                    continue
+        # Check price
+        if __check_numeric_variable(offer, user_config, "price"):
+            return False
 
-            # If all check were passed then send the offer
-            self.send_offer(offer, chat_id)
+        # Check measurement
+        if __check_numeric_variable(offer, user_config, "size"):
+            return False
 
-    def send_offer(self, offer, chat_id):
-        """ Method sets given offer to chat with provided id if the chat has messages turned on. """
-        def __format_offer(o):
-            """ Function which returns formatted message body of an offer. """
-            format_dict = {
-                "Price": "%s" % o.price,
-                "Location": "%s" % o.loc,
-                "Size": "%s" % o.size}
+        # Check localisation
+        if user_config.get("near") is None and __check_categorical_variable(offer, user_config, "loc"):
+            return False
 
-            # Add info about rooms (only if it's a flat)
-            if not o.is_room:
-                format_dict["Rooms"] = "%s" % (o.rooms if o.rooms is not None else "b/d")
+        # Check if it's room
+        if user_config.get("mode") is not None:
+            if offer.is_room != user_config.get("mode"):
+                return False
 
-            # Values alignment
-            just_len = len(max(format_dict.keys(), key=len))
+        # Check number of rooms
+        if not offer.is_room:
+            if __check_numeric_variable(offer, user_config, "rooms", allow_none=True):
+                return False
 
-            # Constructing message body
-            msg_body = "\n".join(["`%s  %s`" % (k.ljust(just_len), v) for k, v in format_dict.items()])  # Attributes
-            msg_body += "\n\n%s" % o.url
-
-            return msg_body
+        # All check were passed
+        return True
 
+    def send_offer(self, offer, chat_id, when=0, force=False, lineage=None):
+        """ Method sets given offer to chat with provided id if the chat has messages turned on (or it is forced).
+        Sending can be delayed by given number of seconds. Returns whether the message was scheduled.
+        If offer's lineage is given, it is recorded once the message is sent. """
         def __send_offer(bot, job):
+            """ Callback function passed to job queue. """
+            message = bot.send_message(text=job.context.get("text"), chat_id=job.context.get("chat_id"),
+                                       parse_mode="Markdown")
+            if job.context.get("lineage") is not None:
+                self.latency.record(job.context.get("lineage").mark("sent"))
+            self.send_thumbnail(offer, job.context.get("chat_id"), message.message_id)
+
+        # Send only if chat is online
+        if self.check_chat_status(chat_id) or force:
+            self.updater.job_queue.run_once(callback=__send_offer, when=when,
+                                            context={
+                                                "text": self.format_offer(offer),
+                                                "chat_id": chat_id,
+                                                "lineage": lineage})
+            return True
+        return False
+
+    def edit_alert(self, offer, chat_id, messages, matches=True, lineage=None):
+        """ Method replaces the alert sent to chat with provided id with the offer's details
+        (or sends them as a new message if the alert wasn't sent). Returns whether the message was scheduled.
+        :param messages: dictionary chat id -> id of the alert's message
+        :param matches: whether the offer still matches chat's config (otherwise it's noted in the message)
+        """
+        def __edit_alert(bot, job):
+            """ Callback function passed to job queue (alerts are sent before, since jobs are run in order). """
+            if messages.get(chat_id) is None:
+                message = bot.send_message(text=job.context.get("text"), chat_id=chat_id, parse_mode="Markdown")
+            else:
+                message = bot.edit_message_text(text=job.context.get("text"), chat_id=chat_id,
+                                                message_id=messages.get(chat_id), parse_mode="Markdown")
+            if job.context.get("lineage") is not None:
+                self.latency.record(job.context.get("lineage").mark("sent"))
+            if matches:
+                self.send_thumbnail(offer, chat_id, message.message_id)
+
+        msg_body = self.format_offer(offer)
+        if not matches:
+            msg_body += "\n\n_The details don't match your filters_"
+        self.updater.job_queue.run_once(callback=__edit_alert, when=0,
+                                        context={
+                                            "text": msg_body,
+                                            "lineage": lineage})
+        return True
+
+    def send_thumbnail(self, offer, chat_id, message_id, check=0):
+        """ Method sends thumbnail of offer's first image to chat with provided id as a reply to the offer's message.
+        Images are downloaded in the background, so the image is checked for a few times before it's given up on.
+        Nothing is sent without the image store or if the thumbnail can't be made (e.g. Pillow isn't installed). """
+        # Offers read back from the output (e.g. /search results) have their images' URLs as a string
+        images_urls = offer.images_urls_list
+        if self.image_store is None or not isinstance(images_urls, list) or len(images_urls) == 0:
+            return
+
+        def __send_thumbnail(bot, job):
+            """ Callback function passed to job queue. """
+            digest = self.image_store.digest(images_urls[0])
+            if digest is None:
+                if check + 1 < THUMBNAIL_CHECKS:
+                    self.send_thumbnail(offer, chat_id, message_id, check + 1)
+                return
+
+            try:
+                thumb_path = self.image_store.thumbnail(digest)
+            except (ImportError, OSError):  # Pillow is missing or the image is broken
+                return
+            with open(thumb_path, "rb") as photo:
+                bot.send_photo(chat_id=chat_id, photo=photo, reply_to_message_id=message_id, disable_notification=True)
+
+        self.updater.job_queue.run_once(callback=__send_thumbnail, when=0 if check == 0 else THUMBNAIL_DELAY)
+
+    @staticmethod
+    def format_offer(offer):
+        """ Method returns formatted message body of an offer. """
+        format_dict = {
+            "Price": "%s" % offer.price,
+            "Location": "%s" % offer.loc,
+            "Size": "%s" % offer.size}
+
+        # Add info about rooms (only if it's a flat)
+        if not offer.is_room:
+            format_dict["Rooms"] = "%s" % (offer.rooms if offer.rooms is not None else "b/d")
+
+        # Values alignment
+        just_len = len(max(format_dict.keys(), key=len))
+
+        # Constructing message body
+        msg_body = "\n".join(["`%s  %s`" % (k.ljust(just_len), v) for k, v in format_dict.items()])  # Attributes
+        msg_body += "\n\n%s" % offer.url
+
+        return msg_body
+
+    def send_change(self, change, chat_id):
+        """ Method sends description of offer's change to chat with provided id if the chat has messages turned on. """
+        def __send_change(bot, job):
             """ Callback function passed to job queue. """
             bot.send_message(text=job.context.get("text"), chat_id=job.context.get("chat_id"), parse_mode="Markdown")
 
         # Send only if chat is online
         if self.check_chat_status(chat_id):
-            self.updater.job_queue.run_once(callback=__send_offer, when=0,
+            msg_body = "*Offer changed*\n%s\n\n%s" % ("\n".join(change.describe()), change.offer.url)
+            self.updater.job_queue.run_once(callback=__send_change, when=0,
                                             context={
-                                                "text": __format_offer(offer),
+                                                "text": msg_body,
                                                 "chat_id": chat_id})
 
+    # ------------------------------ Search methods ------------------------------
+    def search(self, chat_id, offset=0, limit=SEARCH_PAGE_SIZE):
+        """ Method returns saved offers from the last SEARCH_DAYS days matching chat's config (newest first).
+        Offers are preselected with the index and only then checked against the whole config. The index is loaded
+        and kept up to date by the bot's runner, so searching never reads the output files. """
+        if self.offer_index is None:
+            return []
+        with self.configs_lock:
+            user_config = deepcopy(self.get_config(chat_id))
+
+        def __limits(var_name):
+            """ Function converts config's limits to index's limits (infinite limit means no limit). """
+            limits = user_config.get(var_name)
+            return (None if limits.get("min") == float("-inf") else limits.get("min"),
+                    None if limits.get("max") == float("inf") else limits.get("max"))
+
+        candidates = self.offer_index.query(
+            limits={"price": __limits("price"), "size": __limits("size"),
+                    "scrape_time": (dt.timestamp(dt.now()) - SEARCH_DAYS * 86400, None)},
+            loc=user_config.get("loc") if user_config.get("near") is None else None,
+            is_room=user_config.get("mode"))
+
+        return list(islice((o for o in candidates if self.check_offer(o, user_config) and
+                            self.keywords.accepts(chat_id, self.keywords.scan(getattr(o, "description", None))) and
+                            (user_config.get("near") is None or
+                             self.near.contains(chat_id, getattr(o, "lat", None), getattr(o, "lon", None)))),
+                           offset, offset + limit))
+
+    def send_search_results(self, chat_id, more=False):
+        """ Method sends the next page of search results to the chat. Messages are spread out in time so that
+        they don't exceed Telegram's rate limits. Returns number of sent offers. """
+        offset = self.search_offsets.get(chat_id, 0) if more else 0
+        offers = self.search(chat_id, offset)
+        self.search_offsets[chat_id] = offset + len(offers)
+
+        for (i, offer) in enumerate(offers):
+            self.send_offer(offer, chat_id, when=i * SEND_INTERVAL, force=True)
+
+        return len(offers)
+
     # ------------------------------ Bot methods ------------------------------
     def check_chat_id(self, chat_id):
         """ Checks if given chat is currently serviced. """
@@ -236,29 +525,57 @@ class TelegramBot:
         return user_id in self.get_config(chat_id, "chat_admins")
 
     def start(self):
-        """ Starts the updater and saves the timestamp. """
+        """ Starts receiving updates and saves the timestamp.
+        Updates are polled unless the settings contain a webhook section, e.g.:
+        "webhook": {"url": "https://example.com/secret-path", "listen": "0.0.0.0", "port": 8443, "workers": 1,
+                    "dedup_window": 1000} """
         self.start_timestamp = dt.timestamp(dt.now())
-        self.updater.start_polling()
+        webhook_settings = self.bot_settings.get("webhook")
+
+        if webhook_settings is None:
+            self.updater.start_polling()
+            return
+
+        # Updates are handled by the webhook server's threads, only the job queue has to be started
+        self.updater.job_queue.start()
+        self.webhook = WebhookServer(self.process_update,
+                                     listen=webhook_settings.get("listen", "0.0.0.0"),
+                                     port=webhook_settings.get("port", 8443),
+                                     url_path=urlparse(webhook_settings.get("url")).path,
+                                     workers=webhook_settings.get("workers", 1),
+                                     dedup_window=webhook_settings.get("dedup_window", 1000)).start()
+        self.updater.bot.set_webhook(url=webhook_settings.get("url"))
 
     def stop(self):
-        """ Stops the updater. """
-        self.updater.stop()
+        """ Stops receiving updates. """
+        if self.webhook is None:
+            self.updater.stop()
+            return
+
+        self.webhook.stop()
+        self.updater.bot.delete_webhook()
+        self.updater.job_queue.stop()
+
+    def process_update(self, update_json):
+        """ Passes update received by the webhook to the handlers. """
+        self.updater.dispatcher.process_update(Update.de_json(update_json, self.updater.bot))
 
     def update_settings(self, chat_id=None, add=True):
         """ Method saves the settings. Additionally, it adds/removes chat_id to/from bot settings prior to saving. """
-        if chat_id is not None:
-            # If chat id was provided and we are adding user, do so
-            if add:
-                self.bot_settings["chat_ids"].append(chat_id)
-                self.bot_settings["chat_ids"] = list(set(self.get_chat_ids()))
+        with self.configs_lock:
+            if chat_id is not None:
+                # If chat id was provided and we are adding user, do so
+                if add:
+                    self.bot_settings["chat_ids"].append(chat_id)
+                    self.bot_settings["chat_ids"] = list(set(self.get_chat_ids()))
 
-            # Remove chat from serviced chat if there are no chat admins left
-            elif len(self.get_config(chat_id, "chat_admins")) == 0:
-                self.bot_settings["chat_ids"].remove(chat_id)
+                # Remove chat from serviced chat if there are no chat admins left
+                elif len(self.get_config(chat_id, "chat_admins")) == 0:
+                    self.bot_settings["chat_ids"].remove(chat_id)
 
-        # Saving the settings
-        with open(self.settings_file, "w", encoding="utf-8") as sf:
-            json.dump(self.bot_settings, sf, indent=4)
+            # Saving the settings
+            with open(self.settings_file, "w", encoding="utf-8") as sf:
+                json.dump(self.bot_settings, sf, indent=4)
 
         return self
 
@@ -354,8 +671,16 @@ class TelegramBot:
                               "/config `[loc/mode/price/size]` -- displays current settings of chosen parameter\n"
                               "/config `loc [add/remove] location1, location2, ...` -- adds/removes location\n"
                               "/config `mode [flats/rooms/all]` -- changes mode\n"
+                              "/config `keywords [include/exclude] [add/remove] keyword1, keyword2, ...` "
+                              "-- adds/removes words the offer's description must (or mustn't) mention\n"
+                              "/config `near lat lon km` -- limits offers to the circle (instead of locations)\n"
+                              "/config `near off` -- goes back to the list of locations\n"
                               "/config `[price/size/rooms] min max` -- sets new limits",
                     # "favorite": "",
+                    "search": "/search -- displays recent offers matching this chat's settings\n"
+                              "/search `more` -- displays next matching offers",
+                    "stats": "/stats `location` -- displays statistics of offers from given location "
+                             "(last %d days)" % STATS_DAYS,
                     "status": "/status -- displays if bot is working in this chat",
                     "toggle": "/toggle -- turns bot on/off in this chat"
                 }
@@ -371,7 +696,10 @@ class TelegramBot:
                     if self.is_chat_admin(message.chat_id, user.id):
                         desc = {**desc, **desc_private}
                     else:
-                        desc["status"] = desc_private.get("status")  # Only status method work for non-admins
+                        # Only search, status and stats methods work for non-admins
+                        desc["search"] = desc_private.get("search")
+                        desc["stats"] = desc_private.get("stats")
+                        desc["status"] = desc_private.get("status")
 
                 # Adding admin methods
                 if self.is_bot_admin(user.id):
@@ -391,10 +719,7 @@ class TelegramBot:
 
                 # Sending help on Warsaw's districts
                 elif len(args) == 1 and args[0] == "dzielnice":
-                    districts = ['Bemowo', 'Białołęka', 'Bielany', 'Mokotów', 'Ochota', 'Praga Południe',
-                                 'Praga Północ', 'Rembertów', 'Śródmieście', 'Targówek', 'Ursus', 'Ursynów', 'Wawer',
-                                 'Wesoła', 'Wilanów', 'Wola', 'Włochy', 'Żoliborz']
-                    bot.send_message(text="Obsługiwane dzielnice:\n%s" % ", ".join(districts), chat_id=message.chat_id)
+                    bot.send_message(text="Obsługiwane dzielnice:\n%s" % ", ".join(DISTRICTS), chat_id=message.chat_id)
 
                 else:
                     bot.send_message(text="\n\n".join(desc.values()), chat_id=message.chat_id, parse_mode="Markdown")
@@ -410,7 +735,12 @@ class TelegramBot:
                     "price": "Price: min `%0.f`, max `%0.f`" % tuple(self.get_config(c_id, "price").values()),
                     "size": "Size: min `%0.f`, max `%0.f`" % tuple(self.get_config(c_id, "size").values()),
                     "rooms": "Rooms: min `%0.f`, max `%0.f`" % tuple(self.get_config(c_id, "rooms").values()),
-                    "loc": "Locations: %s" % ", ".join(["`'%s'`" % str(loc) for loc in self.get_config(c_id, "loc")])}
+                    "loc": "Locations: %s" % ", ".join(["`'%s'`" % str(loc) for loc in self.get_config(c_id, "loc")]),
+                    "keywords": "Keywords: %s" % "; ".join(["%s %s" % (kind, ", ".join(
+                        ["`'%s'`" % k for k in self.get_config(c_id, "keywords").get(kind)]) or "-")
+                        for kind in KEYWORD_KINDS]),
+                    "near": "Near: %s" % ("-" if self.get_config(c_id, "near") is None else
+                                          "`%(lat).5f %(lon).5f`, `%(km)g km`" % self.get_config(c_id, "near"))}
 
             if self.check_timestamp():
                 message = update.message
@@ -430,7 +760,7 @@ class TelegramBot:
                         bot.send_message(text=msg_body, chat_id=chat_id, parse_mode="Markdown")
 
                     # Display specific parameter config
-                    elif len(args) == 1 and args[0] in ["price", "size", "loc", "mode", "rooms"]:
+                    elif len(args) == 1 and args[0] in ["price", "size", "loc", "mode", "rooms", "keywords", "near"]:
                         msg_body = "*Settings*\n" + __formatted_config(chat_id).get(args[0])
                         bot.send_message(text=msg_body, chat_id=chat_id, parse_mode="Markdown")
 
@@ -444,13 +774,51 @@ class TelegramBot:
                         # confirmation = 2
                         confirmation = 0  # Not recognized for now
 
-                    # Modify provided locations
+                    # Modify provided locations (names are normalized with the gazetteer)
                     elif len(args) >= 3 and args[0] == "loc" and args[1] in ["add", "remove"]:
-                        # ToDo: verify correctness of provided location (check with existing locations base)
                         provided_locations = [loc.replace(",", "") for loc in (" ".join(args[2:])).split(", ")]
-                        self.update_config(chat_id, args[0], provided_locations, add=args[1] == "add")
+                        known_locations = [normalize_location(loc, in_warsaw=True) for loc in provided_locations]
+                        unknown_locations = [loc for (loc, known) in zip(provided_locations, known_locations)
+                                             if known is None]
+
+                        if args[1] == "add" and len(unknown_locations) > 0:
+                            bot.send_message(text="Unknown locations: %s. Get the correct spelling with "
+                                                  "`/help dzielnice`." % ", ".join(unknown_locations),
+                                             chat_id=chat_id, parse_mode="Markdown")
+                        else:
+                            # Canonical names are saved (unknown ones can still be removed, e.g. added before)
+                            locations = [known or loc for (loc, known) in zip(provided_locations, known_locations)]
+                            if args[1] == "remove":
+                                locations = [loc for loc in locations if loc in self.get_config(chat_id, "loc")]
+                            self.update_config(chat_id, args[0], locations, add=args[1] == "add")
+                            confirmation = 1
+
+                    # Modify provided keywords (they must have some letters or digits left after normalization)
+                    elif len(args) >= 4 and args[0] == "keywords" and args[1] in KEYWORD_KINDS and \
+                            args[2] in ["add", "remove"]:
+                        keywords = [k.strip() for k in (" ".join(args[3:])).split(",") if k.strip() != ""]
+                        if args[2] == "add" and any([normalize_keyword(k) is None for k in keywords]):
+                            confirmation = 0
+                        else:
+                            self.update_config(chat_id, args[0], (args[1], keywords), add=args[2] == "add")
+                            confirmation = 1
+
+                    # Set or remove the circle
+                    elif len(args) == 2 and args[0] == "near" and args[1] == "off":
+                        self.update_config(chat_id, args[0], None)
                         confirmation = 1
 
+                    elif len(args) == 4 and args[0] == "near":
+                        try:
+                            lat, lon, km = float(args[1].rstrip(",")), float(args[2].rstrip(",")), float(args[3])
+                            if -90 <= lat <= 90 and -180 <= lon <= 180 and 0 < km <= MAX_RADIUS:
+                                self.update_config(chat_id, args[0], [lat, lon, km])
+                                confirmation = 1
+                            else:
+                                confirmation = 0
+                        except ValueError:
+                            confirmation = 0
+
                     # Set search mode
                     elif len(args) == 2 and args[0] == "mode" and args[1] in mode_dict.keys():
                         self.update_config(chat_id, args[0], mode_dict.get(args[1]))
@@ -499,6 +867,63 @@ class TelegramBot:
             if self.check_timestamp():
                 pass
 
+        def __search(bot, update, args):
+            """ Sends recent saved offers which match chat's config. """
+            if self.check_timestamp():
+                chat_id = update.message.chat_id
+
+                if self.check_chat_id(chat_id):
+                    if self.offer_index is None:
+                        bot.send_message(text="Search is not available.", chat_id=chat_id)
+                        return
+
+                    if len(args) > 1 or (len(args) == 1 and args[0] != "more"):
+                        bot.send_message(text="Command usage not recognized. Get help with `/help search`.",
+                                         chat_id=chat_id, parse_mode="Markdown")
+                        return
+
+                    sent = self.send_search_results(chat_id, more=len(args) == 1)
+                    if sent == 0:
+                        bot.send_message(text="No %smatching offers from the last %d days." % (
+                            "more " if len(args) == 1 else "", SEARCH_DAYS), chat_id=chat_id)
+                    elif sent == SEARCH_PAGE_SIZE:
+                        self.updater.job_queue.run_once(
+                            callback=lambda b, job: b.send_message(
+                                text="Get next offers with `/search more`.", chat_id=chat_id, parse_mode="Markdown"),
+                            when=sent * SEND_INTERVAL)
+
+        def __stats(bot, update, args):
+            """ Sends statistics of offers from given location. """
+            if self.check_timestamp():
+                chat_id = update.message.chat_id
+
+                if self.check_chat_id(chat_id):
+                    if self.analytics is None:
+                        bot.send_message(text="Statistics are not available.", chat_id=chat_id)
+                        return
+
+                    if len(args) == 0:
+                        bot.send_message(text="Command usage not recognized. Get help with `/help stats`.",
+                                         chat_id=chat_id, parse_mode="Markdown")
+                        return
+
+                    # Read only offers saved since last call and compute the statistics
+                    loc = " ".join(args)
+                    self.analytics.refresh()
+                    summary = self.analytics.summary(loc, since=dt.timestamp(dt.now()) - STATS_DAYS * 86400)
+
+                    if len(summary) == 0:
+                        msg_body = "No offers from `%s` in the last %d days." % (loc, STATS_DAYS)
+                    else:
+                        msg_body = "*Statistics: %s* (last %d days)\n" % (loc, STATS_DAYS)
+                        msg_body += "\n".join([
+                            "`%-7s %5d offers, median %5.0f zł, %3.0f zł/m2, %4.1f offers/h`" % (
+                                k.capitalize(), v.get("offers"), v.get("median_price"), v.get("median_price_m2"),
+                                v.get("offers_per_hour"))
+                            for (k, v) in summary.items()])
+
+                    bot.send_message(text=msg_body, chat_id=chat_id, parse_mode="Markdown")
+
         def __status(bot, update):
             """ Sends information whether bot is will send messages to chat or not. """
             if self.check_timestamp():
@@ -530,11 +955,17 @@ class TelegramBot:
                     bot.send_message(text=["Getting to work!", "Gonna take a break now..."][current_status],
                                      chat_id=chat_id)
 
+                    # Catch up with recent offers which were sent while the bot was off
+                    if not current_status:
+                        self.send_search_results(chat_id)
+
         self.updater.dispatcher.add_handler(CommandHandler("chat_admins", __modify_chat_admins, pass_args=True))
         self.updater.dispatcher.add_handler(CommandHandler("chat_info", __chat_info))
         self.updater.dispatcher.add_handler(CommandHandler("help", __help, pass_args=True))
         self.updater.dispatcher.add_handler(CommandHandler("config", __config, pass_args=True))
         # self.updater.dispatcher.add_handler(CommandHandler("favorite", __favorite, pass_args=True))
+        self.updater.dispatcher.add_handler(CommandHandler("search", __search, pass_args=True))
+        self.updater.dispatcher.add_handler(CommandHandler("stats", __stats, pass_args=True))
         self.updater.dispatcher.add_handler(CommandHandler("status", __status))
         self.updater.dispatcher.add_handler(CommandHandler("toggle", __toggle))
         return self
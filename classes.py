@@ -1,19 +1,29 @@
 from csv import DictWriter
+from multiprocessing import Event as ProcessEvent, Process
 from scrapers.scrapers_master import scraper_master
-from threading import Event, Thread
+from signal import SIG_IGN, SIGINT, signal
+from threading import Event, Lock, Thread
+from time import monotonic
+from utils import OFFER_COLUMNS
 
 
 class Offer:
     """ Class used to manage the offers. It holds all the important information from given offer. """
-    def __init__(self, url):
-        self.scrape_dict = scraper_master(url, offer=True)
+    def __init__(self, url, scrape_dict_arg=None, page=None):
+        """ This constructor uses scrapers to retrieve offer's information unless it was already provided.
+        An already fetched page might be provided, so it isn't fetched again. """
+        if scrape_dict_arg is None:
+            self.scrape_dict = scraper_master(url, offer=True, page=page)
+        else:
+            self.scrape_dict = scrape_dict_arg
+        self.lineage = None  # stages' timestamps (set for offers going through the pipeline)
 
     def __dir__(self):
-        return ["url", "is_room", "price", "loc", "rooms_info", "rooms", "size", "images_urls_list",
-                "scrape_time", "preferred_group", "sharing_type", "room_type"]
+        return list(OFFER_COLUMNS)
 
     def __getattr__(self, item):
-        if item not in self.scrape_dict.keys():
+        # Checking scrape_dict itself avoids infinite recursion when object is unpickled (e.g. sent between processes)
+        if item == "scrape_dict" or item not in self.scrape_dict.keys():
             raise AttributeError("type object 'Offer' has no attribute '%s'" % item)
         return self.scrape_dict.get(item)
 
@@ -32,6 +42,27 @@ class Offer:
             writer.writerow(self.scrape_dict)
 
 
+class OfferAlert:
+    """ Offer as it was seen on a listing (its summary), which is sent to chats right away.
+    The alert is edited in place once the offer's page was read. """
+    def __init__(self, summary, seen=None):
+        """
+        :param summary: dictionary with offer's url and the fields shown on the listing (e.g. price, loc, is_room)
+        :param seen: timestamp of the moment the offer was seen on the listing
+        """
+        self.summary = summary
+        self.seen = seen
+
+    def __getattr__(self, item):
+        # Checking summary itself avoids infinite recursion when object is unpickled (e.g. sent between processes)
+        if item == "summary" or item not in self.summary.keys():
+            raise AttributeError("type object 'OfferAlert' has no attribute '%s'" % item)
+        return self.summary.get(item)
+
+    def __repr__(self):
+        return "OfferAlert('%s')" % self.url
+
+
 class Page:
     """ Class used by reader threads to manage pages of offers.
     Iterating over the Page will return consecutive URLs it contains."""
@@ -95,3 +126,69 @@ class StoppableThread (Thread):
     def is_stopped(self):
         """ The method used to check from within the thread whether it has been stopped already. """
         return self.__stop_event.is_set()
+
+
+class StoppableProcess (Process):
+    """ A process counterpart of the StoppableThread with the same stop() and is_stopped() methods.
+    The target is run by a StoppableThread inside the new process, so functions written for threads
+    (which check current_thread().is_stopped()) work unchanged. """
+
+    def __init__(self, **kwargs):
+        """ A created process has an additional event (shared with parent) determining whether it was stopped. """
+        super().__init__(**kwargs)
+        self.__stop_event = ProcessEvent()
+
+    def run(self):
+        """ Runs the target in a thread and passes the stop request to it. """
+        signal(SIGINT, SIG_IGN)  # Ctrl+C is handled by the parent which stops the processes
+
+        thr = StoppableThread(target=self._target, args=self._args, kwargs=self._kwargs, name=self.name)
+        thr.start()
+
+        while thr.is_alive():
+            if self.__stop_event.wait(timeout=1):
+                thr.stop()
+                thr.join()
+
+    def stop(self):
+        """ A method setting the stop field. """
+        self.__stop_event.set()
+
+    def is_stopped(self):
+        """ The method used to check whether the process has been stopped already. """
+        return self.__stop_event.is_set()
+
+
+class TokenBucket:
+    """ Token bucket used to limit the rate of requests. Tokens are added continuously up to the capacity. """
+
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: number of tokens added per second
+        :param capacity: maximum number of tokens (size of a burst)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = monotonic()
+        self.lock = Lock()
+
+    def __refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def try_acquire(self, tokens=1):
+        """ Takes tokens if there are enough of them. Returns whether it succeeded. """
+        with self.lock:
+            self.__refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        """ Returns number of seconds after which there will be enough tokens. """
+        with self.lock:
+            self.__refill()
+            return max(0, (tokens - self.tokens) / self.rate)
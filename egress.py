@@ -0,0 +1,165 @@
+from politeness import HostBlockedException
+from random import choices
+from threading import Lock, current_thread
+from time import monotonic
+from urllib.parse import urlparse
+
+
+PROXY_ERROR_STATUS_CODES = [407, 502, 504]  # responses of a proxy which couldn't (or wouldn't) pass the request on
+
+
+class ProxyController:
+    """ Health of a single egress proxy: moving averages of its latency and error rate combined into a score
+    (expected time of a successful request, lower is better) and its quarantine. """
+    def __init__(self, url, alpha=0.2, initial_latency=1.0):
+        """
+        :param url: proxy's URL (e.g. http://10.0.0.2:3128)
+        :param alpha: weight of the latest request in the moving averages
+        :param initial_latency: latency in seconds assumed before the first request
+        """
+        self.url = url
+        self.alpha = alpha
+        self.latency = initial_latency
+        self.error_rate = 0.0
+
+        self.failures = 0            # consecutive failures
+        self.quarantined_until = 0
+        self.quarantine_time = None  # length of the next quarantine (None until the first one)
+        self.probation = False       # whether the proxy just came back from the quarantine
+
+        # Metrics
+        self.requests = 0
+        self.errors = 0
+        self.quarantines = 0
+
+    def score(self):
+        return self.latency / max(1 - self.error_rate, 0.05)
+
+    def record(self, success, latency=None):
+        """ Updates the averages with the result of a request. """
+        self.requests += 1
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (0 if success else 1)
+        if success:
+            self.failures = 0
+            if latency is not None:
+                self.latency = (1 - self.alpha) * self.latency + self.alpha * latency
+        else:
+            self.failures += 1
+            self.errors += 1
+
+    def stats(self):
+        return {"score": round(self.score(), 3), "latency": round(self.latency, 3),
+                "error_rate": round(self.error_rate, 3), "requests": self.requests, "errors": self.errors,
+                "quarantined": self.quarantined_until > monotonic(), "quarantines": self.quarantines}
+
+
+class ProxyPool:
+    """ Pool of egress proxies the pages are fetched through. Requests are routed by proxies' scores: a host
+    requested by a thread (e.g. a reader of one feed) sticks to a proxy picked randomly with probability inversely
+    proportional to its score, until the proxy fails or the assignment gets old. A proxy which fails repeatedly
+    (or too often) is quarantined for a time which doubles with every quarantine it didn't recover from.
+    An empty pool means that requests are sent directly. """
+    def __init__(self, proxies=None, sticky_time=600, failure_threshold=3, error_threshold=0.5, min_requests=5,
+                 quarantine_time=60, max_quarantine_time=3600):
+        """
+        :param proxies: list of proxies' URLs
+        :param sticky_time: time in seconds after which host's proxy is picked again
+        :param failure_threshold: number of consecutive failures which quarantines the proxy
+        :param error_threshold: error rate which quarantines the proxy (once it sent min_requests requests)
+        :param min_requests: number of requests after which the error rate is trusted
+        :param quarantine_time: time in seconds of the first quarantine
+        :param max_quarantine_time: limit of the (doubling) quarantine time
+        """
+        self.sticky_time = sticky_time
+        self.failure_threshold = failure_threshold
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.base_quarantine_time = quarantine_time
+        self.max_quarantine_time = max_quarantine_time
+
+        self.lock = Lock()
+        self.proxies = []
+        self.assignments = {}  # (host, thread name) -> (proxy, time of the assignment)
+        self.configure(proxies or [])
+
+    def configure(self, proxies):
+        """ Sets the pool's proxies. """
+        with self.lock:
+            self.proxies = [ProxyController(url) for url in proxies]
+            self.assignments = {}
+
+    def __key(self, url):
+        return urlparse(url).netloc, current_thread().name
+
+    def choose(self, url):
+        """ Returns the proxy the URL should be requested through (None if the pool is empty).
+        Raises HostBlockedException if every proxy is quarantined. """
+        with self.lock:
+            if len(self.proxies) == 0:
+                return None
+            now = monotonic()
+
+            # Proxies which served their quarantine get another chance (with a clean record)
+            for proxy in self.proxies:
+                if proxy.quarantined_until != 0 and proxy.quarantined_until <= now:
+                    proxy.quarantined_until = 0
+                    proxy.probation = True
+                    proxy.failures, proxy.error_rate = 0, 0.0
+
+            proxy, assigned_at = self.assignments.get(self.__key(url), (None, 0))
+            if proxy is not None and proxy.quarantined_until == 0 and now - assigned_at < self.sticky_time:
+                return proxy
+
+            available = [proxy for proxy in self.proxies if proxy.quarantined_until == 0]
+            if len(available) == 0:
+                retry_in = min([proxy.quarantined_until for proxy in self.proxies]) - now
+                raise HostBlockedException("Every proxy is quarantined", max(retry_in, 1))
+
+            # Proxies which weren't used yet are scored as the best one, so they get tried
+            scores = [proxy.score() for proxy in available if proxy.requests > 0]
+            best = min(scores) if len(scores) > 0 else 1.0
+            proxy = choices(available, weights=[1 / (proxy.score() if proxy.requests > 0 else best)
+                                                for proxy in available])[0]
+            self.assignments[self.__key(url)] = (proxy, now)
+            return proxy
+
+    def report(self, proxy, url, success, latency=None):
+        """ Reports the result of a request sent through the proxy. Failed request makes the host pick its proxy
+        again, and the proxy might get quarantined. """
+        if proxy is None:
+            return
+
+        with self.lock:
+            proxy.record(success, latency)
+            if success:
+                if proxy.probation:
+                    proxy.probation = False
+                    proxy.quarantine_time = None
+                return
+
+            self.assignments.pop(self.__key(url), None)
+            if proxy.probation or proxy.failures >= self.failure_threshold or \
+                    (proxy.requests >= self.min_requests and proxy.error_rate >= self.error_threshold):
+                self.__quarantine(proxy)
+
+    def __quarantine(self, proxy):
+        """ Takes the proxy out of the pool for a while and drops the hosts' assignments to it. """
+        proxy.quarantine_time = self.base_quarantine_time if proxy.quarantine_time is None else \
+            min(proxy.quarantine_time * 2, self.max_quarantine_time)
+        proxy.quarantined_until = monotonic() + proxy.quarantine_time
+        proxy.probation = False
+        proxy.quarantines += 1
+        self.assignments = dict([(key, value) for (key, value) in self.assignments.items() if value[0] is not proxy])
+
+    def stats(self):
+        """ Returns metrics of every proxy. """
+        with self.lock:
+            hosts = {}
+            for (proxy, _) in self.assignments.values():
+                hosts[proxy.url] = hosts.get(proxy.url, 0) + 1
+            return dict([(proxy.url, {**proxy.stats(), "assigned": hosts.get(proxy.url, 0)})
+                         for proxy in self.proxies])
+
+
+# Pool used by get_page (empty unless the main script was given proxies)
+EGRESS = ProxyPool()
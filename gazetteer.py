@@ -0,0 +1,146 @@
+from functools import lru_cache
+from unicodedata import combining, normalize
+import re
+
+
+# Canonical names of Warsaw's districts
+DISTRICTS = ["Bemowo", "Białołęka", "Bielany", "Mokotów", "Ochota", "Praga Południe", "Praga Północ", "Rembertów",
+             "Śródmieście", "Targówek", "Ursus", "Ursynów", "Wawer", "Wesoła", "Wilanów", "Wola", "Włochy", "Żoliborz"]
+
+# Other names used for the districts
+DISTRICT_ALIASES = {
+    "Praga Południe": ["Praga Płd", "Praga Pd"],
+    "Praga Północ": ["Praga Płn", "Praga Pn"],
+    "Śródmieście": ["Centrum", "Śródmieście Północne", "Śródmieście Południowe"]
+}
+
+# Warsaw's neighbourhoods and districts they belong to
+NEIGHBOURHOODS = {
+    "Bemowo": ["Jelonki", "Boernerowo", "Chrzanów", "Fort Bema", "Górce", "Groty", "Lotnisko"],
+    "Białołęka": ["Tarchomin", "Nowodwory", "Choszczówka", "Żerań", "Brzeziny", "Henryków", "Kobiałka"],
+    "Bielany": ["Chomiczówka", "Młociny", "Wawrzyszew", "Wrzeciono", "Piaski", "Marymont Kaskada", "Ruda"],
+    "Mokotów": ["Stary Mokotów", "Sadyba", "Służew", "Służewiec", "Stegny", "Sielce", "Wierzbno", "Ksawerów",
+                "Czerniaków", "Siekierki", "Augustówka", "Królikarnia"],
+    "Ochota": ["Rakowiec", "Szczęśliwice", "Filtry", "Stara Ochota", "Kolonia Lubeckiego"],
+    "Praga Południe": ["Saska Kępa", "Gocław", "Gocławek", "Grochów", "Kamionek", "Olszynka Grochowska"],
+    "Praga Północ": ["Nowa Praga", "Stara Praga", "Szmulowizna", "Pelcowizna"],
+    "Rembertów": ["Kawęczyn", "Nowy Rembertów", "Stary Rembertów"],
+    "Śródmieście": ["Muranów", "Powiśle", "Nowe Miasto", "Stare Miasto", "Solec", "Ujazdów", "Mirów Północny"],
+    "Targówek": ["Bródno", "Zacisze", "Elsnerów", "Targówek Mieszkaniowy", "Targówek Fabryczny"],
+    "Ursus": ["Niedźwiadek", "Szamoty", "Skorosze", "Gołąbki"],
+    "Ursynów": ["Kabaty", "Natolin", "Imielin", "Stokłosy", "Pyry", "Grabów", "Dąbrówka"],
+    "Wawer": ["Anin", "Falenica", "Miedzeszyn", "Marysin Wawerski", "Radość", "Międzylesie", "Sadul"],
+    "Wesoła": ["Stara Miłosna", "Groszówka", "Zielona", "Plac Wojska Polskiego"],
+    "Wilanów": ["Miasteczko Wilanów", "Powsin", "Zawady", "Kępa Zawadowska", "Błonia Wilanowskie"],
+    "Wola": ["Mirów", "Odolany", "Czyste", "Koło", "Ulrychów", "Młynów", "Nowolipki", "Powązki"],
+    "Włochy": ["Okęcie", "Salomea", "Opacz", "Raków", "Nowe Włochy", "Stare Włochy"],
+    "Żoliborz": ["Marymont", "Sady Żoliborskie", "Stary Żoliborz", "Żoliborz Dziennikarski", "Żoliborz Oficerski"]
+}
+
+# Towns (Warsaw itself and the towns of Masovian Voivodeship)
+TOWNS = ["Warszawa", "Piaseczno", "Pruszków", "Legionowo", "Otwock", "Józefów", "Marki", "Ząbki", "Zielonka",
+         "Łomianki", "Konstancin-Jeziorna", "Grodzisk Mazowiecki", "Milanówek", "Piastów", "Sulejówek", "Wołomin",
+         "Kobyłka", "Radom", "Płock", "Siedlce", "Ostrołęka", "Ciechanów", "Mińsk Mazowiecki", "Żyrardów",
+         "Nowy Dwór Mazowiecki", "Raszyn", "Jabłonna", "Michałowice", "Nadarzyn", "Lesznowola", "Izabelin",
+         "Stare Babice", "Błonie", "Brwinów", "Podkowa Leśna", "Halinów", "Karczew", "Góra Kalwaria"]
+
+# Other names used for the towns (e.g. the first word only, which older versions of the scrapers saved)
+TOWN_ALIASES = {
+    "Grodzisk Mazowiecki": ["Grodzisk"],
+    "Konstancin-Jeziorna": ["Konstancin"],
+    "Mińsk Mazowiecki": ["Mińsk"],
+    "Nowy Dwór Mazowiecki": ["Nowy Dwór"]
+}
+
+WARSAW = "Warszawa"              # districts and neighbourhoods are the ones of this town
+TOWN_RANK, DISTRICT_RANK = 1, 2  # the more specific location wins (e.g. district over "Warszawa")
+
+
+def normalize_text(text):
+    """ Returns lowercase text without diacritics and punctuation (words are separated by single spaces). """
+    text = normalize("NFKD", text.lower().replace("ł", "l"))
+    text = "".join([c for c in text if not combining(c)])
+    return " ".join(re.findall("[a-z0-9]+", text))
+
+
+class Gazetteer:
+    """ Dictionary of known locations compiled into a trie of words. Matching scans a raw location string once
+    and returns canonical name of the most specific location it mentions. Districts and neighbourhoods are Warsaw's
+    ones and their names are common elsewhere too (e.g. "Wola Kosowska" or "Kraków, Piaski Nowe"), so they are taken
+    into account only if the string mentions Warsaw or begins with a district's name on its own (the string's first
+    part is the town otherwise, e.g. "Otwock, Zawady" is Otwock rather than Wilanów). """
+    def __init__(self):
+        self.trie = {}
+        self.districts = set()  # normalized names which stand for a district on their own (see match)
+
+        for district in DISTRICTS:
+            for name in [district] + DISTRICT_ALIASES.get(district, []):
+                self.add(name, district, DISTRICT_RANK)
+                self.districts.add(normalize_text(name))
+            for neighbourhood in NEIGHBOURHOODS.get(district, []):
+                self.add(neighbourhood, district, DISTRICT_RANK)
+        for town in TOWNS:
+            for name in [town] + TOWN_ALIASES.get(town, []):
+                self.add(name, town, TOWN_RANK)
+
+    def add(self, name, canonical, rank):
+        """ Adds name (or alias) of a location to the trie. """
+        node = self.trie
+        for word in normalize_text(name).split(" "):
+            node = node.setdefault(word, {})
+
+        # Keep the more specific meaning if the same name was added twice
+        if node.get(None) is None or node.get(None)[1] < rank:
+            node[None] = (canonical, rank)
+
+    def match(self, raw, in_warsaw=False):
+        """ Returns (canonical name, rank) of the most specific (and then the longest) location found in given string
+        or None if no known location was found. A town other than Warsaw wins over Warsaw's districts, which are
+        found only if the string mentions Warsaw, its first part (before a comma) is a district's name or in_warsaw
+        is set (e.g. for names the users choose from Warsaw's districts). A string beginning with anything else (an
+        unknown town, a neighbourhood's name on its own, e.g. "Koło") is a location outside of Warsaw then. """
+        words = normalize_text(raw).split(" ")
+        best, best_key = None, None
+        town, town_key = None, None
+
+        for start in range(len(words)):
+            node = self.trie
+            for end in range(start, len(words)):
+                node = node.get(words[end])
+                if node is None:
+                    break
+                if node.get(None) is not None:
+                    key = (node.get(None)[1], end - start)
+                    if best_key is None or key > best_key:
+                        best, best_key = node.get(None), key
+                    if key[0] == TOWN_RANK and (town_key is None or key > town_key):
+                        town, town_key = node.get(None), key
+
+        if town is not None and town[0] != WARSAW:
+            return town
+        if town is not None or in_warsaw or normalize_text(raw.split(",")[0]) in self.districts:
+            return best
+        return None
+
+    def normalize(self, raw, in_warsaw=False):
+        """ Returns canonical name of the location mentioned in given string or None if it is unknown. """
+        if raw is None:
+            return None
+        found = self.match(raw, in_warsaw)
+        return None if found is None else found[0]
+
+
+GAZETTEER = Gazetteer()
+
+
+def normalize_location(raw, in_warsaw=False):
+    """ Shortcut for the normalization with the default gazetteer. """
+    return GAZETTEER.normalize(raw, in_warsaw)
+
+
+@lru_cache(maxsize=4096)
+def canonical_location(name):
+    """ Returns canonical name of the location or the name itself if it is unknown. Locations saved before they were
+    normalized (chats' configs and offers in the output files) are compared through it, so their old spellings
+    (e.g. "Praga Płd" or "Grodzisk") are aliases of the canonical names. """
+    return None if name is None else normalize_location(name) or name
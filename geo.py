@@ -0,0 +1,147 @@
+from gazetteer import DISTRICT_ALIASES, DISTRICT_RANK, GAZETTEER, NEIGHBOURHOODS, TOWN_ALIASES, TOWN_RANK, Gazetteer
+from math import asin, cos, floor, radians, sin, sqrt
+from threading import Lock
+
+
+# Approximate centroids (latitude, longitude) of Warsaw's districts, some of their neighbourhoods and the towns
+DISTRICT_CENTROIDS = {
+    "Bemowo": (52.2545, 20.9110), "Białołęka": (52.3200, 20.9700), "Bielany": (52.2930, 20.9340),
+    "Mokotów": (52.1930, 21.0350), "Ochota": (52.2120, 20.9750), "Praga Południe": (52.2390, 21.0830),
+    "Praga Północ": (52.2600, 21.0350), "Rembertów": (52.2600, 21.1600), "Śródmieście": (52.2300, 21.0120),
+    "Targówek": (52.2900, 21.0500), "Ursus": (52.1950, 20.8850), "Ursynów": (52.1410, 21.0330),
+    "Wawer": (52.1970, 21.1600), "Wesoła": (52.2500, 21.2300), "Wilanów": (52.1560, 21.0900),
+    "Wola": (52.2360, 20.9590), "Włochy": (52.1900, 20.9200), "Żoliborz": (52.2680, 20.9830)
+}
+NEIGHBOURHOOD_CENTROIDS = {
+    "Jelonki": (52.2390, 20.9200), "Tarchomin": (52.3180, 20.9630), "Chomiczówka": (52.2790, 20.9320),
+    "Młociny": (52.2950, 20.9300), "Sadyba": (52.1870, 21.0700), "Służewiec": (52.1790, 21.0000),
+    "Stegny": (52.1740, 21.0560), "Wierzbno": (52.1960, 21.0100), "Rakowiec": (52.2000, 20.9750),
+    "Szczęśliwice": (52.2070, 20.9640), "Saska Kępa": (52.2320, 21.0580), "Gocław": (52.2280, 21.0950),
+    "Grochów": (52.2450, 21.1000), "Kamionek": (52.2470, 21.0500), "Nowa Praga": (52.2660, 21.0280),
+    "Stara Praga": (52.2550, 21.0300), "Muranów": (52.2470, 20.9950), "Powiśle": (52.2390, 21.0290),
+    "Stare Miasto": (52.2490, 21.0120), "Bródno": (52.2950, 21.0300), "Kabaty": (52.1320, 21.0650),
+    "Natolin": (52.1400, 21.0500), "Anin": (52.2220, 21.1720), "Falenica": (52.1600, 21.2120),
+    "Miasteczko Wilanów": (52.1610, 21.0800), "Mirów": (52.2380, 20.9850), "Koło": (52.2460, 20.9460),
+    "Powązki": (52.2520, 20.9640), "Ulrychów": (52.2370, 20.9380), "Okęcie": (52.1750, 20.9600),
+    "Marymont": (52.2720, 20.9720), "Sady Żoliborskie": (52.2650, 20.9760)
+}
+TOWN_CENTROIDS = {
+    "Warszawa": (52.2297, 21.0122), "Piaseczno": (52.0810, 21.0240), "Pruszków": (52.1700, 20.8120),
+    "Legionowo": (52.4010, 20.9260), "Otwock": (52.1050, 21.2610), "Józefów": (52.1360, 21.2350),
+    "Marki": (52.3200, 21.1050), "Ząbki": (52.2920, 21.1060), "Zielonka": (52.3050, 21.1600),
+    "Łomianki": (52.3340, 20.8870), "Konstancin-Jeziorna": (52.0930, 21.1170),
+    "Grodzisk Mazowiecki": (52.1090, 20.6250), "Milanówek": (52.1230, 20.6660), "Piastów": (52.1840, 20.8390),
+    "Sulejówek": (52.2450, 21.2800), "Wołomin": (52.3400, 21.2420), "Kobyłka": (52.3390, 21.1950),
+    "Radom": (51.4027, 21.1471), "Płock": (52.5463, 19.7065), "Siedlce": (52.1676, 22.2902),
+    "Ostrołęka": (53.0842, 21.5748), "Ciechanów": (52.8813, 20.6200), "Mińsk Mazowiecki": (52.1790, 21.5720),
+    "Żyrardów": (52.0490, 20.4450), "Nowy Dwór Mazowiecki": (52.4300, 20.7160), "Raszyn": (52.1560, 20.9250),
+    "Jabłonna": (52.3790, 20.9100), "Michałowice": (52.1750, 20.8700), "Nadarzyn": (52.0960, 20.8050),
+    "Lesznowola": (52.0820, 20.9350), "Izabelin": (52.3000, 20.8150), "Stare Babice": (52.2580, 20.8400),
+    "Błonie": (52.1980, 20.6170), "Brwinów": (52.1420, 20.7170), "Podkowa Leśna": (52.1220, 20.7280),
+    "Halinów": (52.2270, 21.3550), "Karczew": (52.0800, 21.2500), "Góra Kalwaria": (51.9770, 21.2150)
+}
+CENTROIDS = {**TOWN_CENTROIDS, **DISTRICT_CENTROIDS, **NEIGHBOURHOOD_CENTROIDS}
+
+NEIGHBOURHOOD_RANK = DISTRICT_RANK + 1  # neighbourhood's centroid is closer than its district's one
+EARTH_RADIUS = 6371.0                    # kilometres
+KM_PER_DEGREE = 111.2                    # length of a degree of latitude in kilometres
+MAX_RADIUS = 100                         # kilometres
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Returns distance in kilometres between two points (haversine formula). """
+    d_lat, d_lon = radians(lat2 - lat1), radians(lon2 - lon1)
+    a = sin(d_lat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+class CentroidGazetteer(Gazetteer):
+    """ Gazetteer of locations with known centroids. Unlike the default one, neighbourhoods with known centroids
+    aren't resolved to their districts, so the most specific centroid is found. """
+    def __init__(self):
+        self.trie = {}
+        self.districts = GAZETTEER.districts  # the same districts (with centroids)
+
+        for district in DISTRICT_CENTROIDS.keys():
+            for name in [district] + DISTRICT_ALIASES.get(district, []) + NEIGHBOURHOODS.get(district, []):
+                self.add(name, district, DISTRICT_RANK)
+        for neighbourhood in NEIGHBOURHOOD_CENTROIDS.keys():
+            self.add(neighbourhood, neighbourhood, NEIGHBOURHOOD_RANK)
+        for town in TOWN_CENTROIDS.keys():
+            for name in [town] + TOWN_ALIASES.get(town, []):
+                self.add(name, town, TOWN_RANK)
+
+
+CENTROID_GAZETTEER = CentroidGazetteer()
+
+
+def geocode(raw):
+    """ Returns (latitude, longitude) of the most specific known location mentioned in given string (None if there
+    is none). It is the location's centroid, so it's only as precise as the location is. """
+    found = CENTROID_GAZETTEER.normalize(raw)
+    return None if found is None else CENTROIDS.get(found)
+
+
+class SubscriptionGrid:
+    """ Spatial index of chats' subscriptions to circles (a point and a radius). The map is divided into a grid of
+    cells and every subscription is kept in the cells its circle's bounding box overlaps, so a point is checked only
+    against the subscriptions of its own cell. """
+    def __init__(self, cell_size=0.05):
+        """
+        :param cell_size: size of a cell in degrees (both latitude and longitude)
+        """
+        self.cell_size = cell_size
+        self.lock = Lock()
+        self.circles = {}  # chat id -> (latitude, longitude, radius in kilometres)
+        self.cells = {}    # (row, column) -> set of chat ids
+
+        self.queries = 0
+        self.candidates = 0  # subscriptions whose distance was checked
+
+    def __cell(self, lat, lon):
+        return floor(lat / self.cell_size), floor(lon / self.cell_size)
+
+    def __covered_cells(self, lat, lon, km):
+        d_lat = km / KM_PER_DEGREE
+        d_lon = km / (KM_PER_DEGREE * max(cos(radians(lat)), 0.01))
+        (row_min, column_min), (row_max, column_max) = self.__cell(lat - d_lat, lon - d_lon), \
+            self.__cell(lat + d_lat, lon + d_lon)
+        return [(row, column) for row in range(row_min, row_max + 1) for column in range(column_min, column_max + 1)]
+
+    def update(self, chat_id, near=None):
+        """ Sets chat's subscription (near is a dictionary with lat, lon and km; None removes the subscription). """
+        with self.lock:
+            if chat_id in self.circles.keys():
+                for cell in self.__covered_cells(*self.circles.pop(chat_id)):
+                    self.cells[cell].discard(chat_id)
+                    if len(self.cells[cell]) == 0:
+                        del self.cells[cell]
+
+            if near is not None:
+                circle = (near.get("lat"), near.get("lon"), near.get("km"))
+                self.circles[chat_id] = circle
+                for cell in self.__covered_cells(*circle):
+                    self.cells.setdefault(cell, set()).add(chat_id)
+
+    def matching(self, lat, lon):
+        """ Returns set of ids of chats whose circles contain the point (empty if it's unknown). """
+        if lat is None or lon is None:
+            return set()
+
+        with self.lock:
+            candidates = self.cells.get(self.__cell(lat, lon), set())
+            self.queries += 1
+            self.candidates += len(candidates)
+            return set([chat_id for chat_id in candidates if self.contains(chat_id, lat, lon)])
+
+    def contains(self, chat_id, lat, lon):
+        """ Returns whether chat's circle contains the point. """
+        circle = self.circles.get(chat_id)
+        return circle is not None and lat is not None and lon is not None and \
+            distance(circle[0], circle[1], lat, lon) <= circle[2]
+
+    def stats(self):
+        """ Returns the index' metrics. """
+        with self.lock:
+            return {"subscriptions": len(self.circles), "cells": len(self.cells), "queries": self.queries,
+                    "candidates_per_query": round(self.candidates / self.queries, 2) if self.queries > 0 else None}
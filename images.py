@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from hashlib import sha1
+from os import makedirs, replace
+from os.path import isfile, join
+from requests import get
+from threading import BoundedSemaphore, Lock
+import json
+
+
+class ImageStore:
+    """ Content-addressed storage of offers' images. Every image is saved once under its sha1 digest,
+    no matter how many offers (or URLs) it comes from. Thumbnails are generated on the first request. """
+    def __init__(self, store_dir, thumbnail_size=(320, 320)):
+        self.store_dir = store_dir
+        self.thumbnail_size = thumbnail_size
+        self.index_file = join(store_dir, "index.jsonl")
+        self.lock = Lock()
+
+        makedirs(join(store_dir, "objects"), exist_ok=True)
+        makedirs(join(store_dir, "thumbs"), exist_ok=True)
+
+        # Loading the index of already downloaded images (image URL -> metadata)
+        self.index = {}
+        self.index_offset = 0
+        self.refresh()
+
+    def refresh(self):
+        """ Loads images recorded in the index file since the last refresh (e.g. downloaded by other processes). """
+        if not isfile(self.index_file):
+            return
+
+        with self.lock:
+            with open(self.index_file, "r", encoding="utf-8", newline="") as idx:
+                idx.seek(self.index_offset)
+                lines = idx.readlines()
+
+            # Skip the last line if it is still being written
+            if len(lines) > 0 and not lines[-1].endswith("\n"):
+                lines.pop()
+            self.index_offset += sum([len(line.encode("utf-8")) for line in lines])
+            for line in lines:
+                record = json.loads(line)
+                self.index[record.get("image_url")] = record
+
+    def object_path(self, digest):
+        return join(self.store_dir, "objects", digest[:2], digest)
+
+    def has_image(self, image_url):
+        return image_url in self.index.keys()
+
+    def put(self, offer_url, image_url, data, content_type=None):
+        """ Saves image's content (unless the same content is already stored) and records its metadata. """
+        digest = sha1(data).hexdigest()
+        path = self.object_path(digest)
+
+        if not isfile(path):
+            makedirs(join(self.store_dir, "objects", digest[:2]), exist_ok=True)
+            with open(path + ".tmp", "wb") as of:
+                of.write(data)
+            replace(path + ".tmp", path)
+
+        record = {
+            "offer_url": offer_url,
+            "image_url": image_url,
+            "sha1": digest,
+            "bytes": len(data),
+            "content_type": content_type,
+            "download_time": dt.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+        with self.lock:
+            self.index[image_url] = record
+            with open(self.index_file, "a", encoding="utf-8") as idx:
+                idx.write(json.dumps(record) + "\n")
+
+        return digest
+
+    def digest(self, image_url):
+        """ Returns sha1 digest of the stored image (None if it wasn't downloaded yet). """
+        if image_url not in self.index.keys():
+            self.refresh()
+        record = self.index.get(image_url)
+        return None if record is None else record.get("sha1")
+
+    def metadata(self, offer_url):
+        """ Returns metadata of every stored image of given offer. """
+        return [record for record in self.index.values() if record.get("offer_url") == offer_url]
+
+    def thumbnail(self, digest):
+        """ Returns path to the image's thumbnail and creates it if it does not exist yet.
+        Note: requires Pillow which is imported only here. """
+        from PIL import Image
+
+        thumb_path = join(self.store_dir, "thumbs", "%s.jpg" % digest)
+        if not isfile(thumb_path):
+            with Image.open(self.object_path(digest)) as img:
+                img = img.convert("RGB")
+                img.thumbnail(self.thumbnail_size)
+                img.save(thumb_path + ".tmp", format="JPEG")
+            replace(thumb_path + ".tmp", thumb_path)
+
+        return thumb_path
+
+
+class ImagePipeline:
+    """ Downloads offers' images in the background with a limited number of threads.
+    If there are more images waiting than the backlog allows, the new ones are skipped
+    so the pipeline never slows down the offers processing. """
+    def __init__(self, store, workers=4, backlog=200, timeout=30):
+        self.store = store
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = BoundedSemaphore(backlog)
+        self.executor = None  # Created on the first use (so it is created within the process which uses it)
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def submit(self, offer):
+        """ Schedules download of every not yet stored image of the offer. Never blocks. """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Images")
+
+        for image_url in (offer.images_urls_list or []):
+            if self.store.has_image(image_url):
+                continue
+
+            if not self.slots.acquire(blocking=False):
+                self.skipped += 1
+                continue
+
+            future = self.executor.submit(self.__download, offer.url, image_url)
+            future.add_done_callback(lambda f: self.slots.release())
+
+    def __download(self, offer_url, image_url):
+        try:
+            response = get(image_url, timeout=self.timeout)
+            response.raise_for_status()
+            self.store.put(offer_url, image_url, response.content, response.headers.get("Content-Type"))
+            self.downloaded += 1
+        except Exception:
+            self.failed += 1
+
+    def stop(self):
+        """ Cancels waiting downloads. """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """ Returns the pipeline's metrics. """
+        return {"downloaded": self.downloaded, "skipped": self.skipped, "failed": self.failed}
@@ -0,0 +1,128 @@
+from collections import deque
+from gazetteer import normalize_text
+from threading import Lock
+
+
+KEYWORD_KINDS = ["include", "exclude"]
+
+
+def normalize_keyword(keyword):
+    """ Returns the pattern matched for the keyword (None if nothing is left of it after normalization). """
+    text = normalize_text(keyword)
+    return " %s" % text if text != "" else None
+
+
+class KeywordMatcher:
+    """ Keywords of all chats compiled into a single Aho-Corasick automaton, so offer's text is scanned once
+    whatever the number of chats and keywords. Text and keywords are normalized (lowercase, no diacritics and
+    punctuation) and a keyword matches at the start of a word, so "balkon" matches "balkonem" as well and "zwierzęta"
+    matches "zwierzeta". A chat accepts an offer whose text mentions every included and none of the excluded keywords.
+    Changes of chats' keywords are applied to the automaton incrementally: keywords shared with other chats only change
+    their owners, new ones are added to the trie and removed ones only lose their output. Failure links are
+    recomputed before the next scan, and the trie is rebuilt from scratch only once most of it is dead. """
+    def __init__(self):
+        self.lock = Lock()
+        self.chats = {}   # chat id -> {kind -> set of patterns}
+        self.owners = {}  # pattern -> number of chats using it
+
+        # Automaton: node -> {character -> node}, node -> failure node, node -> patterns ending there (via failures)
+        # and node -> {character -> next node} with failures already followed (scans make a single step per character)
+        self.goto, self.fail, self.outputs, self.delta = [{}], [0], [[]], [{}]
+        self.terminal = {}  # pattern -> its node
+        self.stale = False  # whether the failure links have to be recomputed
+
+        self.scans = 0
+        self.rebuilds = 0
+
+    def update(self, chat_id, include=None, exclude=None):
+        """ Sets chat's keywords (None removes the chat). """
+        patterns = {}
+        for (kind, keywords) in zip(KEYWORD_KINDS, [include or [], exclude or []]):
+            patterns[kind] = set([p for p in [normalize_keyword(k) for k in keywords] if p is not None])
+
+        with self.lock:
+            old = set().union(*self.chats.pop(chat_id, {}).values())
+            new = set().union(*patterns.values())
+            if include is not None or exclude is not None:
+                self.chats[chat_id] = patterns
+
+            for pattern in new - old:
+                self.owners[pattern] = self.owners.get(pattern, 0) + 1
+                if self.owners[pattern] == 1:
+                    self.__insert(pattern)
+            for pattern in old - new:
+                self.owners[pattern] -= 1
+                if self.owners[pattern] == 0:
+                    del self.owners[pattern]
+                    self.stale = True  # its output is left out when the links are recomputed
+
+            # Dead branches are dropped once they make up most of the trie
+            if len(self.goto) > 2 * (1 + sum([len(p) for p in self.owners.keys()])):
+                self.goto, self.fail, self.outputs, self.delta, self.terminal = [{}], [0], [[]], [{}], {}
+                for pattern in self.owners.keys():
+                    self.__insert(pattern)
+                self.rebuilds += 1
+
+    def __insert(self, pattern):
+        node = 0
+        for char in pattern:
+            if char not in self.goto[node].keys():
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.delta.append({})
+                self.goto[node][char] = len(self.goto) - 1
+            node = self.goto[node][char]
+        self.terminal[pattern] = node
+        self.stale = True
+
+    def __link(self):
+        """ Recomputes the failure links, outputs and transitions (breadth first, so shorter suffixes are done first).
+        Characters which none of the patterns has lead back to the root, so they are left out of the transitions. """
+        ends = dict([(node, pattern) for (pattern, node) in self.terminal.items() if pattern in self.owners.keys()])
+        self.outputs[0] = []
+        self.delta[0] = dict(self.goto[0])
+        nodes = deque()
+        for node in self.goto[0].values():
+            self.fail[node] = 0
+            nodes.append(node)
+
+        while len(nodes) > 0:
+            node = nodes.popleft()
+            self.outputs[node] = ([ends[node]] if node in ends.keys() else []) + self.outputs[self.fail[node]]
+            self.delta[node] = {**self.delta[self.fail[node]], **self.goto[node]}
+            for (char, child) in self.goto[node].items():
+                self.fail[child] = self.delta[self.fail[node]].get(char, 0)
+                nodes.append(child)
+
+        self.stale = False
+
+    def scan(self, text):
+        """ Returns set of keywords' patterns the text mentions. """
+        if text is None:
+            return set()
+
+        with self.lock:
+            if self.stale:
+                self.__link()
+            self.scans += 1
+
+            found, node, delta, outputs = set(), 0, self.delta, self.outputs
+            for char in " %s" % normalize_text(text):
+                node = delta[node].get(char, 0)
+                if outputs[node]:
+                    found.update(outputs[node])
+            return found
+
+    def accepts(self, chat_id, found):
+        """ Returns whether chat's keywords accept a text which mentions found patterns (see scan). """
+        patterns = self.chats.get(chat_id)
+        if patterns is None:
+            return True
+        return patterns.get("include") <= found and len(patterns.get("exclude") & found) == 0
+
+    def stats(self):
+        """ Returns the matcher's metrics. """
+        with self.lock:
+            return {"chats": len(self.chats), "keywords": len(self.owners), "nodes": len(self.goto),
+                    "scans": self.scans, "rebuilds": self.rebuilds}
@@ -0,0 +1,118 @@
+from bisect import bisect_left
+from threading import Lock
+from time import time
+import json
+
+
+STAGES = ["seen", "dequeued", "deduped", "fetched", "parsed", "matched", "sent"]  # in the order they happen
+LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600,
+                   float("inf")]  # upper bounds (in seconds) of histograms' buckets
+
+
+class Lineage:
+    """ Timestamps of the stages an offer went through, from being seen on a listing to being sent to Telegram.
+    It travels with the offer's URL through the read queue and then with the Offer object (also between processes),
+    so timestamps are wall-clock times. """
+    def __init__(self, url, stamps=None):
+        """
+        :param url: offer's URL
+        :param stamps: dictionary stage -> timestamp
+        """
+        self.url = url
+        self.stamps = {} if stamps is None else stamps
+        self.recorded = False
+
+    def __str__(self):
+        return self.url  # sharded queues route items by their string (the same offer goes to the same worker)
+
+    def __repr__(self):
+        return "Lineage('%s', %s)" % (self.url, self.stamps)
+
+    def mark(self, stage, timestamp=None):
+        """ Saves the time of the stage (only the first time it is reached). Returns the lineage. """
+        self.stamps.setdefault(stage, time() if timestamp is None else timestamp)
+        return self
+
+    def latencies(self):
+        """ Returns dictionary stage -> time since the previous reached stage, and total (since the offer was seen). """
+        reached = [stage for stage in STAGES if stage in self.stamps.keys()]
+        latencies = dict([(stage, self.stamps[stage] - self.stamps[previous])
+                          for (previous, stage) in zip(reached, reached[1:])])
+        if len(reached) > 1:
+            latencies["total"] = self.stamps[reached[-1]] - self.stamps[reached[0]]
+        return latencies
+
+    def to_dict(self):
+        return {"url": self.url, "stamps": self.stamps}
+
+    @staticmethod
+    def from_dict(value):
+        return Lineage(value.get("url"), value.get("stamps"))
+
+
+class Histogram:
+    """ Histogram with fixed, roughly logarithmic buckets (percentiles are the buckets' upper bounds). """
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """ Returns upper bound of the bucket holding the q-th percentile. """
+        threshold, seen = q * self.count, 0
+        for (bound, count) in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= threshold and seen > 0:
+                return min(bound, self.max)
+        return None
+
+    def stats(self):
+        return dict([("count", self.count)] + [(name, round(self.percentile(q), 3))
+                                               for (name, q) in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]] +
+                    [("max", round(self.max, 3))])
+
+
+class LatencyTracker:
+    """ Aggregates finished lineages into per-stage and end-to-end (total) latency histograms.
+    Each lineage is also appended to the log file (JSON lines) if one was given. """
+    def __init__(self, log_file=None):
+        """
+        :param log_file: file the lineages are appended to
+        """
+        self.log_file = log_file
+        self.lock = Lock()
+        self.histograms = dict([(stage, Histogram()) for stage in STAGES[1:] + ["total"]])
+        self.alerts = Histogram()  # time from being seen to the listing-based alert being sent
+
+    def record(self, lineage):
+        """ Adds the offer's latencies to the histograms (each lineage is recorded once). """
+        with self.lock:
+            if lineage is None or lineage.recorded:
+                return
+            lineage.recorded = True
+
+            latencies = lineage.latencies()
+            for (stage, latency) in latencies.items():
+                self.histograms[stage].add(latency)
+
+            if self.log_file is not None:
+                with open(self.log_file, "a", encoding="utf-8") as lf:
+                    lf.write(json.dumps({**lineage.to_dict(), "latencies": latencies}) + "\n")
+
+    def record_alert(self, seen):
+        """ Adds the latency of an alert sent for an offer seen at given time. """
+        with self.lock:
+            if seen is not None:
+                self.alerts.add(max(time() - seen, 0))
+
+    def stats(self):
+        """ Returns the histograms' summaries (in seconds). """
+        with self.lock:
+            histograms = {**self.histograms, "alert": self.alerts}
+            return dict([(stage, histogram.stats()) for (stage, histogram) in histograms.items()
+                         if histogram.count > 0])
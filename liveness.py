@@ -0,0 +1,230 @@
+from classes import TokenBucket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from egress import EGRESS, PROXY_ERROR_STATUS_CODES
+from os.path import isfile
+from politeness import POLITENESS, THROTTLE_STATUS_CODES, HostBlockedException, parse_retry_after
+from threading import Lock, current_thread
+from time import monotonic, sleep, time
+from urllib.parse import urlparse
+from utils import read_new_rows
+import heapq
+import json
+
+# Note: requests is imported only when the checker actually runs.
+
+
+REMOVED_STATUS_CODES = [404, 410]                  # offer's page is gone
+REDIRECT_STATUS_CODES = [301, 302, 303, 307, 308]  # removed offers are redirected (e.g. to their category)
+
+
+class LivenessScheduler:
+    """ Keeps the known offers which are still on the market and decides when each of them should be checked.
+    Like revisits, fresh offers are checked often and old ones rarely, but a check is a single HEAD request
+    (no page is downloaded or parsed), so many more offers can be covered. Removed offers are saved to the removals
+    file (JSON lines with url, first_seen, removed_at and the time on market) and aren't checked anymore. """
+    def __init__(self, db_file, removals_file, min_interval=6 * 3600, max_interval=3 * 86400, max_age=90 * 86400,
+                 age_factor=0.5):
+        """
+        :param db_file: output file (any of its parts) with known offers
+        :param removals_file: JSON lines file where removed offers are saved (and loaded from on start)
+        :param min_interval: shortest interval in seconds between two checks
+        :param max_interval: longest interval in seconds between two checks
+        :param max_age: offers older than this (in seconds) are no longer checked
+        :param age_factor: interval is this fraction of the offer's age
+        """
+        self.db_file = db_file
+        self.removals_file = removals_file
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_age = max_age
+        self.age_factor = age_factor
+
+        self.lock = Lock()
+        self.first_seen = {}  # url -> first seen timestamp
+        self.removed = {}     # url -> seconds the offer was on the market
+        self.heap = []        # (next check timestamp, url)
+        self.offsets = {}     # output part -> number of bytes already read
+        self.checked = 0
+        self.unknown = 0      # checks which couldn't tell (e.g. the host failed)
+
+        # Offers removed before restart aren't checked again
+        if isfile(self.removals_file):
+            with open(self.removals_file, "r", encoding="utf-8") as rf:
+                for line in rf:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.removed[record.get("url")] = record.get("on_market")
+
+    def next_check(self, first_seen, now):
+        """ Returns timestamp of the next check of an offer first seen at given time (None if it is too old). """
+        age = now - first_seen
+        if age > self.max_age:
+            return None
+        return now + min(self.max_interval, max(self.min_interval, age * self.age_factor))
+
+    def refresh(self):
+        """ Loads offers saved since the last refresh. Their first check is scheduled by their age. """
+        now = time()
+        for row in read_new_rows(self.db_file, self.offsets):
+            try:
+                first_seen = dt.strptime(row.get("scrape_time"), "%Y-%m-%d %H:%M:%S").timestamp()
+            except (TypeError, ValueError):
+                continue
+
+            with self.lock:
+                if row.get("url") in self.first_seen.keys() or row.get("url") in self.removed.keys():
+                    continue
+                self.first_seen[row.get("url")] = first_seen
+                check = self.next_check(first_seen, now)
+                if check is not None:
+                    heapq.heappush(self.heap, (check, row.get("url")))
+
+        return self
+
+    def count_due(self, limit):
+        """ Returns number of offers (up to the limit) which should be checked now. """
+        with self.lock:
+            now = time()
+            return len([1 for (check, _) in heapq.nsmallest(limit, self.heap) if check <= now])
+
+    def pop_due(self, limit):
+        """ Returns URLs of up to limit offers which should be checked now. """
+        urls = []
+        with self.lock:
+            while len(urls) < limit and len(self.heap) > 0 and self.heap[0][0] <= time():
+                urls.append(heapq.heappop(self.heap)[1])
+        return urls
+
+    def reschedule(self, url, alive):
+        """ Schedules the next check of the offer (unless it is too old already).
+        :param alive: result of the check (True, or None if the check couldn't tell)
+        """
+        with self.lock:
+            self.checked += 1
+            self.unknown += alive is None
+            check = self.next_check(self.first_seen[url], time())
+            if check is not None:
+                heapq.heappush(self.heap, (check, url))
+
+    def remove(self, url, status):
+        """ Saves the offer as removed now. Returns the record saved to the removals file. """
+        with self.lock:
+            self.checked += 1
+            now = time()
+            first_seen = self.first_seen.pop(url)
+            self.removed[url] = now - first_seen
+
+            record = {"url": url, "first_seen": dt.fromtimestamp(first_seen).strftime("%Y-%m-%d %H:%M:%S"),
+                      "removed_at": dt.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"),
+                      "on_market": round(now - first_seen), "status": status}
+            with open(self.removals_file, "a", encoding="utf-8") as rf:
+                rf.write(json.dumps(record) + "\n")
+            return record
+
+    def stats(self):
+        """ Returns the scheduler's metrics (median time on market of removed offers is in days). """
+        with self.lock:
+            on_market = sorted([seconds for seconds in self.removed.values() if seconds is not None])
+            median = on_market[len(on_market) // 2] / 86400 if len(on_market) > 0 else None
+            return {"active": len(self.first_seen), "removed": len(self.removed), "scheduled": len(self.heap),
+                    "checked": self.checked, "unknown": self.unknown,
+                    "median_days_on_market": None if median is None else round(median, 1)}
+
+
+def check_offer(session, url, timeout=10):
+    """ Checks whether offer's page is still there with a HEAD request (or a GET of its first byte if the host
+    doesn't allow HEAD). Requests are coordinated with the others sent to the host by the politeness controller.
+    Returns (True if the offer is there, False if it was removed or None if it couldn't be told, status code). """
+    from requests.exceptions import RequestException
+
+    try:
+        proxy = EGRESS.choose(url)
+        host = POLITENESS.host(url, None if proxy is None else proxy.url)
+        probe = host.acquire()
+    except HostBlockedException:
+        return None, None
+    proxies = None if proxy is None else {"http": proxy.url, "https": proxy.url}
+
+    try:
+        start = monotonic()
+        response = session.head(url, allow_redirects=False, timeout=timeout, proxies=proxies)
+        if response.status_code == 405:
+            response = session.get(url, allow_redirects=False, timeout=timeout, stream=True, proxies=proxies,
+                                   headers={"Range": "bytes=0-0"})
+            response.close()
+    except RequestException:
+        host.release(probe, success=False)
+        EGRESS.report(proxy, url, success=False)
+        return None, None
+
+    if response.status_code in THROTTLE_STATUS_CODES:
+        host.release(probe, success=False, throttled=True,
+                     retry_after=parse_retry_after(response.headers.get("Retry-After")))
+        EGRESS.report(proxy, url, success=False)
+        return None, response.status_code
+    host.release(probe, success=response.status_code < 500)
+    EGRESS.report(proxy, url, success=response.status_code not in PROXY_ERROR_STATUS_CODES,
+                  latency=monotonic() - start)
+
+    if response.status_code in REMOVED_STATUS_CODES:
+        return False, response.status_code
+
+    # Offer which moved (e.g. to https) is still there, the removed one is redirected elsewhere (e.g. to a listing)
+    if response.status_code in REDIRECT_STATUS_CODES:
+        offer_id = urlparse(url).path.rstrip("/").split("/")[-1]
+        return offer_id in urlparse(response.headers.get("Location", "")).path, response.status_code
+
+    return (True if response.status_code < 300 else None), response.status_code
+
+
+def liveness_runner(thread_statuses, scheduler, rate=0.5, batch_size=20, workers=2, refresh_interval=300):
+    """ Function checks known offers in batches on the scheduler's schedule and saves the removed ones.
+    Like revisits, it has its own request budget (below the host's rate limit, which it shares with the others),
+    so it doesn't starve reading of new offers.
+    :param thread_statuses: used for debugging and checking up on threads
+    :param scheduler: LivenessScheduler with known offers
+    :param rate: maximum number of checks per second (0.5 per second covers over 40 thousand offers a day)
+    :param batch_size: maximum number of offers checked at once
+    :param workers: number of requests sent at the same time (they share session's kept-alive connections)
+    :param refresh_interval: time in seconds between loading newly saved offers
+    """
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+
+    thread_statuses[current_thread().name] = "Booting"
+    budget = TokenBucket(rate, capacity=batch_size)
+    last_refresh = 0
+
+    session = Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=workers))
+    session.mount("https://", HTTPAdapter(pool_maxsize=workers))
+
+    with ThreadPoolExecutor(workers) as pool:
+        while not current_thread().is_stopped():
+            # Schedule newly saved offers
+            if time() - last_refresh > refresh_interval:
+                thread_statuses[current_thread().name] = "Loading"
+                scheduler.refresh()
+                last_refresh = time()
+
+            # Take a batch of offers only if the budget allows to check all of them now
+            due = scheduler.count_due(batch_size)
+            if due == 0 or not budget.try_acquire(due):
+                thread_statuses[current_thread().name] = "Waiting"
+                sleep(1 if due == 0 else min(budget.wait_time(due), 1))
+                continue
+
+            # Checking the offers
+            thread_statuses[current_thread().name] = "Check %02d" % due
+            urls = scheduler.pop_due(due)
+            for (url, (alive, status)) in zip(urls, pool.map(lambda u: check_offer(session, u), urls)):
+                if alive is False:
+                    scheduler.remove(url, status)
+                else:
+                    scheduler.reschedule(url, alive)
+
+    session.close()
+    thread_statuses[current_thread().name] = "Stopped"
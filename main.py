@@ -1,8 +1,23 @@
+from api import api_runner
+from archive import ARCHIVE
 from argparse import ArgumentParser
-from classes import StoppableThread
+from backfill import BACKFILL_PRIORITY, BackfillCrawler, backfill_runner
+from classes import StoppableProcess, StoppableThread
+from egress import EGRESS
+from importlib.util import find_spec
+from lineage import LatencyTracker
+from liveness import LivenessScheduler, liveness_runner
+from multiprocessing import JoinableQueue, Manager
+from offers_index import OfferIndex
+from os.path import join
+from politeness import POLITENESS
+from prefilter import PREFILTER_POLICIES, ListingPrefilter
 from utils import SUPPORTED_MODES, SUPPORTED_PAGES, get_url, thread_runner
 from methods import bot_runner, process_offers, read_pages
 from queue import Queue
+from queues import QUEUE_POLICIES, BoundedQueue, DurableQueue, ShardedQueue
+from readers import ReaderPool, reader_pool_runner
+from revisits import RevisitScheduler, revisit_runner
 
 
 # ---------- Parsing provided arguments ----------
@@ -14,6 +29,50 @@ parser.add_argument("--bot", dest="bot", default=None, nargs=2, metavar=("settin
                     help="bot settings file start Telegram bot")
 parser.add_argument("--output", dest="output", default=None, metavar="output_file",
                     help="output file where offers are saved")
+parser.add_argument("--queue-size", dest="queue_size", default=0, type=int, metavar="size",
+                    help="capacity of each offers queue (0 means unbounded)")
+parser.add_argument("--queue-policy", dest="queue_policy", default="block", choices=QUEUE_POLICIES,
+                    help="what to do when a bounded queue is full")
+parser.add_argument("--spill-dir", dest="spill_dir", default=".", metavar="spill_dir",
+                    help="directory for queue spill files (used by spill policy)")
+parser.add_argument("--durable-queue", dest="durable_queue", default=None, metavar="queue_dir",
+                    help="keep offers queues on the disk so they survive restarts (overrides --queue-size)")
+parser.add_argument("--images", dest="images", default=None, metavar="images_dir",
+                    help="download offers' images in the background and store them in given directory")
+parser.add_argument("--archive", dest="archive", default=None, metavar="archive_dir",
+                    help="keep compressed copies of fetched offers' pages (see archive.py to extract them again)")
+parser.add_argument("--latency", dest="latency", default=None, metavar="latency_file",
+                    help="save offers' stages timestamps and latencies (from being seen to being sent) to given file")
+parser.add_argument("--revisit", dest="revisit", default=None, metavar="changes_file",
+                    help="revisit saved offers and notify about their changes (which are saved to given file)")
+parser.add_argument("--liveness", dest="liveness", default=None, metavar="removals_file",
+                    help="check whether saved offers are still there and save the removed ones to given file")
+parser.add_argument("--liveness-rate", dest="liveness_rate", default=0.5, type=float, metavar="rate",
+                    help="maximum number of liveness checks per second (they count towards --host-rate)")
+parser.add_argument("--api", dest="api", default=None, type=int, metavar="port",
+                    help="serve saved offers over HTTP on given local port")
+parser.add_argument("--tracking", dest="tracking", default=None, metavar="config_file",
+                    help="track pages listed in given config file (changes are applied without a restart)")
+parser.add_argument("--host-rate", dest="host_rate", default=1.0, type=float, metavar="rate",
+                    help="maximum number of requests per second sent to a single host")
+parser.add_argument("--host-in-flight", dest="host_in_flight", default=2, type=int, metavar="requests",
+                    help="maximum number of requests sent to a single host at the same time")
+parser.add_argument("--proxies", dest="proxies", default=[], nargs="+", metavar="proxy",
+                    help="send requests through given egress proxies (e.g. http://10.0.0.2:3128) picked by health")
+parser.add_argument("--prefilter", dest="prefilter", default=None, choices=PREFILTER_POLICIES,
+                    help="defer (or skip) fetching offers which no online chat would receive judging by the listing "
+                         "(skipped offers aren't saved to the output either)")
+parser.add_argument("--alerts", dest="alerts", default=False, const=True, action="store_const",
+                    help="alert chats about new offers right away based on the listing (edited once details are read)")
+parser.add_argument("--backfill", dest="backfill", default=None, metavar="checkpoint_file",
+                    help="walk all listing pages of the selected pages once to collect older offers (the progress is "
+                         "saved to given file, so the backfill can be resumed)")
+parser.add_argument("--backfill-rate", dest="backfill_rate", default=0.5, type=float, metavar="rate",
+                    help="maximum number of listing pages fetched per second by the backfill")
+parser.add_argument("--backfill-workers", dest="backfill_workers", default=2, type=int, metavar="workers",
+                    help="number of listing pages fetched by the backfill at the same time")
+parser.add_argument("--processes", dest="processes", default=0, type=int, metavar="workers",
+                    help="run readers, given number of workers and the bot as separate processes")
 
 for page_name in SUPPORTED_PAGES:
     parser.add_argument("--%s" % page_name, dest=page_name, choices=SUPPORTED_MODES, default=[], nargs="+",
@@ -22,48 +81,198 @@ for page_name in SUPPORTED_PAGES:
 # Write down choices
 selection = vars(parser.parse_args())
 
+# Queues shared between processes can only block when they are full
+if selection.get("processes") > 0 and (selection.get("durable_queue") is not None or
+                                       selection.get("queue_policy") != "block"):
+    parser.error("--processes supports only in-memory queues with the block policy")
+
+# Prefilter uses chats' configs and deferred offers need a queue with priorities
+if selection.get("prefilter") is not None and selection.get("bot") is None:
+    parser.error("--prefilter requires --bot")
+if selection.get("alerts") and selection.get("bot") is None:
+    parser.error("--alerts requires --bot")
+if selection.get("prefilter") == "defer" and (selection.get("queue_size") == 0 or selection.get("processes") > 0 or
+                                              selection.get("durable_queue") is not None):
+    parser.error("--prefilter defer requires --queue-size (priorities are supported only by the bounded queue)")
+
 # For each page add selected modes (or add all if it was chosen to do so)
 urls = []
 for page_name in SUPPORTED_PAGES:
     for mode in (SUPPORTED_MODES if selection.get("all") else selection.get(page_name)):
         urls.append(get_url(page_name, mode))
 
+# Optional dependencies are checked up front (they are imported only once they are used)
+if selection.get("archive") is not None and find_spec("zstandard") is None:
+    parser.error("--archive requires zstandard (pip install zstandard)")
+if selection.get("images") is not None and selection.get("bot") is not None and find_spec("PIL") is None:
+    parser.error("--images with --bot requires Pillow for the thumbnails (pip install Pillow)")
+
+# Backfill walks the selected pages (which are also read live)
+if selection.get("backfill") is not None and len(urls) == 0:
+    parser.error("--backfill requires selected pages (e.g. --all)")
+
 
 # ---------- Variables initialization ----------
-thread_statuses = {}         # dictionary holds names of all threads and information what they are up to
-threads = []                 # list of threads
-read_offers_queue = Queue()  # offers read by page reader
-offers_queue = Queue()       # offers for bot
+threads = []                 # list of threads (or processes)
+
+# Requests sent to the same host are coordinated (each process has its own controller)
+POLITENESS.configure(rate=selection.get("host_rate"), max_in_flight=selection.get("host_in_flight"))
+EGRESS.configure(selection.get("proxies"))  # each proxy has its own hosts' limits
+
+# Fetched offers' pages are archived (each process writes its own segments)
+if selection.get("archive") is not None:
+    ARCHIVE.open(selection.get("archive"))
+
+# Offers read by page reader and offers for bot
+if selection.get("processes") > 0:
+    manager = Manager()
+    thread_statuses = manager.dict()  # statuses are reported by every process
+    worker_queues = [JoinableQueue(selection.get("queue_size")) for _ in range(selection.get("processes"))]
+    read_offers_queue = ShardedQueue(worker_queues)  # each offer URL always goes to the same worker
+    offers_queue = JoinableQueue(selection.get("queue_size"))
+else:
+    thread_statuses = {}  # dictionary holds names of all threads and information what they are up to
+    if selection.get("durable_queue") is not None:
+        read_offers_queue = DurableQueue(join(selection.get("durable_queue"), "read_offers"))
+        offers_queue = DurableQueue(join(selection.get("durable_queue"), "offers"))
+    elif selection.get("queue_size") > 0:
+        # Read offers are served freshest first (stale ones wait or get shed), the bot gets offers in order
+        read_offers_queue = BoundedQueue(selection.get("queue_size"), selection.get("queue_policy"),
+                                         join(selection.get("spill_dir"), "read_offers_queue.spill"),
+                                         freshest_first=True)
+        offers_queue = BoundedQueue(selection.get("queue_size"), selection.get("queue_policy"),
+                                    join(selection.get("spill_dir"), "offers_queue.spill"))
+    else:
+        read_offers_queue = Queue()
+        offers_queue = Queue()
+    worker_queues = [read_offers_queue]
+runner_class = StoppableProcess if selection.get("processes") > 0 else StoppableThread
+
+# Optional images downloading (off the offers processing path)
+image_pipeline = None
+if selection.get("images") is not None:
+    from images import ImagePipeline, ImageStore
+    image_pipeline = ImagePipeline(ImageStore(selection.get("images")))
+
+# Index of saved offers (used by the API and the bot's search)
+offer_index = None
+if selection.get("api") is not None or (selection.get("bot") is not None and selection.get("output") is not None):
+    offer_index = OfferIndex(selection.get("output"), selection.get("liveness"))
+
+
+# Listing-level prefilter of the offers (uses the bot's chats' configs) and alerts sent by the bot right away
+prefilter = None
+if selection.get("prefilter") is not None:
+    prefilter = ListingPrefilter(selection.get("bot")[0], selection.get("bot")[1], selection.get("prefilter"))
+alerts_queue = offers_queue if selection.get("alerts") else None
+
 
 # ---------- Defining threads ----------
 # Page reading threads
 for i in range(len(urls)):
     threads.append(
-        StoppableThread(
+        runner_class(
             target=read_pages,
-            args=(thread_statuses, urls[i], read_offers_queue),
+            args=(thread_statuses, urls[i], read_offers_queue, 30, 0, None, prefilter, alerts_queue),
             name="Reader %d" % i))
-    
-# Worker thread
-thr_worker = StoppableThread(
-    target=process_offers,
-    args=(thread_statuses, read_offers_queue, offers_queue, selection.get("output"),
-          selection.get("bot")[0] if selection.get("bot") is not None else None),
-    name="Worker")
-# Start worker only if there is a reader
+
+# Backfilling thread (it finishes once every listing page was walked; workers process the found offers)
+backfill_crawler = None
+if selection.get("backfill") is not None:
+    backfill_crawler = BackfillCrawler(selection.get("backfill"), urls, window=selection.get("backfill_workers"))
+    threads.append(
+        StoppableThread(
+            target=backfill_runner,
+            args=(thread_statuses, backfill_crawler, read_offers_queue, selection.get("backfill_rate"),
+                  selection.get("backfill_workers"), 5,
+                  -BACKFILL_PRIORITY if isinstance(read_offers_queue, BoundedQueue) else 0, offer_index),
+            name="Backfill"))
+
+# Readers of the tracking config file (they can be started, stopped and retuned while running)
+reader_pool = None
+if selection.get("tracking") is not None:
+    reader_pool = ReaderPool(selection.get("tracking"), thread_statuses, read_offers_queue, runner_class,
+                             manager.dict if selection.get("processes") > 0 else dict, len(urls), prefilter,
+                             alerts_queue)
+    threads.append(
+        StoppableThread(
+            target=reader_pool_runner,
+            args=(thread_statuses, reader_pool),
+            name="Readers"))
+
+# Worker threads (one per queue shard) are started only if there is a reader
 if len(threads) > 0:
-    threads.append(thr_worker)
+    for i in range(len(worker_queues)):
+        threads.append(
+            runner_class(
+                target=process_offers,
+                args=(thread_statuses, worker_queues[i], offers_queue, selection.get("output"),
+                      selection.get("bot")[0] if selection.get("bot") is not None else None, image_pipeline,
+                      offer_index),
+                name="Worker" if len(worker_queues) == 1 else "Worker %d" % i))
+
+# Revisiting thread (needs saved offers to work with)
+revisit_scheduler = None
+if selection.get("revisit") is not None and selection.get("output") is not None:
+    revisit_scheduler = RevisitScheduler(selection.get("output"), selection.get("revisit"))
+    threads.append(
+        runner_class(
+            target=revisit_runner,
+            args=(thread_statuses, revisit_scheduler, offers_queue),
+            name="Revisit"))
+
+# Liveness checking thread (needs saved offers to work with)
+liveness_scheduler = None
+if selection.get("liveness") is not None and selection.get("output") is not None:
+    liveness_scheduler = LivenessScheduler(selection.get("output"), selection.get("liveness"))
+    threads.append(
+        runner_class(
+            target=liveness_runner,
+            args=(thread_statuses, liveness_scheduler, selection.get("liveness_rate")),
+            name="Liveness"))
 
 # Bot thread (started only if it was selected)
+latency = None
 if selection.get("bot") is not None:
-    thr_bot = StoppableThread(
+    latency = LatencyTracker(selection.get("latency"))
+
+    analytics = None
+    if selection.get("output") is not None:
+        from analytics import Analytics  # pandas and numpy are loaded only when they are needed
+        analytics = Analytics(selection.get("output"))
+
+    thr_bot = runner_class(
         target=bot_runner,
-        args=(thread_statuses, offers_queue, selection.get("bot")[0], selection.get("bot")[1]),
+        args=(thread_statuses, offers_queue, selection.get("bot")[0], selection.get("bot")[1], analytics,
+              offer_index, latency),
+        kwargs={"image_store": image_pipeline.store if image_pipeline is not None else None},
         name="Bot")
     threads.append(thr_bot)
 
 
+# Metrics of the components (printed at the end and served by the API)
+metrics = {"Read queue": read_offers_queue, "Offers queue": offers_queue, "Images": image_pipeline,
+           "Revisits": revisit_scheduler, "Liveness": liveness_scheduler, "Latency": latency, "Readers": reader_pool,
+           "Backfill": backfill_crawler,
+           "Hosts": POLITENESS, "Proxies": EGRESS if len(selection.get("proxies")) > 0 else None,
+           "Prefilter": prefilter, "Archive": ARCHIVE if selection.get("archive") is not None else None}
+
+# API thread (started only if it was selected)
+if selection.get("api") is not None:
+    threads.append(
+        StoppableThread(
+            target=api_runner,
+            args=(thread_statuses, offer_index, selection.get("api")),
+            kwargs={"metrics": metrics},
+            name="API"))
+
+
 # ---------- Running the threads ----------
 if len(threads) == 0:
     exit("No threads were started due to lack of selected options. For help add an -h / --help argument.")
-thread_runner(threads, thread_statuses)
+thread_runner(threads, thread_statuses, metrics)
+
+# Make sure everything what is left in durable queues is on the disk
+for q in [read_offers_queue, offers_queue]:
+    if hasattr(q, "close"):
+        q.close()
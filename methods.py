@@ -1,60 +1,114 @@
-from bot import TelegramBot
-from classes import Offer, Page
+from archive import archive_page
+from classes import Offer, OfferAlert, Page
+from collections import deque
 from json import load
+from lineage import Lineage
+from politeness import HostBlockedException
+from prefilter import DEFERRED_PRIORITY
+from queue import Full
+from revisits import OfferChange
 from scrapers.scrapers_master import ScraperMissingException
 from threading import current_thread
-from time import sleep
-from utils import GetPageException, is_duplicate, send_message
+from time import monotonic, sleep
+from urllib.parse import urlparse
+from utils import GetPageException, get_page, is_duplicate, send_message
 
 
-def read_pages(thread_statuses, url, q_read, interval=30):
+def read_pages(thread_statuses, url, q_read, interval=30, priority=0, tuning=None, prefilter=None, q_alerts=None):
     """ A method used to track the given URL and put read offers to a queue.
     :param thread_statuses: used for debugging and checking up on threads
     :param url: address to listen to
     :param q_read: queue of read offers passed to the function processing them
     :param interval: time in seconds between two consecutive refreshes of the page
+    :param priority: priority of the read offers (supported by the bounded queue)
+    :param tuning: optional dictionary with interval and priority which might be changed while the thread runs
+    :param prefilter: optional ListingPrefilter deciding (based on the listing) whether offers are worth fetching
+    :param q_alerts: optional queue (the bot's one) which gets alerts about new offers made of the listing
     """
     thread_statuses[current_thread().name] = "Booting"
 
-    # Save a current version of the page
-    page_old = Page(url)
+    # The first successfully read version of the page is the one new offers are tracked against
+    page_old = None
+    failures = 0
 
     # Work until the thread has been stopped by parent process
     while not current_thread().is_stopped():
         thread_statuses[current_thread().name] = "Working"
+        if tuning is not None:
+            interval, priority = tuning.get("interval", interval), tuning.get("priority", priority)
 
-        # One error retry getting the same page
+        # Retry getting the same page after an error, backing off exponentially (up to the refresh interval)
         try:
             page = Page(url)
-        except GetPageException:
-            continue
-        except ScraperMissingException:
+            failures = 0
+        except (GetPageException, ScraperMissingException) as err:
+            failures += 1
+            backoff = min(2 ** failures, interval)
+            if isinstance(err, HostBlockedException):
+                backoff = max(backoff, min(err.retry_in, interval))
+            for i in range(int(backoff)):
+                thread_statuses[current_thread().name] = "Backoff %02d" % (int(backoff) - i)
+                sleep(1)
+                if current_thread().is_stopped():
+                    break
             continue
 
-        # Append each new offer to processing queue
-        for offer_url in (page - page_old):
-            q_read.put(offer_url)
+        # Append each new offer to processing queue (bounded queue might make us wait, so keep checking the stop)
+        # Each offer carries its lineage (stages' timestamps) starting with the moment it was seen
+        summaries = dict([(summary.get("url"), summary) for summary in getattr(page, "offers_summaries", [])])
+        for offer_url in (page - page_old if page_old is not None else []):
+            # Offers which no chat would receive (judging by the listing) are fetched after the others or skipped
+            offer_priority = priority
+            wanted = prefilter is None or prefilter.check(summaries.get(offer_url))
+            if not wanted:
+                if prefilter.policy == "skip":
+                    continue
+                offer_priority = priority - DEFERRED_PRIORITY
+
+            lineage = Lineage(offer_url).mark("seen")
+
+            # The bot alerts the chats right away (offer's details follow once its page is read)
+            if q_alerts is not None and wanted and offer_url in summaries.keys():
+                try:
+                    q_alerts.put(OfferAlert(summaries.get(offer_url), lineage.stamps.get("seen")), block=False)
+                except Full:
+                    pass
+
+            while not current_thread().is_stopped():
+                try:
+                    if offer_priority != 0:
+                        q_read.put(lineage, timeout=1, priority=offer_priority)
+                    else:
+                        q_read.put(lineage, timeout=1)
+                    break
+                except Full:
+                    thread_statuses[current_thread().name] = "Queue full"
 
         # Save current page so we can track which offers are new
         page_old = page
 
-        # Wait before refreshing the page and keep updating the status
-        for i in range(interval):
-            thread_statuses[current_thread().name] = "Wait %02d" % (interval - i)
+        # Wait before refreshing the page and keep updating the status (the interval might be retuned meanwhile)
+        waited = 0
+        while waited < interval and not current_thread().is_stopped():
+            thread_statuses[current_thread().name] = "Wait %02d" % (interval - waited)
             sleep(1)
-            if current_thread().is_stopped():
-                break
+            waited += 1
+            if tuning is not None:
+                interval = tuning.get("interval", interval)
 
     thread_statuses[current_thread().name] = "Stopped"
 
 
-def process_offers(thread_statuses, q_read, q_offers, db_file, bot_settings_file):
+def process_offers(thread_statuses, q_read, q_offers, db_file, bot_settings_file, image_pipeline=None,
+                   offer_index=None):
     """ Function processes offers from the read queue and saves them under specified path.
     :param thread_statuses: used for debugging and checking up on threads
     :param q_read: queue of read offers
     :param q_offers: queue of offer objects passed to bot
     :param db_file: file where the offers should be saved
     :param bot_settings_file: json file which contains bot token
+    :param image_pipeline: optional ImagePipeline downloading offers' images in the background
+    :param offer_index: optional OfferIndex which is kept up to date with saved offers
     """
     thread_statuses[current_thread().name] = "Booting"
     trouble_meter = 0
@@ -63,42 +117,101 @@ def process_offers(thread_statuses, q_read, q_offers, db_file, bot_settings_file
         with open(bot_settings_file, "r", encoding="utf-8") as sf:
             bot_token = load(sf).get("token")
 
+    # Offers of hosts whose circuits are open wait aside (unacknowledged), so offers of other hosts aren't held up.
+    # A durable queue gets acknowledgements by entries' ids then, as the offers are no longer finished in order.
+    blocked = {}  # host -> (time of the next attempt, (entry id, offer's lineage) pairs waiting for the host)
+
+    def __next_waiting():
+        """ Returns (entry id, lineage) of an offer whose host might be contacted again (None if there is none). """
+        for (host, (retry_at, entries)) in list(blocked.items()):
+            if retry_at <= monotonic():
+                entry = entries.popleft()
+                if len(entries) == 0:
+                    del blocked[host]
+                return entry
+        return None
+
     # Work until the thread has been stopped by parent process
     while not current_thread().is_stopped():
-        thread_statuses[current_thread().name] = "Waiting"
+        thread_statuses[current_thread().name] = "Waiting" if len(blocked) == 0 else "Host wait"
 
-        while q_read.qsize() > 0:
-            if bot_settings_file is not None:
-                # Send notification if offers are piling up
-                if q_read.qsize() // 100 > trouble_meter:
-                    trouble_meter += 1
-                    send_message(bot_token, 87974246, "Liczba ofert w kolejce wzrasta: %s" % q_read.qsize())
-                    if db_file is not None and trouble_meter > 0:
-                        with open(db_file, "r", encoding="utf-8") as dbf:
-                            if len(dbf.readlines()) > 10000:
-                                p += 1
-                                db_file = db_file.replace("_p%02d.csv" % (p - 1), "_p%02d.csv" % p)
-                                send_message(bot_token, 87974246, "Nowy plik utworzony: %s" % db_file)
-
-                # Send notifications if offers pile-up is getting worked through
-                elif q_read.qsize() // 100 < trouble_meter:
-                    trouble_meter -= 1
-                    send_message(bot_token, 87974246, "Liczba ofert w kolejce maleje: %s" % q_read.qsize())
-
-            # Read URL and update status
-            thread_statuses[current_thread().name] = "Work %02d" % q_read.qsize()
-            url = q_read.get()
+        while not current_thread().is_stopped():
+            entry, waited = __next_waiting(), True
+            if entry is None:
+                if q_read.qsize() == 0:
+                    break
+
+                if bot_settings_file is not None:
+                    # Send notification if offers are piling up
+                    if q_read.qsize() // 100 > trouble_meter:
+                        trouble_meter += 1
+                        send_message(bot_token, 87974246, "Liczba ofert w kolejce wzrasta: %s" % q_read.qsize())
+                        if hasattr(q_read, "stats"):
+                            send_message(bot_token, 87974246, "Odrzucone oferty: %d, zrzucone na dysk: %d" % (
+                                q_read.stats().get("shed"), q_read.stats().get("spilled")))
+                        if db_file is not None and trouble_meter > 0:
+                            with open(db_file, "r", encoding="utf-8") as dbf:
+                                if len(dbf.readlines()) > 10000:
+                                    p += 1
+                                    db_file = db_file.replace("_p%02d.csv" % (p - 1), "_p%02d.csv" % p)
+                                    send_message(bot_token, 87974246, "Nowy plik utworzony: %s" % db_file)
+
+                    # Send notifications if offers pile-up is getting worked through
+                    elif q_read.qsize() // 100 < trouble_meter:
+                        trouble_meter -= 1
+                        send_message(bot_token, 87974246, "Liczba ofert w kolejce maleje: %s" % q_read.qsize())
 
-            # Check if it's duplicate
-            if is_duplicate(db_file, "url", url):
-                continue
+                # Read URL (queues left by older versions might hold plain URLs)
+                entry_id, item = q_read.get_entry() if hasattr(q_read, "get_entry") else (None, q_read.get())
+                entry = (entry_id, (item if isinstance(item, Lineage) else Lineage(item)).mark("dequeued"))
+                waited = False
+            entry_id, lineage = entry
+
+            # Update status
+            thread_statuses[current_thread().name] = "Work %02d" % q_read.qsize()
+            url = lineage.url
+            host = urlparse(url).netloc
+            waiting = False
 
-            # Reading and processing the offer
             try:
-                offer = Offer(url)
-                q_offers.put(offer)
+                # Offers of a blocked host wait for it behind the ones which already wait (their order is kept)
+                if host in blocked.keys() and not waited:
+                    blocked[host][1].append(entry)
+                    waiting = True
+                    continue
+
+                # Check if it's duplicate
+                if is_duplicate(db_file, "url", url):
+                    continue
+                lineage.mark("deduped")
+
+                # Fetching the offer's page (while the host is blocked, the offer waits for it instead of being dropped)
+                try:
+                    page = get_page(url)
+                except HostBlockedException as err:
+                    entries = blocked[host][1] if host in blocked.keys() else deque()
+                    entries.appendleft(entry)
+                    blocked[host] = (monotonic() + err.retry_in, entries)
+                    waiting = True
+                    continue
+                lineage.mark("fetched")
+                archive_page(url, page)
+
+                # Reading the offer
+                offer = Offer(url, page=page)
+                offer.lineage = lineage.mark("parsed")
+
+                # Processing the offer (backfilled offers are history, so they aren't passed to the bot)
+                if "backfilled" not in lineage.stamps.keys():
+                    q_offers.put(offer)
                 if db_file is not None:
                     offer.save_to_file(db_file)
+                if offer_index is not None:
+                    offer_index.add(offer)
+
+                # Images are downloaded in the background (after the offer was already passed on)
+                if image_pipeline is not None:
+                    image_pipeline.submit(offer)
 
             # Skip the offer if we were unable to retrieve the page or if the page is not supported
             except ScraperMissingException:
@@ -106,35 +219,68 @@ def process_offers(thread_statuses, q_read, q_offers, db_file, bot_settings_file
             except GetPageException:
                 pass
 
+            # Acknowledge the offer (durable queue won't deliver it again after restart) unless it waits for its host
+            finally:
+                if not waiting:
+                    if entry_id is None:
+                        q_read.task_done()
+                    else:
+                        q_read.task_done(entry_id)
+
+    if image_pipeline is not None:
+        image_pipeline.stop()
     thread_statuses[current_thread().name] = "Stopped"
 
 
-def bot_runner(thread_statuses, q_offer, bot_settings_file, bot_configs_dir):
+def bot_runner(thread_statuses, q_offer, bot_settings_file, bot_configs_dir, analytics=None, offer_index=None,
+               latency=None, index_refresh_interval=10, image_store=None):
     """ Function creates a Telegram Bot and supplies it with offers from q_offer queue.
     :param thread_statuses: used for debugging and checking up on threads
     :param q_offer: offers which are supplied to the bot
     :param bot_settings_file: settings file path
     :param bot_configs_dir: configs directory path
+    :param analytics: optional Analytics used to answer /stats
+    :param offer_index: optional OfferIndex used to answer /search
+    :param latency: optional LatencyTracker which gets lineages of the sent offers
+    :param index_refresh_interval: time in seconds between loading offers saved by other processes to the index
+    :param image_store: optional ImageStore with offers' images whose thumbnails are sent after the offers
     """
+    from bot import TelegramBot  # python-telegram-bot is loaded only when the bot is actually used
+
     # Starting the bot
     thread_statuses[current_thread().name] = "Booting"
     try:
-        bot = TelegramBot(bot_settings_file, bot_configs_dir)
+        bot = TelegramBot(bot_settings_file, bot_configs_dir, analytics, offer_index, latency, image_store=image_store)
     except Exception as err:
         thread_statuses[current_thread().name] = "Error -- %s" % err.__str__()
         return
+
+    # Saved offers are loaded before the bot starts answering, so commands (e.g. /search) never have to load them
+    if offer_index is not None:
+        thread_statuses[current_thread().name] = "Loading"
+        offer_index.refresh()
+    last_refresh = monotonic()
     bot.start()
 
     while not current_thread().is_stopped():
         thread_statuses[current_thread().name] = "Waiting"
+        if offer_index is not None and monotonic() - last_refresh > index_refresh_interval:
+            offer_index.refresh()
+            last_refresh = monotonic()
 
         while q_offer.qsize() > 0:
             # Get an offer and update status
             thread_statuses[current_thread().name] = "Work %02d" % q_offer.qsize()
             offer = q_offer.get()
 
-            # Process the offer (and send it if that's needed
-            bot.process_offer(offer)
+            # Process the offer or the offer's change (and send it if that's needed
+            if isinstance(offer, OfferChange):
+                bot.process_change(offer)
+            elif isinstance(offer, OfferAlert):
+                bot.process_alert(offer)
+            else:
+                bot.process_offer(offer)
+            q_offer.task_done()
 
     bot.stop()
     thread_statuses[current_thread().name] = "Stopped"
@@ -0,0 +1,201 @@
+from bisect import bisect_left, bisect_right, insort
+from classes import Offer
+from datetime import datetime as dt
+from gazetteer import canonical_location
+from heapq import nlargest
+from itertools import islice
+from os.path import isfile
+from threading import Lock
+from utils import read_new_rows
+import json
+
+
+NUMERIC_FIELDS = ["price", "size", "rooms", "scrape_time"]  # fields with sorted (range) indexes
+CATEGORICAL_FIELDS = ["loc", "is_room"]                      # fields with hash (equality) indexes
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def row_to_offer(row):
+    """ Creates an Offer from a row read from the output file (values are converted back from strings). """
+    scrape_dict = dict(row)
+    scrape_dict["is_room"] = {"True": True, "False": False}.get(row.get("is_room"))
+    for field in ["price", "size", "rooms"]:
+        scrape_dict[field] = _to_int(row.get(field))
+    for field in ["lat", "lon"]:
+        scrape_dict[field] = _to_float(row.get(field))
+    scrape_dict["loc"] = canonical_location(row.get("loc"))  # rows saved before locations were normalized
+    for field in scrape_dict.keys():
+        if scrape_dict[field] == "":
+            scrape_dict[field] = None
+    return Offer(row.get("url"), scrape_dict_arg=scrape_dict)
+
+
+def to_timestamp(scrape_time):
+    """ Converts offer's scrape time (string) to a timestamp. """
+    try:
+        return dt.strptime(scrape_time, "%Y-%m-%d %H:%M:%S").timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class OfferIndex:
+    """ In-memory store of offers with secondary indexes, so that filtered queries don't scan all offers.
+    Numeric fields are kept in sorted lists (range queries with bisect), categorical ones in dictionaries of sets.
+    Offers which were removed from the site (see liveness.py) are kept, but queries don't return them. """
+    def __init__(self, db_file=None, removals_file=None):
+        """
+        :param db_file: output file (any of its parts) the index is loaded from and refreshed with
+        :param removals_file: JSON lines file with removed offers the index is refreshed with
+        """
+        self.db_file = db_file
+        self.offsets = {}
+        self.removals_file = removals_file
+        self.removals_offset = 0
+        self.lock = Lock()
+        self.refresh_lock = Lock()  # threads refreshing the index at once would read the same rows twice
+
+        self.offers = []  # offer id (position) -> Offer
+        self.ids = {}     # url -> offer id
+        self.numeric = dict([(field, []) for field in NUMERIC_FIELDS])          # field -> sorted [(value, id)]
+        self.categorical = dict([(field, {}) for field in CATEGORICAL_FIELDS])  # field -> {value: set of ids}
+        self.removed_urls = set()  # removed offers (they might not be in the index yet)
+        self.removed = set()       # ids of removed offers
+
+    def __len__(self):
+        return len(self.offers)
+
+    def __add(self, offer, add_value):
+        """ Adds the offer to the index using given function to add its numeric values to the sorted lists. """
+        if offer.url in self.ids.keys():
+            return False
+
+        offer_id = len(self.offers)
+        self.offers.append(offer)
+        self.ids[offer.url] = offer_id
+        if offer.url in self.removed_urls:
+            self.removed.add(offer_id)
+
+        for field in NUMERIC_FIELDS:
+            value = to_timestamp(offer.scrape_time) if field == "scrape_time" else getattr(offer, field)
+            if value is not None:
+                add_value(self.numeric[field], (value, offer_id))
+
+        for field in CATEGORICAL_FIELDS:
+            self.categorical[field].setdefault(getattr(offer, field), set()).add(offer_id)
+
+        return True
+
+    def add(self, offer):
+        """ Adds the offer to the index (offers already present are skipped). Returns whether it was added. """
+        with self.lock:
+            return self.__add(offer, insort)
+
+    def add_many(self, offers):
+        """ Adds multiple offers at once -- values are appended and sorted once. Returns number of added offers. """
+        with self.lock:
+            added = sum([self.__add(offer, list.append) for offer in offers])
+            for field in NUMERIC_FIELDS:
+                self.numeric[field].sort()
+            return added
+
+    def remove(self, url):
+        """ Marks the offer as removed from the site. """
+        with self.lock:
+            self.removed_urls.add(url)
+            if url in self.ids.keys():
+                self.removed.add(self.ids[url])
+
+    def refresh(self):
+        """ Adds offers saved to the output files and marks offers saved to the removals file since the last refresh.
+        Returns number of added offers. """
+        if self.db_file is None:
+            return 0
+
+        with self.refresh_lock:
+            added = self.add_many([row_to_offer(row) for row in read_new_rows(self.db_file, self.offsets)])
+
+            if self.removals_file is not None and isfile(self.removals_file):
+                with open(self.removals_file, "r", encoding="utf-8", newline="") as rf:
+                    rf.seek(self.removals_offset)
+                    lines = rf.readlines()
+
+                # Skip the last line if it is still being written
+                if len(lines) > 0 and not lines[-1].endswith("\n"):
+                    lines.pop()
+                self.removals_offset += sum([len(line.encode("utf-8")) for line in lines])
+                for line in lines:
+                    self.remove(json.loads(line).get("url"))
+
+        return added
+
+    def get(self, url):
+        with self.lock:
+            return self.offers[self.ids[url]] if url in self.ids.keys() else None
+
+    def __range(self, field, min_value, max_value):
+        """ Returns set of ids of offers which field's value is within given limits. """
+        values = self.numeric[field]
+        start = 0 if min_value is None else bisect_left(values, (min_value, -1))
+        end = len(values) if max_value is None else bisect_right(values, (max_value, float("inf")))
+        return set([offer_id for (_, offer_id) in values[start:end]])
+
+    def __select(self, limits, loc, is_room, offset, limit):
+        """ Returns iterable of ids of offers (newest first) matching all provided filters (see query). """
+        candidates = []
+
+        for (field, (min_value, max_value)) in (limits or {}).items():
+            if min_value is not None or max_value is not None:
+                candidates.append(self.__range(field, min_value, max_value))
+
+        if loc is not None:
+            candidates.append(set().union(*[self.categorical["loc"].get(canonical_location(value), set())
+                                            for value in loc]))
+
+        if is_room is not None:
+            candidates.append(self.categorical["is_room"].get(is_room, set()))
+
+        # Intersect starting with the smallest set and take the newest (highest ids) ones which weren't removed
+        if len(candidates) > 0:
+            candidates.sort(key=len)
+            ids = candidates[0].intersection(*candidates[1:]) - self.removed
+            ids = sorted(ids, reverse=True) if limit is None else nlargest(offset + limit, ids)
+        else:
+            ids = (offer_id for offer_id in range(len(self.offers) - 1, -1, -1) if offer_id not in self.removed)
+
+        return islice(ids, offset, None if limit is None else offset + limit)
+
+    def query(self, limits=None, loc=None, is_room=None, offset=0, limit=None):
+        """ Returns list of offers (newest first) matching all provided filters.
+        :param limits: dictionary numeric field -> (min, max); either limit might be None
+        :param loc: list of accepted locations
+        :param is_room: offer type
+        :param offset: number of matching offers to skip
+        :param limit: maximum number of returned offers
+        """
+        with self.lock:
+            return [self.offers[offer_id] for offer_id in self.__select(limits, loc, is_room, offset, limit)]
+
+    def stream(self, limits=None, loc=None, is_room=None, offset=0, limit=None):
+        """ Returns iterator of offers matching all provided filters (see query). Offers are taken one by one as the
+        iterator is consumed and the lock is held only while the filters are applied (offers are never moved within
+        the index, so later additions don't affect it). """
+        with self.lock:
+            ids = self.__select(limits, loc, is_room, offset, limit)
+        return (self.offers[offer_id] for offer_id in ids)
+
+    def stats(self):
+        """ Returns the index's metrics. """
+        return {"offers": len(self.offers), "locations": len(self.categorical["loc"]), "removed": len(self.removed)}
@@ -0,0 +1,170 @@
+from classes import TokenBucket
+from threading import Condition, Lock
+from time import monotonic, sleep
+from urllib.parse import urlparse
+from utils import GetPageException
+
+
+THROTTLE_STATUS_CODES = [429, 503]  # responses meaning that the host wants us to slow down
+
+
+class HostBlockedException(GetPageException):
+    """ Raised instead of sending a request to a host which circuit is open. """
+    def __init__(self, message, retry_in):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class HostController:
+    """ Politeness of requests sent to a single host: a token bucket limiting the rate of requests, a limit of
+    requests in flight and a circuit breaker. The circuit opens after consecutive failures (or right away when the host
+    throttles us), stays open for a time which doubles with every failed attempt to close it and then half-opens,
+    letting a few probe requests through. A successful probe closes the circuit again. """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, rate=1.0, burst=1, max_in_flight=2, failure_threshold=5, open_time=30, max_open_time=900,
+                 probes=1):
+        """
+        :param rate: maximum number of requests per second
+        :param burst: number of requests which can be sent at once after a quiet period
+        :param max_in_flight: maximum number of requests sent at the same time
+        :param failure_threshold: number of consecutive failures which opens the circuit
+        :param open_time: time in seconds the circuit stays open for the first time
+        :param max_open_time: limit of the (doubling) time the circuit stays open
+        :param probes: number of requests let through when the circuit is half-open
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.failure_threshold = failure_threshold
+        self.base_open_time = open_time
+        self.max_open_time = max_open_time
+        self.probes = probes
+
+        self.condition = Condition()
+        self.state = HostController.CLOSED
+        self.in_flight = 0
+        self.probes_in_flight = 0
+        self.failures = 0
+        self.open_time = open_time
+        self.opened_until = 0
+
+        # Metrics
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.openings = 0
+
+    def __open(self, retry_after=None):
+        """ Opens the circuit (for the time the host asked for if it did so). """
+        self.state = HostController.OPEN
+        self.opened_until = monotonic() + max(self.open_time, retry_after or 0)
+        self.open_time = min(self.open_time * 2, self.max_open_time)
+        self.openings += 1
+
+    def acquire(self):
+        """ Waits until a request can be sent to the host (rate limit and in-flight limit).
+        Raises HostBlockedException right away if the circuit is open. Returns whether the request is a probe. """
+        with self.condition:
+            # Half-open the circuit once it was open long enough
+            if self.state == HostController.OPEN and monotonic() >= self.opened_until:
+                self.state = HostController.HALF_OPEN
+
+            if self.state == HostController.OPEN or \
+                    (self.state == HostController.HALF_OPEN and self.probes_in_flight >= self.probes):
+                self.rejected += 1
+                raise HostBlockedException("Circuit of the host is %s" % self.state,
+                                           max(self.opened_until - monotonic(), 1))
+
+            probe = self.state == HostController.HALF_OPEN
+            if probe:
+                self.probes_in_flight += 1
+
+            # Take a place among requests in flight
+            while self.in_flight >= self.max_in_flight:
+                self.condition.wait()
+            self.in_flight += 1
+            self.requests += 1
+
+        # Wait for the rate limit (without holding the lock)
+        while not self.bucket.try_acquire():
+            sleep(self.bucket.wait_time())
+        return probe
+
+    def release(self, probe, success, throttled=False, retry_after=None):
+        """ Reports the result of a request sent after acquire().
+        :param probe: value returned by acquire()
+        :param success: whether the host answered properly
+        :param throttled: whether the host told us to slow down (opens the circuit right away)
+        :param retry_after: number of seconds after which the host allowed to come back
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if probe:
+                self.probes_in_flight -= 1
+
+            if success:
+                self.failures = 0
+                if probe:
+                    self.state = HostController.CLOSED
+                    self.open_time = self.base_open_time
+            else:
+                self.failures += 1
+                self.errors += 1
+                self.throttled += int(throttled)
+                # Requests which were sent before the circuit opened don't prolong it
+                if probe or (self.state == HostController.CLOSED and
+                             (throttled or self.failures >= self.failure_threshold)):
+                    self.__open(retry_after)
+
+            self.condition.notify()
+
+    def stats(self):
+        """ Returns the host's metrics. """
+        with self.condition:
+            return {"state": self.state, "in_flight": self.in_flight, "requests": self.requests,
+                    "errors": self.errors, "throttled": self.throttled, "rejected": self.rejected,
+                    "openings": self.openings}
+
+
+class PolitenessController:
+    """ Shared registry of HostControllers, so that all threads fetching pages from the same host are coordinated.
+    Requests sent through different egress proxies come from different addresses, so each proxy has its own
+    controller of the host. """
+    def __init__(self, **host_settings):
+        """
+        :param host_settings: HostController's arguments used for every host
+        """
+        self.host_settings = host_settings
+        self.hosts = {}
+        self.lock = Lock()
+
+    def configure(self, **host_settings):
+        """ Changes the settings of hosts which weren't contacted yet. """
+        self.host_settings.update(host_settings)
+
+    def host(self, url, egress=None):
+        """ Returns controller of the URL's host (as seen through given egress proxy). """
+        name = urlparse(url).netloc if egress is None else "%s via %s" % (urlparse(url).netloc, egress)
+        with self.lock:
+            if name not in self.hosts.keys():
+                self.hosts[name] = HostController(**self.host_settings)
+            return self.hosts[name]
+
+    def stats(self):
+        """ Returns metrics of every contacted host. """
+        with self.lock:
+            hosts = list(self.hosts.items())
+        return dict([(name, host.stats()) for (name, host) in hosts])
+
+
+def parse_retry_after(value):
+    """ Returns number of seconds from the Retry-After header (dates are not supported) or None. """
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+# Controller used by get_page (shared by all threads of the process)
+POLITENESS = PolitenessController()
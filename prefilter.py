@@ -0,0 +1,107 @@
+from gazetteer import canonical_location
+from os.path import getmtime, isfile, join
+from threading import Lock
+from time import monotonic
+import json
+
+
+PREFILTER_POLICIES = ["defer", "skip"]
+DEFERRED_PRIORITY = 10  # deferred offers' priority is lowered by this much (they are fetched when nothing else waits)
+
+
+class ListingPrefilter:
+    """ Checks offers' summaries read from listings (price, location and offer type) against the configs of online chats,
+    so pages of offers which no chat would receive are fetched later (defer) or not at all (skip).
+    A summary passes if it might match at least one chat. Fields missing from the summary never reject an offer,
+    since the offer's page might still match. The configs are read from the bot's files (and reloaded when they
+    change), so readers running in other processes than the bot see the same chats. Until the files were read
+    successfully at least once, every offer passes (unknown chats mustn't make offers disappear).
+    Note that skipped offers are never fetched, so they are missing from the output as well (and thus from /stats,
+    /search, the API and revisits); the prefilter trades the dataset's completeness for requests. """
+    def __init__(self, bot_settings_file, configs_dir, policy="defer", check_interval=5):
+        """
+        :param bot_settings_file: bot settings file (with the list of chat ids)
+        :param configs_dir: directory of chats' configs
+        :param policy: what happens to offers which didn't pass (see PREFILTER_POLICIES)
+        :param check_interval: minimum number of seconds between checks whether the configs were changed
+        """
+        self.settings_file = bot_settings_file
+        self.configs_dir = configs_dir
+        self.policy = policy
+        self.check_interval = check_interval
+
+        self.lock = Lock()
+        self.chats = []       # configs of online chats
+        self.loaded = False   # whether the configs were read successfully at least once
+        self.mtimes = None    # modification times of the loaded files
+        self.checked_at = None
+
+        self.checked = 0
+        self.passed = 0
+
+    def __reload(self):
+        """ Loads the configs again if any of the files was changed. The last loaded configs are kept on errors
+        (e.g. when the bot is just writing a file). """
+        if self.checked_at is not None and monotonic() - self.checked_at < self.check_interval:
+            return
+        self.checked_at = monotonic()
+
+        try:
+            with open(self.settings_file, "r", encoding="utf-8") as sf:
+                chat_ids = json.load(sf).get("chat_ids", [])
+            paths = [join(self.configs_dir, "%s.json" % chat_id) for chat_id in chat_ids]
+            paths = [self.settings_file] + [path for path in paths if isfile(path)]
+
+            mtimes = [getmtime(path) for path in paths]
+            if mtimes == self.mtimes:
+                return
+
+            chats = []
+            for path in paths[1:]:
+                with open(path, "r", encoding="utf-8") as cf:
+                    config = json.load(cf)
+                if config.get("online"):
+                    if config.get("loc") is not None:  # the bot migrates old spellings too, but it might not run yet
+                        config["loc"] = [canonical_location(loc) for loc in config.get("loc")]
+                    chats.append(config)
+        except (OSError, ValueError, AttributeError):
+            return
+
+        self.chats, self.mtimes, self.loaded = chats, mtimes, True
+
+    @staticmethod
+    def might_match(summary, config):
+        """ Checks summary's fields the same way the bot checks the offer (see TelegramBot.check_offer). """
+        price, limits = summary.get("price"), config.get("price")
+        if price is not None and limits is not None and not limits.get("min") <= price <= limits.get("max"):
+            return False
+
+        # Chats subscribed to a circle (near) aren't filtered by the list of locations
+        loc = summary.get("loc")
+        if loc is not None and config.get("near") is None and config.get("loc") is not None and \
+                loc not in config.get("loc"):
+            return False
+
+        # Chats which want only flats (or only rooms)
+        is_room = summary.get("is_room")
+        if is_room is not None and config.get("mode") is not None and is_room != config.get("mode"):
+            return False
+
+        return True
+
+    def check(self, summary):
+        """ Returns whether the offer might be sent to any online chat (offers without a summary always pass, and so
+        do all offers until the configs were loaded). """
+        with self.lock:
+            self.__reload()
+            passed = summary is None or not self.loaded or \
+                any([self.might_match(summary, config) for config in self.chats])
+            self.checked += 1
+            self.passed += passed
+            return passed
+
+    def stats(self):
+        """ Returns the prefilter's metrics. """
+        with self.lock:
+            return {"chats": len(self.chats), "loaded": self.loaded, "checked": self.checked, "passed": self.passed,
+                    ("deferred" if self.policy == "defer" else "skipped"): self.checked - self.passed}
@@ -0,0 +1,387 @@
+from classes import Offer, OfferAlert
+from collections import deque
+from itertools import count
+from lineage import Lineage
+from os import fsync, listdir, makedirs, remove, replace
+from os.path import isfile, join
+from queue import Empty, Queue
+from revisits import OfferChange
+from threading import Condition, Lock
+from time import monotonic
+from zlib import crc32
+import heapq
+import json
+
+
+QUEUE_POLICIES = ["block", "drop-oldest", "spill"]
+
+
+def encode_item(item):
+    """ Function converts queue item (offer URL, Lineage, Offer, OfferAlert or OfferChange object)
+    to a JSON-serializable value. """
+    if isinstance(item, Lineage):
+        return {"lineage": item.to_dict()}
+    if isinstance(item, Offer):
+        if item.lineage is not None:
+            return {"offer": item.scrape_dict, "lineage": item.lineage.to_dict()}
+        return {"offer": item.scrape_dict}
+    if isinstance(item, OfferAlert):
+        return {"alert": item.summary, "seen": item.seen}
+    if isinstance(item, OfferChange):
+        return {"change": {"offer": item.offer.scrape_dict, "changes": item.changes, "time": item.change_time}}
+    return item
+
+
+def decode_item(value):
+    """ Function reverses encode_item. """
+    if isinstance(value, dict) and "offer" in value.keys():
+        offer = Offer(value["offer"].get("url"), scrape_dict_arg=value["offer"])
+        if value.get("lineage") is not None:
+            offer.lineage = Lineage.from_dict(value.get("lineage"))
+        return offer
+    if isinstance(value, dict) and "lineage" in value.keys():
+        return Lineage.from_dict(value.get("lineage"))
+    if isinstance(value, dict) and "alert" in value.keys():
+        return OfferAlert(value.get("alert"), value.get("seen"))
+    if isinstance(value, dict) and "change" in value.keys():
+        change = value["change"]
+        return OfferChange(Offer(change["offer"].get("url"), scrape_dict_arg=change["offer"]),
+                           dict([(k, tuple(v)) for (k, v) in change["changes"].items()]), change["time"])
+    return value
+
+
+class SpillFile:
+    """ Append-only file holding queue entries which did not fit into the memory.
+    Entries are read back in the order they were written. """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.read_pos = 0
+        self.pending = 0
+
+        # Leftovers from previous run are not recoverable (the offsets were not saved), so start clean
+        if isfile(file_name):
+            remove(file_name)
+
+    def append(self, entry):
+        """ Writes a single heap entry to the end of the file. """
+        priority, timestamp, _, item = entry
+        with open(self.file_name, "a", encoding="utf-8") as sf:
+            sf.write(json.dumps([priority, timestamp, encode_item(item)]) + "\n")
+        self.pending += 1
+
+    def pop(self):
+        """ Reads the oldest spilled entry. Returns None if there is nothing left. """
+        if self.pending == 0:
+            return None
+
+        with open(self.file_name, "r", encoding="utf-8") as sf:
+            sf.seek(self.read_pos)
+            line = sf.readline()
+            self.read_pos = sf.tell()
+        self.pending -= 1
+
+        # Truncate the file once everything was read back
+        if self.pending == 0:
+            remove(self.file_name)
+            self.read_pos = 0
+
+        priority, timestamp, value = json.loads(line)
+        return priority, timestamp, decode_item(value)
+
+
+class BoundedQueue(Queue):
+    """ Queue with a limited capacity and a backpressure policy which is applied when the queue is full:
+     * block -- put() waits until there is a free slot (regular Queue behaviour),
+     * drop-oldest -- the oldest item of the lowest priority is shed to make room for the new one,
+     * spill -- the item which would be served last is moved to a spill file and read back once there is room again.
+    Items are served by priority and then in the order they were put, or freshest first if it's asked for (e.g. read
+    offers, so that stale offers are the ones which wait or get shed). Consumers which rely on the order (the bot gets
+    an offer's alert before the offer itself) need the former. """
+    def __init__(self, maxsize=1000, policy="block", spill_file=None, freshest_first=False):
+        assert maxsize > 0
+        assert policy in QUEUE_POLICIES
+        assert policy != "spill" or spill_file is not None
+
+        self.policy = policy
+        self.freshest_first = freshest_first
+        self.spill = SpillFile(spill_file) if policy == "spill" else None
+        self.shed = 0     # number of items dropped due to overload
+        self.spilled = 0  # number of items moved to the spill file
+        super().__init__(maxsize)
+
+    # ---------- Queue's storage methods (called with the mutex held) ----------
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = count()
+
+    def _qsize(self):
+        return len(self.queue) + (self.spill.pending if self.spill is not None else 0)
+
+    def _put(self, entry):
+        heapq.heappush(self.queue, entry)
+
+    def _get(self):
+        # Read back spilled entry if the memory is empty
+        if len(self.queue) == 0:
+            self.__unspill()
+
+        item = heapq.heappop(self.queue)[-1]
+
+        # Make use of freed slot
+        if self.spill is not None and self.spill.pending > 0 and len(self.queue) < self.maxsize:
+            self.__unspill()
+
+        return item
+
+    def __unspill(self):
+        priority, timestamp, item = self.spill.pop()
+        heapq.heappush(self.queue, (priority, timestamp, next(self.counter), item))
+
+    def __pop_stalest(self):
+        """ Removes and returns the entry which is pushed out: the one which would be served last, except that the
+        oldest one of the lowest priority is shed by the drop-oldest policy if the items are served in order. """
+        if self.freshest_first or self.policy == "spill":
+            entry = max(self.queue)  # the counter is unique so items themselves are never compared
+        else:
+            entry = max(self.queue, key=lambda queued: (queued[0], -queued[2]))
+        self.queue.remove(entry)
+        heapq.heapify(self.queue)
+        return entry
+
+    # ---------- Public methods ----------
+    def put(self, item, block=True, timeout=None, priority=0):
+        """ Puts item into the queue. Higher priority items are served first.
+        Only the block policy can make this method wait (or raise queue.Full on timeout). """
+        entry = (-priority, -monotonic() if self.freshest_first else 0, next(self.counter), item)
+
+        if self.policy == "block":
+            return super().put(entry, block, timeout)
+
+        with self.not_full:
+            self._put(entry)
+            self.unfinished_tasks += 1
+
+            # Push out the stalest entry (which might be the new one)
+            if len(self.queue) > self.maxsize:
+                stalest = self.__pop_stalest()
+                if self.policy == "drop-oldest":
+                    self.shed += 1
+                    self.unfinished_tasks -= 1
+                else:
+                    self.spill.append(stalest)
+                    self.spilled += 1
+
+            self.not_empty.notify()
+
+    def stats(self):
+        """ Returns the queue's metrics. """
+        with self.mutex:
+            return {
+                "size": self._qsize(),
+                "maxsize": self.maxsize,
+                "policy": self.policy,
+                "shed": self.shed,
+                "spilled": self.spilled,
+                "spill_pending": self.spill.pending if self.spill is not None else 0}
+
+
+class DurableQueue:
+    """ Disk-backed replacement for the Queue. Items are appended to a log split into segment files,
+    a consumer offset is kept for acknowledged items (task_done) and fully acknowledged segments are removed.
+    Items which were put but not acknowledged before a crash are delivered again after restart. Items might be
+    acknowledged out of order (see get_entry), the offset then stays at the oldest one which wasn't acknowledged. """
+    def __init__(self, queue_dir, segment_size=1000, fsync_every=100, fsync_interval=1.0):
+        """
+        :param queue_dir: directory holding the segments and the offsets file
+        :param segment_size: number of entries per segment file
+        :param fsync_every: number of puts after which the segment is synced to the disk
+        :param fsync_interval: maximum time in seconds between two syncs (checked on put)
+        """
+        makedirs(queue_dir, exist_ok=True)
+        self.queue_dir = queue_dir
+        self.offsets_file = join(queue_dir, "offsets.json")
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.pending = deque()    # (id, item) put but not yet delivered
+        self.delivered = {}       # ids delivered but not yet acknowledged (in the order they were delivered)
+        self.unsynced = 0
+        self.last_sync = monotonic()
+
+        # Load the consumer offset (id of the first not acknowledged entry) and ids acknowledged past it
+        self.acked = 0
+        self.done = set()
+        if isfile(self.offsets_file):
+            with open(self.offsets_file, "r", encoding="utf-8") as of:
+                offsets = json.load(of)
+            self.acked = offsets.get("acked")
+            self.done = set(offsets.get("done", []))
+
+        # Replay not acknowledged entries
+        self.next_id = self.acked
+        for segment in self.__segments():
+            with open(join(queue_dir, segment), "r", encoding="utf-8") as sf:
+                for line in sf:
+                    try:
+                        entry_id, value = json.loads(line)
+                    except ValueError:
+                        break  # Torn write at the end of the log
+                    if entry_id >= self.acked and entry_id not in self.done:
+                        self.pending.append((entry_id, decode_item(value)))
+                    self.next_id = max(self.next_id, entry_id + 1)
+
+        self.segment = None
+        self.segment_start = None
+        self.__compact()
+
+    # ---------- Log management ----------
+    def __segments(self):
+        """ Returns segment file names sorted by the first id they hold. """
+        return sorted([f for f in listdir(self.queue_dir) if f.endswith(".log")])
+
+    def __write(self, entry_id, item):
+        # Open a new segment if there is none or the current one is full
+        if self.segment is None or entry_id - self.segment_start >= self.segment_size:
+            if self.segment is not None:
+                self.__sync()
+                self.segment.close()
+            self.segment_start = entry_id
+            self.segment = open(join(self.queue_dir, "%012d.log" % entry_id), "a", encoding="utf-8")
+
+        self.segment.write(json.dumps([entry_id, encode_item(item)]) + "\n")
+        self.unsynced += 1
+
+        self.__maybe_sync()
+
+    def __maybe_sync(self):
+        """ Batched fsync -- syncs only every fsync_every changes or after fsync_interval seconds. """
+        if self.unsynced >= self.fsync_every or monotonic() - self.last_sync >= self.fsync_interval:
+            self.__sync()
+
+    def __sync(self):
+        if self.segment is not None and self.unsynced > 0:
+            self.segment.flush()
+            fsync(self.segment.fileno())
+        self.unsynced = 0
+        self.last_sync = monotonic()
+
+        # Save the offset atomically
+        with open(self.offsets_file + ".tmp", "w", encoding="utf-8") as of:
+            json.dump({"acked": self.acked, "done": sorted(self.done)}, of)
+        replace(self.offsets_file + ".tmp", self.offsets_file)
+
+    def __compact(self):
+        """ Removes segments in which every entry was already acknowledged. """
+        segments = self.__segments()
+        for (segment, next_segment) in zip(segments, segments[1:]):
+            if int(next_segment[:-4]) <= self.acked:
+                remove(join(self.queue_dir, segment))
+        self.acks_since_compact = 0
+
+    # ---------- Queue's interface ----------
+    def put(self, item, block=True, timeout=None, priority=0):
+        """ Appends item to the log. The arguments other than item are accepted for compatibility only. """
+        with self.mutex:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.__write(entry_id, item)
+            self.pending.append((entry_id, item))
+            self.not_empty.notify()
+
+    def get_entry(self, block=True, timeout=None):
+        """ Returns (id, item) of the oldest not delivered item, so it can be acknowledged by its id.
+        Raises queue.Empty like the Queue does. """
+        with self.not_empty:
+            if not block:
+                if len(self.pending) == 0:
+                    raise Empty
+            elif not self.not_empty.wait_for(lambda: len(self.pending) > 0, timeout):
+                raise Empty
+
+            entry_id, item = self.pending.popleft()
+            self.delivered[entry_id] = None
+            return entry_id, item
+
+    def get(self, block=True, timeout=None):
+        """ Returns the oldest not delivered item. Raises queue.Empty like the Queue does. """
+        return self.get_entry(block, timeout)[1]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self, entry_id=None):
+        """ Acknowledges the delivered item with given id (the oldest delivered one by default), so it won't be
+        delivered again after restart. """
+        with self.mutex:
+            if len(self.delivered) == 0:
+                raise ValueError("task_done() called too many times")
+            if entry_id is None:
+                entry_id = next(iter(self.delivered))
+            if entry_id not in self.delivered.keys():
+                raise ValueError("entry %s wasn't delivered or was already acknowledged" % entry_id)
+            del self.delivered[entry_id]
+            acked = next(iter(self.delivered)) if len(self.delivered) > 0 else \
+                (self.pending[0][0] if len(self.pending) > 0 else self.next_id)
+
+            # Items acknowledged past the offset are remembered until the offset passes them
+            if entry_id > acked:
+                self.done.add(entry_id)
+            elif acked != self.acked and len(self.done) > 0:
+                self.done = set([done_id for done_id in self.done if done_id > acked])
+            self.acked = acked
+            self.unsynced += 1
+            self.acks_since_compact += 1
+            self.__maybe_sync()
+
+            # Compact once per segment
+            if self.acks_since_compact >= self.segment_size:
+                self.__sync()
+                self.__compact()
+
+    def qsize(self):
+        return len(self.pending)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        """ Syncs the log and the offset to the disk. """
+        with self.mutex:
+            self.__sync()
+            self.__compact()
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+    def stats(self):
+        """ Returns the queue's metrics. """
+        with self.mutex:
+            return {
+                "size": len(self.pending),
+                "unacked": len(self.delivered),
+                "acked": self.acked,
+                "acked_ahead": len(self.done),
+                "segments": len(self.__segments())}
+
+
+class ShardedQueue:
+    """ Producer side of a set of queues. Every item is put into a shard chosen by its hash,
+    so the same offer URL always ends up at the same consumer (e.g. worker process). """
+    def __init__(self, shards):
+        self.shards = shards
+
+    def shard_of(self, item):
+        """ Returns index of the shard for given item. Uses crc32 since hash() differs between processes. """
+        return crc32(str(item).encode("utf-8")) % len(self.shards)
+
+    def put(self, item, block=True, timeout=None, priority=0):
+        self.shards[self.shard_of(item)].put(item, block, timeout)
+
+    def qsize(self):
+        return sum([shard.qsize() for shard in self.shards])
+
+    def empty(self):
+        return self.qsize() == 0
@@ -0,0 +1,164 @@
+from classes import StoppableThread
+from methods import read_pages
+from os.path import getmtime, isfile
+from queues import BoundedQueue
+from threading import Lock, current_thread
+from time import sleep
+from utils import get_url
+import json
+
+
+class TrackingConfigException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def load_tracking(config_file):
+    """ Reads the tracking config file. It is a .json file with a list of readers, e.g.:
+    {"readers": [{"url": "https://www.olx.pl/nieruchomosci/mieszkania/wynajem/malopolskie/", "interval": 60},
+                 {"page": "gumtree", "mode": "rooms", "interval": 30, "priority": 1}]}
+    Returns dictionary url -> {"interval": seconds between refreshes, "priority": priority of the read offers}. """
+    try:
+        with open(config_file, "r", encoding="utf-8") as cf:
+            config = json.load(cf)
+
+        readers = {}
+        for entry in config.get("readers", []):
+            url = entry.get("url") or get_url(entry.get("page"), entry.get("mode"))
+            readers[url] = {"interval": max(int(entry.get("interval", 30)), 1),
+                            "priority": int(entry.get("priority", 0))}
+        return readers
+
+    except (OSError, ValueError, AttributeError, AssertionError) as err:
+        raise TrackingConfigException("incorrect tracking config file: %s" % err)
+
+
+class ReaderPool:
+    """ Set of page readers defined by the tracking config file, which can be changed while the scraper runs.
+    Readers of new URLs are started, readers of removed ones are stopped and the others are retuned in place
+    (they keep their last read page, so no offers are missed or read twice). All readers share the read queue,
+    so the workers, the deduplication and the output are the same as for the readers given at startup. """
+    def __init__(self, config_file, thread_statuses, q_read, runner_class=StoppableThread, dict_factory=dict,
+                 first_id=0, prefilter=None, q_alerts=None):
+        """
+        :param config_file: tracking config file (see load_tracking)
+        :param thread_statuses: used for debugging and checking up on threads
+        :param q_read: queue of read offers
+        :param runner_class: StoppableThread or StoppableProcess
+        :param dict_factory: creates readers' tuning dictionaries (must be shared between processes if they are used)
+        :param first_id: number of the first reader (readers given at startup come first)
+        :param prefilter: optional ListingPrefilter passed to the readers
+        :param q_alerts: optional queue of alerts about new offers passed to the readers
+        """
+        self.config_file = config_file
+        self.thread_statuses = thread_statuses
+        self.q_read = q_read
+        self.runner_class = runner_class
+        self.dict_factory = dict_factory
+        self.next_id = first_id
+        self.prefilter = prefilter
+        self.q_alerts = q_alerts
+
+        self.lock = Lock()
+        self.readers = {}   # url -> (runner, tuning)
+        self.stopping = []  # runners which were stopped but might still be finishing
+        self.mtime = None
+        self.reloads = 0
+        self.errors = 0
+
+    def check(self):
+        """ Reloads the config if the file was changed since the last check. Returns whether it was reloaded. """
+        mtime = getmtime(self.config_file) if isfile(self.config_file) else None
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        self.reload()
+        return True
+
+    def reload(self):
+        """ Applies the config file to the running readers. A broken config leaves them as they are. """
+        try:
+            config = load_tracking(self.config_file)
+        except TrackingConfigException:
+            self.errors += 1
+            raise
+
+        # Priorities are supported only by the bounded queue
+        if not isinstance(self.q_read, BoundedQueue):
+            for settings in config.values():
+                settings["priority"] = 0
+
+        with self.lock:
+            for url in [url for url in self.readers.keys() if url not in config.keys()]:
+                runner, _ = self.readers.pop(url)
+                runner.stop()
+                self.stopping.append(runner)
+
+            for (url, settings) in config.items():
+                if url in self.readers.keys():
+                    self.readers[url][1].update(settings)
+                    continue
+
+                tuning = self.dict_factory()
+                tuning.update(settings)
+                runner = self.runner_class(
+                    target=read_pages,
+                    args=(self.thread_statuses, url, self.q_read, settings.get("interval"),
+                          settings.get("priority"), tuning, self.prefilter, self.q_alerts),
+                    name="Reader %d" % self.next_id)
+                self.next_id += 1
+                self.readers[url] = (runner, tuning)
+                runner.start()
+
+            self.reloads += 1
+
+    def reap(self):
+        """ Forgets readers which were stopped and have already finished. """
+        with self.lock:
+            for runner in [runner for runner in self.stopping if not runner.is_alive()]:
+                self.stopping.remove(runner)
+                self.thread_statuses.pop(runner.name, None)
+
+    def stop(self):
+        """ Stops all readers and waits for them. """
+        with self.lock:
+            self.stopping += [runner for (runner, _) in self.readers.values()]
+            self.readers = {}
+            for runner in self.stopping:
+                runner.stop()
+            for runner in self.stopping:
+                runner.join()
+            self.stopping = []
+
+    def stats(self):
+        """ Returns the pool's metrics. """
+        with self.lock:
+            return {"readers": len(self.readers), "stopping": len(self.stopping), "reloads": self.reloads,
+                    "errors": self.errors}
+
+
+def reader_pool_runner(thread_statuses, pool, check_interval=5):
+    """ Function keeps the reader pool in line with its config file until the thread is stopped.
+    :param thread_statuses: used for debugging and checking up on threads
+    :param pool: ReaderPool
+    :param check_interval: time in seconds between checks of the config file
+    """
+    thread_statuses[current_thread().name] = "Booting"
+
+    while not current_thread().is_stopped():
+        thread_statuses[current_thread().name] = "Watching"
+        try:
+            if pool.check():
+                thread_statuses[current_thread().name] = "Reloaded"
+        except TrackingConfigException:
+            thread_statuses[current_thread().name] = "Config error"
+        pool.reap()
+
+        for _ in range(check_interval):
+            sleep(1)
+            if current_thread().is_stopped():
+                break
+
+    thread_statuses[current_thread().name] = "Stopping"
+    pool.stop()
+    thread_statuses[current_thread().name] = "Stopped"
@@ -0,0 +1,193 @@
+from classes import Offer, TokenBucket
+from datetime import datetime as dt
+from gazetteer import canonical_location
+from os.path import isfile
+from scrapers.scrapers_master import ScraperMissingException
+from threading import Lock, current_thread
+from time import sleep, time
+from utils import GetPageException, read_new_rows
+import heapq
+import json
+
+
+REVISIT_FIELDS = ["is_room", "price", "loc", "rooms_info", "rooms", "size", "preferred_group", "sharing_type",
+                  "room_type"]  # fields compared between visits
+
+
+def _as_str(value):
+    """ Values are compared the way they are saved in the output file (None is saved as an empty string). """
+    return "" if value is None else str(value)
+
+
+class OfferChange:
+    """ Change of an already known offer which was found by a revisit. """
+    def __init__(self, offer, changes, change_time=None):
+        """
+        :param offer: the offer as it was read during the revisit
+        :param changes: dictionary field -> (old value, new value)
+        :param change_time: when the change was found
+        """
+        self.offer = offer
+        self.changes = changes
+        self.change_time = change_time if change_time is not None else dt.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def __repr__(self):
+        return "OfferChange('%s', %s)" % (self.offer.url, self.changes)
+
+    def describe(self):
+        """ Returns list of human-readable descriptions of the changes. """
+        descriptions = []
+        for (field, (old, new)) in self.changes.items():
+            if field == "price" and (old or "").isdigit() and new.isdigit():
+                descriptions.append("Price %s by %d zł (%s -> %s)" % (
+                    ["rose", "dropped"][int(new) < int(old)], abs(int(new) - int(old)), old, new))
+            else:
+                descriptions.append("%s changed: %s -> %s" % (field.capitalize(), old or "b/d", new or "b/d"))
+        return descriptions
+
+
+class RevisitScheduler:
+    """ Keeps the known offers and decides when each of them should be fetched again.
+    The interval between visits grows with the offer's age -- fresh offers are visited often, old ones rarely. """
+    def __init__(self, db_file, changes_file=None, min_interval=1800, max_interval=7 * 86400, max_age=30 * 86400,
+                 age_factor=0.25):
+        """
+        :param db_file: output file (any of its parts) with known offers
+        :param changes_file: JSON lines file where found changes are saved (and replayed from on start)
+        :param min_interval: shortest interval in seconds between two visits
+        :param max_interval: longest interval in seconds between two visits
+        :param max_age: offers older than this (in seconds) are no longer visited
+        :param age_factor: interval is this fraction of the offer's age
+        """
+        self.db_file = db_file
+        self.changes_file = changes_file
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_age = max_age
+        self.age_factor = age_factor
+
+        self.lock = Lock()
+        self.records = {}  # url -> (first seen timestamp, last known values)
+        self.heap = []     # (next visit timestamp, url)
+        self.offsets = {}  # output part -> number of bytes already read
+        self.changes_replayed = False
+
+    def next_visit(self, first_seen, now):
+        """ Returns timestamp of the next visit of an offer first seen at given time (None if it is too old). """
+        age = now - first_seen
+        if age > self.max_age:
+            return None
+        return now + min(self.max_interval, max(self.min_interval, age * self.age_factor))
+
+    def refresh(self):
+        """ Loads offers saved since the last refresh (so offers saved by any worker get scheduled). """
+        now = time()
+        for row in read_new_rows(self.db_file, self.offsets):
+            try:
+                first_seen = dt.strptime(row.get("scrape_time"), "%Y-%m-%d %H:%M:%S").timestamp()
+            except (TypeError, ValueError):
+                continue
+
+            with self.lock:
+                if row.get("url") in self.records.keys():
+                    continue
+                values = dict([(f, row.get(f)) for f in REVISIT_FIELDS])
+                values["loc"] = _as_str(canonical_location(values.get("loc")))  # rows saved before normalization
+                self.records[row.get("url")] = (first_seen, values)
+                visit = self.next_visit(first_seen, now)
+                if visit is not None:
+                    heapq.heappush(self.heap, (visit, row.get("url")))
+
+        # Replay changes found before restart so we compare with the latest values
+        if self.changes_file is not None and isfile(self.changes_file) and not self.changes_replayed:
+            with open(self.changes_file, "r", encoding="utf-8") as cf:
+                for line in cf:
+                    record = json.loads(line)
+                    if record.get("url") in self.records.keys():
+                        for (field, (old, new)) in record.get("changes").items():
+                            self.records[record.get("url")][1][field] = new
+        self.changes_replayed = True
+
+        return self
+
+    def pop_due(self):
+        """ Returns URL of an offer which should be visited now or None if there is none. """
+        with self.lock:
+            if len(self.heap) > 0 and self.heap[0][0] <= time():
+                return heapq.heappop(self.heap)[1]
+        return None
+
+    def reschedule(self, url):
+        """ Schedules the next visit of the offer (unless it is too old already). """
+        with self.lock:
+            visit = self.next_visit(self.records[url][0], time())
+            if visit is not None:
+                heapq.heappush(self.heap, (visit, url))
+
+    def update(self, offer):
+        """ Compares revisited offer with its last known values. Returns OfferChange or None if nothing changed. """
+        with self.lock:
+            first_seen, values = self.records[offer.url]
+            changes = dict([
+                (f, (values.get(f), _as_str(getattr(offer, f))))
+                for f in REVISIT_FIELDS if values.get(f) != _as_str(getattr(offer, f))])
+            if len(changes) == 0:
+                return None
+
+            for (field, (old, new)) in changes.items():
+                values[field] = new
+
+        change = OfferChange(offer, changes)
+        if self.changes_file is not None:
+            with open(self.changes_file, "a", encoding="utf-8") as cf:
+                cf.write(json.dumps({"url": offer.url, "time": change.change_time, "changes": changes}) + "\n")
+
+        return change
+
+    def stats(self):
+        """ Returns the scheduler's metrics. """
+        with self.lock:
+            return {"known": len(self.records), "scheduled": len(self.heap)}
+
+
+def revisit_runner(thread_statuses, scheduler, q_offers, rate=0.1, refresh_interval=300):
+    """ Function revisits known offers on the scheduler's schedule and passes found changes to the bot.
+    It has its own request budget and runs next to the readers and the worker, so it never delays new offers.
+    :param thread_statuses: used for debugging and checking up on threads
+    :param scheduler: RevisitScheduler with known offers
+    :param q_offers: queue of offers (and offer changes) passed to bot
+    :param rate: maximum number of revisits per second
+    :param refresh_interval: time in seconds between loading newly saved offers
+    """
+    thread_statuses[current_thread().name] = "Booting"
+    budget = TokenBucket(rate)
+    last_refresh = 0
+
+    while not current_thread().is_stopped():
+        # Schedule newly saved offers
+        if time() - last_refresh > refresh_interval:
+            thread_statuses[current_thread().name] = "Loading"
+            scheduler.refresh()
+            last_refresh = time()
+
+        # Take an offer only if the budget allows to visit it now
+        url = scheduler.pop_due() if budget.wait_time() == 0 else None
+        if url is None:
+            thread_statuses[current_thread().name] = "Waiting"
+            sleep(1)
+            continue
+
+        # Revisiting the offer
+        thread_statuses[current_thread().name] = "Revisit"
+        budget.try_acquire()
+        try:
+            change = scheduler.update(Offer(url))
+            if change is not None:
+                q_offers.put(change)
+        except ScraperMissingException:
+            pass
+        except GetPageException:
+            pass
+        scheduler.reschedule(url)
+
+    thread_statuses[current_thread().name] = "Stopped"
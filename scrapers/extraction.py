@@ -0,0 +1,254 @@
+from ast import literal_eval
+from gazetteer import normalize_location
+from geo import geocode
+from threading import Lock
+from urllib.parse import urlparse
+import re
+
+# Note: cssselect, lxml and pyquery are imported only when a plan is run for the first time (see the utils' note).
+
+
+# Errors which make a field fall back to its default value (e.g. missing element or a number which isn't there)
+FIELD_ERRORS = (ValueError, TypeError, AttributeError, IndexError, KeyError, SyntaxError)
+
+
+class ExtractionSpecException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def _digits(_):
+    return lambda value, context: int("".join([d for d in value if d.isdigit()]))
+
+
+def _regex(pattern):
+    compiled = re.compile(pattern)
+    return lambda value, context: compiled.search(value).group()
+
+
+def _int(empty=None):
+    """ Integer (an empty string is converted to the given value if there is one). """
+    return lambda value, context: empty if value == "" and empty is not None else int(value)
+
+
+def _float(_):
+    return lambda value, context: float(value)
+
+
+def _slice(bounds):
+    return lambda value, context: value[slice(*bounds)]
+
+
+def _contains(text):
+    return lambda value, context: value.find(text) != -1
+
+
+def _split(separator):
+    return lambda value, context: value.split(separator)
+
+
+def _item(key):
+    return lambda value, context: value[key]
+
+
+def _literal(_):
+    return lambda value, context: literal_eval(value)
+
+
+def _location(strict=None):
+    """ Canonical location or the first part of the raw location if it is unknown (or None if it's strict). """
+    if strict:
+        return lambda value, context: normalize_location(value)
+    first_part = re.compile("^[^,]*")
+    return lambda value, context: normalize_location(value) or first_part.search(value).group()
+
+
+def _centroid(coordinate):
+    """ Latitude or longitude (the argument) of the location's centroid (see geo.geocode). """
+    index = ["lat", "lon"].index(coordinate)
+    return lambda value, context: geocode(value)[index]
+
+
+def _text(_):
+    """ Text with whitespace (e.g. line breaks) collapsed to single spaces (None if nothing is left). """
+    return lambda value, context: " ".join(value.split()) or None
+
+
+def _template(template):
+    """ Formats the value into the template; {origin} is the scheme and host of the page (e.g. to make URLs). """
+    return lambda value, context: template.format(value=value, **context)
+
+
+# Converter name -> function creating the converter from its argument (converters take the value and page's context)
+CONVERTERS = {
+    "digits": _digits,
+    "regex": _regex,
+    "int": _int,
+    "float": _float,
+    "slice": _slice,
+    "contains": _contains,
+    "split": _split,
+    "item": _item,
+    "literal": _literal,
+    "location": _location,
+    "centroid": _centroid,
+    "text": _text,
+    "template": _template
+}
+
+
+def element_text(element):
+    """ Text of the element the way requests_html (PyQuery) returns it, i.e. with block elements on separate lines. """
+    from pyquery.text import extract_text
+    return extract_text(element)
+
+
+def document_root(page):
+    """ Returns root element of the page (requests_html's HTML or raw HTML parsed the same way requests_html does). """
+    if isinstance(page, (str, bytes)):
+        from pyquery import PyQuery
+        return PyQuery(page)("html")[0]
+    return page.element[0]
+
+
+class ExtractionPlan:
+    """ Extraction spec compiled into a plan which is run on every page. The spec is plain data, e.g.:
+    {"price": {"select": "div[class=price]", "convert": ["digits"]},
+     "_details": {"pairs": {"keys": "span[class=name]", "values": "span[class=value]"}},
+     "rooms": {"from": "_details", "key": "Liczba pokoi", "convert": [["regex", "[0-9]*"], ["int", 0]]}}
+    Every field takes its value from one source:
+        select  -- CSS selector; pick the first (default), the last or all elements, optionally go down to
+                   the first element matching "then" and take the "attr" attribute (text by default)
+        pairs   -- dictionary made of "rows" split by "sep" or of zipped "keys" and "values" elements
+        from    -- value of an earlier field or "url" (optionally its "key" if it is a dictionary)
+        value   -- a constant
+        each    -- CSS selector of rows (e.g. offers on a listing); every row is extracted by the nested spec
+                   given in "fields", which results in a list of dictionaries
+    then the converters are applied (to every item if all elements were picked). A missing value or a conversion
+    error results in the alternative field spec given in "or" (e.g. coordinates from the map, or else location's
+    centroid) and then in the field's default (None unless given). Fields starting with _ are not returned.
+    Selectors (translated to XPath) and regexes are compiled once and every distinct selector is evaluated once
+    per page. The spec is checked right away, while the selectors are compiled when the plan is run for the first time
+    (so importing the scrapers stays cheap). """
+    def __init__(self, spec):
+        """
+        :param spec: dictionary field -> field spec (fields are returned in the same order)
+        """
+        self.selectors = {}  # (CSS selector, XPath prefix) -> compiled XPath (None until the plan is compiled)
+        self.compiled = False
+        self.lock = Lock()
+        self.fields = [(name, self.__compile_field(name, field_spec)) for (name, field_spec) in spec.items()]
+
+    def __selector(self, css, prefix="descendant-or-self::"):
+        key = (css, prefix)
+        self.selectors[key] = None
+        return key
+
+    def compile(self):
+        """ Translates the selectors to compiled XPath expressions. """
+        from cssselect import HTMLTranslator
+        from lxml.etree import XPath
+
+        with self.lock:
+            if not self.compiled:
+                translator = HTMLTranslator()
+                for (css, prefix) in self.selectors.keys():
+                    self.selectors[(css, prefix)] = XPath(translator.css_to_xpath(css, prefix=prefix))
+                self.compiled = True
+
+    def __compile_field(self, name, field_spec):
+        """ Returns (value getter, list of converters, whether converters are applied to every item, default,
+        alternative field (compiled the same way) or None). """
+        sources = [source for source in ["select", "pairs", "from", "value", "each"] if source in field_spec.keys()]
+        if len(sources) != 1:
+            raise ExtractionSpecException("field %s must have exactly one of select, pairs, from, value and each"
+                                          % name)
+
+        converters = []
+        for converter in field_spec.get("convert", []):
+            converter_name, arg = (converter, None) if isinstance(converter, str) else converter
+            if converter_name not in CONVERTERS.keys():
+                raise ExtractionSpecException("field %s uses unknown converter %s" % (name, converter_name))
+            converters.append(CONVERTERS[converter_name](arg))
+
+        pick = field_spec.get("pick", "first")
+        if pick not in ["first", "last", "all"]:
+            raise ExtractionSpecException("field %s picks %s (first, last or all expected)" % (name, pick))
+
+        default = field_spec.get("default")
+        alternative = self.__compile_field(name, field_spec.get("or")) if "or" in field_spec.keys() else None
+        return self.__getter(field_spec, sources[0], pick), converters, pick == "all", default, alternative
+
+    def __getter(self, field_spec, source, pick):
+        """ Returns function reading the field's raw value from (cached selector results, values, context). """
+        if source == "value":
+            return lambda found, values, context: field_spec.get("value")
+
+        if source == "from":
+            origin, key = field_spec.get("from"), field_spec.get("key")
+            if key is None:
+                return lambda found, values, context: values.get(origin, context.get(origin))
+            return lambda found, values, context: (values.get(origin) or {}).get(key)
+
+        if source == "each":
+            rows, row_plan = self.__selector(field_spec.get("each")), ExtractionPlan(field_spec.get("fields", {}))
+            return lambda found, values, context: [row_plan.run(e, context.get("url")) for e in found(rows)]
+
+        if source == "pairs":
+            pairs = field_spec.get("pairs")
+            if "rows" in pairs.keys():
+                rows, sep = self.__selector(pairs.get("rows")), pairs.get("sep", "\n")
+                return lambda found, values, context: dict([element_text(e).split(sep) for e in found(rows)])
+            keys, vals = self.__selector(pairs.get("keys")), self.__selector(pairs.get("values"))
+            return lambda found, values, context: dict(zip([element_text(e) for e in found(keys)],
+                                                           [element_text(e) for e in found(vals)]))
+
+        # Reading elements' text or attribute
+        selector = self.__selector(field_spec.get("select"))
+        then = self.__selector(field_spec.get("then"), "descendant::") if "then" in field_spec.keys() else None
+        attr = field_spec.get("attr")
+
+        def __read(element):
+            if then is not None:
+                element = self.selectors[then](element)[0]
+            return element_text(element) if attr is None else element.attrib[attr]
+
+        if pick == "all":
+            return lambda found, values, context: [__read(e) for e in found(selector)]
+        index = 0 if pick == "first" else -1
+        return lambda found, values, context: __read(found(selector)[index]) if len(found(selector)) > 0 else None
+
+    def run(self, page, url):
+        """ Extracts the fields from the page (requests_html's HTML, raw HTML or a root element). Returns dict. """
+        if page is None:
+            raise ValueError("There is no page to extract the fields from: %s" % url)
+        if not self.compiled:
+            self.compile()
+        root = document_root(page) if isinstance(page, (str, bytes)) or hasattr(page, "element") else page
+        parsed_url = urlparse(url)
+        context = {"url": url, "origin": "%s://%s" % (parsed_url.scheme, parsed_url.netloc)}
+        cache = {}
+
+        def __found(selector):
+            if selector not in cache.keys():
+                cache[selector] = self.selectors[selector](root)
+            return cache[selector]
+
+        def __value(field, values):
+            getter, converters, each, default, alternative = field
+            try:
+                value = getter(__found, values, context)
+                if value is not None:
+                    for converter in converters:
+                        value = [converter(v, context) for v in value] if each else converter(value, context)
+            except FIELD_ERRORS:
+                value = None
+            if value is None and alternative is not None:
+                return __value(alternative, values)
+            return default if value is None else value
+
+        values = {}
+        for (name, field) in self.fields:
+            values[name] = __value(field, values)
+
+        return dict([(name, value) for (name, value) in values.items() if not name.startswith("_")])
@@ -1,100 +1,60 @@
+from archive import archive_page
+from scrapers.extraction import ExtractionPlan
 from utils import get_page
-import re
 
 
-def scraper_main_gumtree(url):
+# Page with offers
+GUMTREE_LISTING_SPEC = {
+    "offers_urls": {"select": "div[class='view'] div[class='title'] a", "pick": "all", "attr": "href",
+                    "convert": [["template", "{origin}{value}"]]},
+    # Information shown on the listing (used to decide whether offer's page is worth fetching right away)
+    "offers_summaries": {"each": "div[class='view'] div.tileV1", "fields": {
+        "url": {"select": "div[class='title'] a", "attr": "href", "convert": [["template", "{origin}{value}"]]},
+        "is_room": {"from": "url", "convert": [["contains", "pokoje-do-wynajecia"]]},
+        "title": {"select": "div[class='title'] a"},
+        "price": {"select": "div[class=price] span[class=value]", "convert": ["digits"]},
+        "loc": {"select": "div[class=category-location] span", "convert": [["location", True]]}}}
+}
+
+# Offer's page (images are listed in the gallery's data, e.g. {"large": "[url1, url2]"})
+GUMTREE_OFFER_SPEC = {
+    "url": {"from": "url"},
+    "_attributes": {"pairs": {"keys": "div[class=vip-details] span[class=name]",
+                              "values": "div[class=vip-details] span[class=value]"}, "default": {}},
+    "is_room": {"from": "url", "convert": [["contains", "pokoje-do-wynajecia"]]},
+    "price": {"select": "div[class=vip-content-header] span[class=value]", "convert": ["digits"]},
+    "loc": {"from": "_attributes", "key": "Lokalizacja", "convert": ["location"]},
+    "rooms_info": {"from": "_attributes", "key": "Liczba pokoi"},
+    "rooms": {"from": "_attributes", "key": "Liczba pokoi", "convert": [["regex", "[0-9]*"], ["int", 0]]},
+    "size": {"from": "_attributes", "key": "Wielkość (m2)", "convert": ["int"]},
+    "images_urls_list": {"select": "script[id=vip-gallery-data]",
+                         "convert": ["literal", ["item", "large"], ["slice", [1, -1]], ["split", ", "]]},
+    "preferred_group": {"from": "_attributes", "key": "Preferowana płeć"},
+    "sharing_type": {"from": "_attributes", "key": "Współdzielenie"},
+    "room_type": {"value": None},
+    "description": {"select": "div[class=description]", "convert": ["text"]},
+    # Coordinates of the map's link (e.g. https://www.google.com/maps?q=52.21,20.98) or the location's centroid
+    "_coordinates": {"select": "span[class=google-maps-link]", "attr": "data-uri",
+                     "convert": [["regex", "-?[0-9.]+,-?[0-9.]+$"], ["split", ","]]},
+    "lat": {"from": "_coordinates", "convert": [["item", 0], "float"],
+            "or": {"from": "_attributes", "key": "Lokalizacja", "convert": [["centroid", "lat"]]}},
+    "lon": {"from": "_coordinates", "convert": [["item", 1], "float"],
+            "or": {"from": "_attributes", "key": "Lokalizacja", "convert": [["centroid", "lon"]]}}
+}
+
+GUMTREE_LISTING_PLAN = ExtractionPlan(GUMTREE_LISTING_SPEC)
+GUMTREE_OFFER_PLAN = ExtractionPlan(GUMTREE_OFFER_SPEC)
+
+
+def scraper_main_gumtree(url, page=None):
     """ Reads pages with offers from GumTree and provides URLS to said offers. """
+    return {"url": url, **GUMTREE_LISTING_PLAN.run(get_page(url) if page is None else page, url)}
 
-    # Loading the page
-    page = get_page(url)
 
-    # Putting the offer's URLs together
-    offers = page.element("div[class='view'] div[class='title'] a")
-
-    return {
-        "url": url,
-        "offers_urls": ["https://www.gumtree.pl" + off.attrib.get("href") for off in offers]
-    }
-
-
-def scraper_gumtree(url):
+def scraper_gumtree(url, page=None):
     """ Extracts the relevant information from provided offer page. """
-    page = get_page(url)
-
-    # Extracting price
-    try:
-        price = int("".join([
-            d for d
-            in page.find("div[class=vip-content-header] span[class=value]", first=True).text
-            if d.isdigit()
-        ]))
-    except ValueError:
-        price = None
-    except AttributeError:
-        price = None
-
-    # Extracting images' url list
-    try:
-        url_img_dict = dict(eval(
-            page.find("script[id=vip-gallery-data]", first=True).text
-        ))
-        url_img_large_str = url_img_dict["large"]
-        url_img_list = (url_img_large_str[1:-1]).split(", ")
-    except Exception:
-        url_img_list = None
-
-    # Extracting attributes' name and values
-    attr_dict = dict(zip(
-        [name.text for name in page.find("div[class=vip-details] span[class=name]")],
-        [val.text for val in page.find("div[class=vip-details] span[class=value]")]
-    ))
-
-    # Adding the localisation if it wasn't added before
-    if "Lokalizacja" in attr_dict.keys():
-        loc = re.search("[^,]*", attr_dict["Lokalizacja"]).group()
-    else:
-        loc = None
-
-    # Reading number of rooms
-    rooms = attr_dict.get("Liczba pokoi")
-    try:
-        if rooms is None:
-            rooms_number = None
-        else:
-            rooms_number_raw = re.search("[0-9]*", rooms).group()
-            rooms_number = int(rooms_number_raw) if len(rooms_number_raw) > 0 else 0
-    except ValueError:
-        rooms_number = None
-    except TypeError:
-        rooms_number = None
-
-    # Saving flat's measurement
-    try:
-        size = int(attr_dict.get("Wielkość (m2)"))
-    except ValueError:
-        size = None
-    except TypeError:
-        size = None
-
-    # Checking if it's room offer
-    is_room = url.find("pokoje-do-wynajecia") != -1
-
-    # Reading room's preference
-    preferred_group = attr_dict.get("Preferowana płeć")
-
-    # Reading what is being shared
-    sharing_type = attr_dict.get("Współdzielenie")
-
-    return {
-        "url": url,
-        "is_room": is_room,
-        "price": price,
-        "loc": loc,
-        "rooms_info": rooms,
-        "rooms": rooms_number,
-        "size": size,
-        "images_urls_list": url_img_list,
-        "preferred_group": preferred_group,
-        "sharing_type": sharing_type,
-        "room_type": None
-    }
+    # Fetched pages are archived, so the offer can be extracted again later
+    if page is None:
+        page = get_page(url)
+        archive_page(url, page)
+    return GUMTREE_OFFER_PLAN.run(page, url)
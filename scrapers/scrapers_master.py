@@ -1,5 +1,5 @@
 from datetime import datetime
-from utils import SUPPORTED_PAGES
+from utils import SUPPORTED_PAGES, GetPageException
 from scrapers.scrapers_gumtree import *
 from scrapers.scrapers_olx import *
 
@@ -9,14 +9,18 @@ class ScraperMissingException(Exception):
         super().__init__(message)
 
 
-def scraper_master(url, offer):
+def scraper_master(url, offer, page=None):
+    """ Scrapes the page with given URL using the scraper of its site.
+    An already fetched page (e.g. an archived one) might be provided, so it isn't fetched again. """
 
     for page_name in SUPPORTED_PAGES:
         if url.find("%s." % page_name) != -1:
             try:
-                response = eval("scraper_%s%s('%s')" % ("main_" if not offer else "", page_name, url))
+                response = globals()["scraper_%s%s" % ("main_" if not offer else "", page_name)](url, page)
                 response["scrape_time"] = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
                 return response
+            except GetPageException:
+                raise  # the page couldn't be retrieved (e.g. the host is blocked), the scraper isn't to blame
             except Exception as err:
                 pass
 
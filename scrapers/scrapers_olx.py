@@ -1,121 +1,59 @@
+from archive import archive_page
+from scrapers.extraction import ExtractionPlan
 from utils import get_page
-import re
 
 
-def scraper_main_olx(url):
+# Page with offers: offers' ids are the end of their tables' class (e.g. "fixed breakword ad_idXYZ")
+OLX_OFFER_URL = [["regex", "[^_]*$"], ["slice", [2, None]], ["template", "{origin}/oferta/CID3-ID{value}.html"]]
+OLX_LISTING_SPEC = {
+    "offers_urls": {"select": "table[id=offers_table] table[summary=Ogłoszenie]", "pick": "all", "attr": "class",
+                    "convert": OLX_OFFER_URL},
+    # Information shown on the listing (used to decide whether offer's page is worth fetching right away)
+    "offers_summaries": {"each": "table[id=offers_table] table[summary=Ogłoszenie]", "fields": {
+        "is_room": {"from": "url", "convert": [["contains", "stancje-pokoje"]]},  # listing's URL (url isn't set yet)
+        "url": {"select": "table", "attr": "class", "convert": OLX_OFFER_URL},
+        "title": {"select": "a"},
+        "price": {"select": "p[class=price]", "convert": ["digits"]},
+        "loc": {"select": "small.breadcrumb span", "pick": "last", "convert": [["location", True]]}}}
+}
+
+# Offer's page
+OLX_OFFER_SPEC = {
+    "url": {"from": "url"},
+    "_attributes": {"pairs": {"rows": "div[id=offerdescription] table[class=item]", "sep": "\n"}, "default": {}},
+    "is_room": {"select": "div[class='wrapper'] td li", "pick": "last", "then": "a", "attr": "href",
+                "convert": [["contains", "stancje-pokoje"]]},
+    "price": {"select": "div[class=price-label]", "convert": ["digits"]},
+    "loc": {"select": "a[class=show-map-link]", "convert": ["location"]},
+    "rooms_info": {"from": "_attributes", "key": "Liczba pokoi"},
+    "rooms": {"from": "_attributes", "key": "Liczba pokoi", "convert": [["regex", "[0-9]*"], ["int", 0]]},
+    "size": {"from": "_attributes", "key": "Powierzchnia", "convert": [["regex", "[0-9]*"], "int"]},
+    "images_urls_list": {"select": "div[class=photo-glow] img", "pick": "all", "attr": "src",
+                         "convert": [["regex", "[^;]*"]]},
+    "preferred_group": {"from": "_attributes", "key": "Preferowani"},
+    "sharing_type": {"value": None},
+    "room_type": {"from": "_attributes", "key": "Rodzaj pokoju"},
+    "description": {"select": "div[id=textContent]", "convert": ["text"]},
+    # Coordinates shown on the map (or the centroid of the location if there is no map)
+    "lat": {"select": "div[id=mapcontainer]", "attr": "data-lat", "convert": ["float"],
+            "or": {"select": "a[class=show-map-link]", "convert": [["centroid", "lat"]]}},
+    "lon": {"select": "div[id=mapcontainer]", "attr": "data-lon", "convert": ["float"],
+            "or": {"select": "a[class=show-map-link]", "convert": [["centroid", "lon"]]}}
+}
+
+OLX_LISTING_PLAN = ExtractionPlan(OLX_LISTING_SPEC)
+OLX_OFFER_PLAN = ExtractionPlan(OLX_OFFER_SPEC)
+
+
+def scraper_main_olx(url, page=None):
     """ Reads pages with offers from OLX and provides URLS to said offers. """
+    return {"url": url, **OLX_LISTING_PLAN.run(get_page(url) if page is None else page, url)}
 
-    def __create_url_olx(offs_ids, prefix="https://www.olx.pl"):
-        """ Method creates an olx offer link from parts read from a main page. """
-        return [
-            "/".join([
-                prefix,
-                "oferta",
-                "CID3-ID" + o_id + ".html"
-            ])
-            for o_id in offs_ids
-        ]
 
-    # Loading the page
-    page = get_page(url)
-
-    # Reading the offers' ids
-    offers_ids = [
-        re.search("[^_]*$", off.attrib["class"]).group()[2:]
-        for off in page.element("table[id=offers_table] table[summary=Ogłoszenie]")
-    ]
-
-    return {
-        "url": url,
-        "offers_urls": __create_url_olx(offers_ids)
-    }
-
-
-def scraper_olx(url):
+def scraper_olx(url, page=None):
     """ Extracts the relevant information from provided offer page. """
-    page = get_page(url)
-
-    # Reading the images url list
-    url_img_list = [
-        re.search("[^;]*", elem.attrib["src"]).group()
-        for elem in page.element("div[class=photo-glow] img")]
-
-    # Extracting price
-    try:
-        price = int("".join([
-            d for d
-            in page.find("div[class=price-label]", first=True).text
-            if d.isdigit()
-        ]))
-    except ValueError:
-        price = None
-    except AttributeError:
-        price = None
-
-    # Reading the location
-    try:
-        loc_raw = page.find("a[class=show-map-link]", first=True).text
-        loc = re.search("^[^, ]*", loc_raw).group()
-
-        if loc == "Warszawa":
-            loc = re.search("[^, ]*$", loc_raw).group()  # Save district if it's Warsaw
-            loc = loc.replace("-", " ")
-
-    except AttributeError:
-        loc = None
-
-    # Reading the attributes
-    try:
-        attr_dict = dict([e.text.split(sep="\n")
-                          for e in page.find("div[id=offerdescription] table[class=item]")])
-    except ValueError:
-        attr_dict = {}
-
-    # Reading number of rooms
-    rooms = attr_dict.get("Liczba pokoi")
-    try:
-        if rooms is None:
-            rooms_number = None
-        else:
-            rooms_number_raw = re.search("[0-9]*", rooms).group()
-            rooms_number = int(rooms_number_raw) if len(rooms_number_raw) > 0 else 0
-    except ValueError:
-        rooms_number = None
-    except TypeError:
-        rooms_number = None
-
-    # Reading the size of the flat
-    size_raw = attr_dict.get("Powierzchnia")
-    try:
-        size = int(re.search("[0-9]*", size_raw).group())
-    except ValueError:
-        size = None
-    except TypeError:
-        size = None
-
-    # Checking if it's room offer
-    try:
-        is_room = page.element("div[class='wrapper'] td li")[-1].find("a").attrib.get("href")\
-                      .find("stancje-pokoje") != -1
-    except IndexError:
-        is_room = None
-
-    # Reading room's preference
-    preferred_group = attr_dict.get("Preferowani")
-
-    # Reading room type
-    room_type = attr_dict.get("Rodzaj pokoju")
-
-    return {
-        "url": url,
-        "is_room": is_room,
-        "price": price,
-        "loc": loc,
-        "rooms_info": rooms,
-        "rooms": rooms_number,
-        "size": size,
-        "images_urls_list": url_img_list,
-        "preferred_group": preferred_group,
-        "sharing_type": None,
-        "room_type": room_type
-    }
+    # Fetched pages are archived, so the offer can be extracted again later
+    if page is None:
+        page = get_page(url)
+        archive_page(url, page)
+    return OLX_OFFER_PLAN.run(page, url)
@@ -1,13 +1,17 @@
+from csv import DictReader, Error
 from datetime import datetime as dt
-from numpy import concatenate, unique
+from glob import glob
 from os.path import isfile
-from pandas import read_csv
-from requests import get
-from requests.exceptions import ConnectionError
-from requests_html import HTMLSession, MaxRetries
-from time import sleep
+from time import monotonic, sleep
+import re
 
+# Note: heavy dependencies (requests, requests_html, numpy, pandas) are imported only within functions using them,
+# so that scripts importing this module start fast.
 
+
+# Columns of the output file (new ones are appended, so older files can still be read)
+OFFER_COLUMNS = ["url", "is_room", "price", "loc", "rooms_info", "rooms", "size", "images_urls_list",
+                 "scrape_time", "preferred_group", "sharing_type", "room_type", "description", "lat", "lon"]
 SUPPORTED_MODES = ["rooms", "flats"]
 SUPPORTED_PAGES = ["gumtree", "olx"]
 URLS = {
@@ -43,33 +47,68 @@ class SomeOtherException(Exception):
 
 
 def get_page(url, recursion=0, retry_after=5):
+    """ Returns the page's HTML. Requests are coordinated per host by the politeness controller, which limits their
+    rate and stops sending them to a failing host (HostBlockedException is raised then). If there are egress proxies,
+    the request is sent through the one the pool picks and its result is reported back to the pool (a proxy's error
+    makes the request go through another proxy). GetPageException is raised whenever the page couldn't be retrieved
+    (None is never returned). """
+    from egress import EGRESS, PROXY_ERROR_STATUS_CODES
+    from politeness import POLITENESS, THROTTLE_STATUS_CODES, parse_retry_after
+    from requests.exceptions import ConnectionError
+    from requests_html import HTMLSession, MaxRetries
+
     if recursion > 2:
         raise GetPageException("Get page method failed too many times.")
 
+    proxy = EGRESS.choose(url)
+    host = POLITENESS.host(url, None if proxy is None else proxy.url)
+    probe = host.acquire()
+
     try:
         # Creating a new session
         session = HTMLSession()
 
         # Loading the page to a variable
-        page = session.get(url).html
+        start = monotonic()
+        response = session.get(url, proxies=None if proxy is None else {"http": proxy.url, "https": proxy.url})
         session.close()
 
-        return page
-
-    except MaxRetries:
+    except (MaxRetries, ConnectionError):
+        host.release(probe, success=False)
+        EGRESS.report(proxy, url, success=False)
         sleep(retry_after)
-        return get_page(url, recursion+1)
+        return get_page(url, recursion + 1, retry_after)
 
-    except ConnectionError:
-        sleep(retry_after)
-        return get_page(url, recursion + 1)
-
-    except Exception as err:  # We just skip page in this iteration and try to save
+    except Exception as err:  # We just skip page in this iteration (callers handle the exception) and try to save
+        host.release(probe, success=False)
+        EGRESS.report(proxy, url, success=False)
         with open("simple_get_page_log.txt", "a", encoding="utf-8") as lf:
             print(
                 "[%s] Error message: %s" % (dt.now().strftime("%Y-%m-%d, %H:%M:%S"), err),
                 end="\n%s\n" % ("-"*20),
                 file=lf)
+        raise GetPageException("Get page method failed: %s" % err)
+
+    # The host asks us to slow down, so its circuit opens (for as long as it asked for)
+    if response.status_code in THROTTLE_STATUS_CODES:
+        host.release(probe, success=False, throttled=True,
+                     retry_after=parse_retry_after(response.headers.get("Retry-After")))
+        EGRESS.report(proxy, url, success=False)
+        raise GetPageException("Host throttles requests (HTTP %d): %s" % (response.status_code, url))
+
+    # The proxy couldn't pass the request on, so it's sent again (the pool picks another proxy for a failed one)
+    if proxy is not None and response.status_code in PROXY_ERROR_STATUS_CODES:
+        host.release(probe, success=False)
+        EGRESS.report(proxy, url, success=False)
+        return get_page(url, recursion + 1, retry_after)
+
+    host.release(probe, success=response.status_code < 500)
+    EGRESS.report(proxy, url, success=True, latency=monotonic() - start)
+
+    # Error page isn't the page (e.g. a listing without offers would make all of its offers look new next time)
+    if response.status_code >= 500:
+        raise GetPageException("Host failed to serve the page (HTTP %d): %s" % (response.status_code, url))
+    return response.html
 
 
 def get_url(page_name, mode):
@@ -82,6 +121,9 @@ def get_url(page_name, mode):
 def is_duplicate(file_path, key, value):
     """ Method returns information if given value of chosen key is a duplicate to selected file.
     Note: method assumes that key values in file are already unique. """
+    from numpy import concatenate, unique
+    from pandas import read_csv
+
     def __is_duplicate(el_array, new_el):
         return len(unique(concatenate((el_array, [new_el])))) != len(el_array) + 1
 
@@ -89,32 +131,88 @@ def is_duplicate(file_path, key, value):
     if file_path is None or not isfile(file_path):
         return False
 
-    return __is_duplicate(
-        read_csv(file_path,
-                 names=["url", "is_room", "price", "loc", "rooms_info", "rooms", "size", "images_urls_list",
-                        "scrape_time", "preferred_group", "sharing_type", "room_type"]).loc[:, key],
-        value)
+    return __is_duplicate(read_csv(file_path, names=OFFER_COLUMNS).loc[:, key], value)
+
+
+def output_parts(db_file):
+    """ Returns all existing parts of the output file (files rotated by the worker end with _pXX.csv). """
+    pattern = re.sub("_p[0-9]{2}\\.csv$", "_p[0-9][0-9].csv", db_file)
+    return sorted(glob(pattern)) if pattern != db_file else [f for f in [db_file] if isfile(f)]
+
+
+def complete_rows(lines):
+    """ Returns (rows as dictionaries, number of lines they take) of the rows in given lines of the output file.
+    Values might span several lines (e.g. descriptions with new lines), so a row at the end which isn't complete yet
+    is left out (it's still being written), while a malformed row elsewhere is skipped. """
+    rows, start = [], 0
+    while start < len(lines):
+        reader = DictReader(lines[start:], fieldnames=OFFER_COLUMNS, strict=True)
+        done = 0
+        try:
+            for row in reader:
+                rows.append(row)
+                done = reader.line_num
+            return rows, len(lines)
+        except Error:
+            consumed = reader.reader.line_num  # lines read by the failed row too
+            if consumed >= len(lines) - start:
+                return rows, start + done
+            start += max(consumed, 1)
+    return rows, start
+
+
+def read_new_rows(db_file, offsets):
+    """ Returns rows (as dictionaries) added to the output files since the last call.
+    :param db_file: output file (any of its parts)
+    :param offsets: dictionary part -> number of bytes already read; it is updated by this function
+    """
+    rows = []
+    for part in output_parts(db_file):
+        with open(part, "r", encoding="utf-8", newline="") as df:  # keep line endings to count bytes right
+            df.seek(offsets.get(part, 0))
+            lines = df.readlines()
+
+        # Skip the last line (or the last row spanning several lines) if it is still being written
+        if len(lines) > 0 and not lines[-1].endswith("\n"):
+            lines.pop()
+        part_rows, read_lines = complete_rows(lines)
+        offsets[part] = offsets.get(part, 0) + sum([len(line.encode("utf-8")) for line in lines[:read_lines]])
+
+        rows += part_rows
+
+    return rows
 
 
 def send_message(bot_token, chat_id, text_body):
+    from requests import get
+
     url = "https://api.telegram.org/bot%s/sendMessage?text=%s&chat_id=%d" % (bot_token, text_body, chat_id)
     get(url)
 
 
-def thread_runner(threads, thread_statuses):
-    """ Method used by main script to run, monitor and stop threads. """
+def thread_runner(threads, thread_statuses, metrics=None):
+    """ Method used by main script to run, monitor and stop threads.
+    Metrics of provided objects (name -> object with stats() method) are printed once everything is finished. """
 
     # Starting the threads
     for thr in threads:
         thr.start()
 
+    def __print_header():
+        print("|%s|" % "|".join([" %-8s " % thr for thr in columns]))
+        print("|%s|" % "|".join(["-"*10 for thr in columns]))
+
     # Printing table's header
-    print("|%s|" % "|".join([" %-8s " % thr for thr in thread_statuses.keys()]))
-    print("|%s|" % "|".join(["-"*10 for thr in thread_statuses]))
+    columns = list(thread_statuses.keys())
+    __print_header()
 
     try:
-        # Keep printing status of the threads
+        # Keep printing status of the threads (threads might come and go, e.g. readers of the reader pool)
         while True:
+            if list(thread_statuses.keys()) != columns:
+                columns = list(thread_statuses.keys())
+                print()
+                __print_header()
             print("\r|%s|" % "|".join([" %-8s " % status for status in thread_statuses.values()]), end="")
 
     except KeyboardInterrupt:
@@ -129,3 +227,8 @@ def thread_runner(threads, thread_statuses):
     finally:
         # Print last status when everything is finished
         print("\r|%s|" % "|".join([" %-8s " % status for status in thread_statuses.values()]))
+
+        # Print metrics (e.g. how many offers were shed)
+        for (name, obj) in (metrics or {}).items():
+            if hasattr(obj, "stats"):
+                print("%s: %s" % (name, ", ".join(["%s %s" % (k, v) for (k, v) in obj.stats().items()])))
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import json
+
+
+class WebhookServer:
+    """ Embedded HTTP endpoint which receives updates pushed by Telegram (instead of polling for them).
+    Updates are acknowledged immediately and handled by a pool of threads. Telegram redelivers updates which
+    were not acknowledged in time, so ids of recently received updates are remembered and duplicates are dropped. """
+    def __init__(self, handle_update, listen="0.0.0.0", port=8443, url_path="/", workers=1, dedup_window=1000):
+        """
+        :param handle_update: function called with every update (decoded JSON)
+        :param listen: address the server listens on
+        :param port: port the server listens on
+        :param url_path: path the updates are posted to (a secret path protects from fake updates)
+        :param workers: number of threads handling the updates at once
+        :param dedup_window: number of recent update ids remembered
+        """
+        self.handle_update = handle_update
+        self.address = (listen, port)
+        self.url_path = url_path if url_path.startswith("/") else "/" + url_path
+        self.workers = workers
+        self.dedup_window = dedup_window
+
+        self.lock = Lock()
+        self.recent_ids = OrderedDict()
+        self.server = None
+        self.executor = None
+        self.received = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id):
+        """ Checks whether update with given id was already received (and remembers it if it wasn't). """
+        with self.lock:
+            if update_id in self.recent_ids.keys():
+                self.duplicates += 1
+                return True
+
+            self.recent_ids[update_id] = True
+            if len(self.recent_ids) > self.dedup_window:
+                self.recent_ids.popitem(last=False)
+            self.received += 1
+            return False
+
+    def __make_handler(self):
+        webhook = self
+
+        class UpdateHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass  # Don't mess up the threads' status table
+
+            def do_POST(self):
+                if self.path != webhook.url_path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                try:
+                    update = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                # Acknowledge first so Telegram doesn't wait for (or resend) slow updates
+                self.send_response(200)
+                self.end_headers()
+
+                if not webhook.is_duplicate(update.get("update_id")):
+                    webhook.executor.submit(webhook.handle_update, update)
+
+        return UpdateHandler
+
+    @property
+    def port(self):
+        """ Port the server actually listens on (useful if it was started with port 0). """
+        return self.server.server_address[1]
+
+    def start(self):
+        """ Starts the server in a background thread. """
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Webhook")
+        self.server = ThreadingHTTPServer(self.address, self.__make_handler())
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Stops the server and waits for the updates which are being handled. """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.executor.shutdown(wait=True)
+            self.server = None
+
+    def stats(self):
+        """ Returns the server's metrics. """
+        return {"received": self.received, "duplicates": self.duplicates}